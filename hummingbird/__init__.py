@@ -43,22 +43,14 @@ def main():
         if (args.influxdb is not None):
             from .ipc import influx
             influx.init(args.influxdb)
-        from .backend import Worker
-        if(args.backend != True):
-            worker = Worker(args.backend, args.port)
-        else:
-            worker = Worker(None, args.port)
-        if not args.profile:
-            worker.start()
-        else:
-            from pycallgraph import PyCallGraph
-            from pycallgraph.output import GraphvizOutput
+        if args.workers is not None and args.workers > 1:
             from . import ipc
-            import os
-            graphviz = GraphvizOutput()
-            graphviz.output_file = 'pycallgraph_%d.png' % (ipc.mpi.rank)
-            with PyCallGraph(output=graphviz):
-                worker.start()
+            if ipc.mpi.use_mpi:
+                print("The --workers option cannot be used together with MPI")
+                exit(1)
+            ipc.local.start(args.workers, lambda: _start_backend(args))
+        else:
+            _start_backend(args)
     elif(args.interface is not False):
         from . import interface
         interface.start_interface(args.no_restore)
@@ -68,5 +60,23 @@ def main():
             pid = int(file.read())
         os.kill(pid, signal.SIGUSR1)
 
+def _start_backend(args):
+    """Create the backend worker and start its event loop"""
+    from .backend import Worker
+    if(args.backend != True):
+        worker = Worker(args.backend, args.port)
+    else:
+        worker = Worker(None, args.port)
+    if not args.profile:
+        worker.start()
+    else:
+        from pycallgraph import PyCallGraph
+        from pycallgraph.output import GraphvizOutput
+        from . import ipc
+        graphviz = GraphvizOutput()
+        graphviz.output_file = 'pycallgraph_%d.png' % (ipc.mpi.rank)
+        with PyCallGraph(output=graphviz):
+            worker.start()
+
 if __name__ == "__main__":
     main()
@@ -3,13 +3,14 @@
 # Hummingbird is distributed under the terms of the Simplified BSD License.
 # -------------------------------------------------------------------------
 """Creates Hummingbird events for testing purposes"""
+import logging
 import random
 import time
 
 import numpy
 
 from hummingbird import ipc
-from . import EventTranslator, Worker, add_record, ureg
+from . import EventTranslator, add_record, ureg
 
 
 class DummyTranslator(object):
@@ -53,10 +54,8 @@ class DummyTranslator(object):
                 self.keys.add(self.state['Dummy']['Data Sources'][ds]['type'])
 
         except (IndexError, StopIteration) as e:
+            # The worker calls end_of_run and reports to the master
             logging.warning('End of Run.')
-            if 'end_of_run' in dir(Worker.conf):
-                Worker.conf.end_of_run()
-            ipc.mpi.slave_done()
             return None
 
         return EventTranslator(evt, self)
@@ -3,6 +3,11 @@
 # Hummingbird is distributed under the terms of the Simplified BSD License.
 # -------------------------------------------------------------------------
 """Provides the interface between the analysis code and the various translators."""
+import threading
+
+# Serializes the calls of the translators, which keep caches but are
+# called from the prefetching thread as well as from onEvent
+translator_lock = threading.RLock()
 
 class EventTranslator(object):
     """Provides the interface between the analysis code and the various
@@ -28,30 +33,42 @@ class EventTranslator(object):
         
     def __getitem__(self, key):
         if key not in self._cache:
-            self._cache[key] = self._trans.translate(self._evt, key)
+            with translator_lock:
+                self._cache[key] = self._trans.translate(self._evt, key)
         return self._cache[key]
 
     def keys(self):
         """Returns the translated keys available"""
         if self._trans_keys is None:
-            self._trans_keys = self._trans.event_keys(self._evt)
+            with translator_lock:
+                self._trans_keys = self._trans.event_keys(self._evt)
         return self._trans_keys + self._new_keys
 
     def native_keys(self):
         """Returns the keys, with facility specific names, available"""
         if self._native_keys is None:
-            self._native_keys = self._trans.event_native_keys(self._evt)
+            with translator_lock:
+                self._native_keys = self._trans.event_native_keys(self._evt)
         return self._native_keys
 
     def event_id(self):
         """Returns an id which should be unique for each
         shot and increase monotonically"""
         if self._id is None:
-            self._id = self._trans.event_id(self._evt)
+            with translator_lock:
+                self._id = self._trans.event_id(self._evt)
         return self._id
 
     def event_id2(self):
         """Returns an alternative id"""
         if self._id2 is None:
-            self._id2 = self._trans.event_id2(self._evt)
+            with translator_lock:
+                self._id2 = self._trans.event_id2(self._evt)
         return self._id2
+
+    def clear_cache(self):
+        """Forget the translated values, such that they are translated
+        again, e.g. after the translator was reconfigured"""
+        self._cache = dict([(key, self._cache[key]) for key in self._new_keys if key in self._cache])
+        self._trans_keys = None
+        self._native_keys = None
@@ -8,6 +8,8 @@ from __future__ import print_function  # Compatibility with python 2 and 3
 import datetime
 import logging
 import os
+import sys
+import threading
 
 import numpy
 from pytz import timezone
@@ -16,6 +18,8 @@ import psana
 
 from hummingbird import ipc
 from . import EventTranslator, Record, Worker, add_record, ureg
+from .event_translator import translator_lock
+from .prefetcher import on_main_thread
 
 _argparser = None
 def add_cmdline_args():
@@ -51,6 +55,106 @@ def add_cmdline_args():
 PNCCD_IDS = ['pnccdFront', 'pnccdBack']
 ACQ_IDS = [('ACQ%i' % i) for i in range(1,4+1)]
 
+def _indexable(dsrc):
+    """Returns True if the data source is a single run of XTC files,
+    whose events can be read in any order using the index files"""
+    options = dsrc.split(':')
+    if not options[0].startswith('exp='):
+        return False
+    runs = [o[len('run='):] for o in options if o.startswith('run=')]
+    if len(runs) != 1 or not runs[0].isdigit():
+        return False
+    # Live data and small data are read in order
+    return not [o for o in options if o in ('live', 'smd') or o.startswith('stream=')]
+
+def _locked(data):
+    """Returns the function data, to be evaluated by a lazy Record,
+    holding the translator lock, as psana is not thread safe"""
+    if not hasattr(data, '__call__'):
+        return data
+    def locked():
+        with translator_lock:
+            return data()
+    return locked
+
+# The corrections (pedestals, common mode, gain) of the data methods
+_CALIB_STEPS = {'raw':       (False, False, False),
+                'calib_pc':  (True, False, False),
+                'calib_cmc': (True, True, False),
+                'calib_gc':  (True, True, True)}
+
+class _Calibration(object):
+    """Returns the raw data of a detector corrected with its calibration
+    constants, which are only read once per run and kept as contiguous
+    float32 arrays. The corrections are done in place, in one array.
+
+    With buffers > 0 the data is corrected into that many arrays in turn,
+    instead of a new one for every event. An array still referred to,
+    by a Record of an event read ahead or kept by the analysis, is not
+    reused; a new one takes its place in the pool."""
+    def __init__(self, pedestals, common_mode, gain, buffers=0):
+        self.pedestals = pedestals
+        self.common_mode = common_mode
+        self.gain = gain
+        self._run = None
+        self._constants = (None, None)
+        self._buffers = [None for i in range(int(buffers))]
+        self._next = 0
+
+    def __call__(self, obj, evt):
+        raw = obj.raw(evt)
+        if raw is None:
+            return None
+        rnum = obj.runnum(evt)
+        if rnum != self._run:
+            self._load(obj, evt, rnum)
+        pedestals, gain = self._constants
+        data = self._output(raw.shape)
+        if pedestals is not None:
+            numpy.subtract(raw, pedestals, out=data)
+        else:
+            data[...] = raw
+        if self.common_mode:
+            obj.common_mode_apply(rnum, data, cmpars=None)
+        if gain is not None:
+            data *= gain
+        return data
+
+    def _load(self, obj, evt, rnum):
+        """Read the calibration constants of the run"""
+        pedestals = gain = None
+        if self.pedestals:
+            pedestals = obj.pedestals(evt)
+            if pedestals is None:
+                logging.warning("No pedestals found for run %s", rnum)
+            else:
+                pedestals = numpy.ascontiguousarray(pedestals, dtype=numpy.float32)
+        if self.gain:
+            gain = obj.gain(evt)
+            if gain is not None:
+                gain = numpy.ascontiguousarray(gain, dtype=numpy.float32)
+            if gain is not None and (gain == 1).all():
+                # Nothing to correct
+                gain = None
+        self._constants = (pedestals, gain)
+        self._run = rnum
+
+    def _output(self, shape):
+        """Returns the array to write the corrected data to"""
+        if not self._buffers:
+            return numpy.empty(shape, dtype=numpy.float32)
+        for i in range(len(self._buffers)):
+            self._next = (self._next + 1) % len(self._buffers)
+            data = self._buffers[self._next]
+            if data is None or data.shape != shape:
+                break
+            # Only the pool, data and getrefcount refer to a free buffer
+            if sys.getrefcount(data) <= 3:
+                return data
+        data = numpy.empty(shape, dtype=numpy.float32)
+        self._buffers[self._next] = data
+        return data
+
 class LCLSTranslator(object):
     """Translate between LCLS events and Hummingbird ones"""
     def __init__(self, state):
@@ -106,20 +210,30 @@ class LCLSTranslator(object):
             self.i = 0
             self.data_source = psana.DataSource(dsrc)
             self.run = self.data_source.runs().next()                        
-        elif 'indexing' in state:
+        elif 'indexing' in state or _indexable(dsrc):
+            # The event readers take batches of consecutive events from
+            # a queue, rather than every nth event, so a slow reader does
+            # not hold back the others and no event is read in vain
             if dsrc[-len(':idx'):] != ':idx':
                 dsrc += ':idx'
-            if 'index_offset' in state:
-                self.i = state['index_offset'] / ipc.mpi.nr_event_readers()
-            else:
-                self.i = 0
+            self.times = None
+            self.fiducials = None
+            self.index_offset = int(state.get('index_offset', 0))
+            self.batch_size = 10
+            if 'LCLS/BatchSize' in state:
+                self.batch_size = state['LCLS/BatchSize']
+            elif('LCLS' in state and 'BatchSize' in state['LCLS']):
+                self.batch_size = state['LCLS']['BatchSize']
+            self.i = 0
+            self.batch_end = 0
             self.data_source = psana.DataSource(dsrc)
             self.run = self.data_source.runs().next()
             self.timestamps = self.run.times()
             if self.N is not None:
                 self.timestamps = self.timestamps[:self.N]
-            self.timestamps = self.timestamps[ipc.mpi.event_reader_rank()::ipc.mpi.nr_event_readers()]
+            self.dsrc = dsrc
         else:
+            # Reading a stream, the shared memory or several runs
             self.times = None
             self.fiducials = None
             self.i = 0
@@ -169,6 +283,36 @@ class LCLSTranslator(object):
             self._c2n[v] = self._c2n.get(v, [])
             self._c2n[v].append(k)
 
+        # Define the functions translating each LCLS type
+        self._translators = {}
+        for k, v in self._n2c.items():
+            if v == 'photonEnergies':
+                self._translators[k] = self._tr_bld_data_ebeam
+        self._translators[psana.Bld.BldDataFEEGasDetEnergy] = self._tr_bld_data_fee_gas_det_energy
+        self._translators[psana.Bld.BldDataFEEGasDetEnergyV1] = self._tr_bld_data_fee_gas_det_energy
+        self._translators[psana.Lusi.IpmFexV1] = self._tr_lusi_ipm_fex
+        self._translators[psana.Camera.FrameV1] = self._tr_camera
+        self._translators[psana.CsPad.DataV2] = self._tr_cspad
+        self._translators[psana.CsPad2x2.ElementV1] = self._tr_cspad2x2
+        self._translators[psana.PNCCD.FullFrameV1] = self._tr_pnccdFullFrame
+        self._translators[psana.PNCCD.FramesV1] = self._tr_pnccdFrames
+        self._translators[psana.Acqiris.DataDescV1] = self._tr_acqiris
+        self._translators[psana.EventId] = self._tr_event_id
+        for k, v in self._n2c.items():
+            if v == 'eventCodes':
+                self._translators[k] = self._tr_event_codes
+
+        # The event keys of each Hummingbird key for the run being read,
+        # and the run and event keys they were found for
+        self._run_keys = None
+        self._run_keys_run = None
+        # The last event of each thread, with its run and event keys
+        self._last_event = threading.local()
+        # The LCLS types found without a translation
+        self._unsupported = set()
+        # The configuration of each Acqiris, by source
+        self._acqiris_configs = {}
+
         # Define how to translate between LCLS sources and Hummingbird ones
         self._s2c = {}
         # CXI (OnAxis Cam)
@@ -222,31 +366,8 @@ class LCLSTranslator(object):
                         f = lambda obj, evt: obj.image(evt)
                     elif meth == "calib":
                         f = lambda obj, evt: obj.calib(evt)
-                    elif meth == "raw":
-                        def f(obj, evt):
-                            #obj = self._detectors[detid]['obj']
-                            raw = numpy.array(obj.raw(evt), dtype=numpy.float32, copy=True)
-                            return raw
-                    elif meth == "calib_pc":
-                        def f(obj, evt):
-                            cdata = numpy.array(obj.raw(evt), dtype=numpy.float32, copy=True) - obj.pedestals(evt)
-                            return cdata
-                    elif meth == "calib_cmc":
-                        def f(obj, evt):
-                            #obj = self._detectors[detid]['obj']
-                            rnum = obj.runnum(evt)
-                            cdata = numpy.array(obj.raw(evt), dtype=numpy.float32, copy=True) - obj.pedestals(evt)
-                            obj.common_mode_apply(rnum, cdata, cmpars=None)
-                            return cdata
-                    elif meth == "calib_gc":
-                        def f(obj, evt):
-                            #obj = self._detectors[detid]['obj']
-                            rnum = obj.runnum(evt)
-                            cdata = numpy.array(obj.raw(evt), dtype=numpy.float32, copy=True) - obj.pedestals(evt)
-                            obj.common_mode_apply(rnum, cdata, cmpars=None)
-                            gain = obj.gain(evt)
-                            cdata *= gain
-                            return cdata
+                    elif meth in _CALIB_STEPS:
+                        f = _Calibration(*_CALIB_STEPS[meth], buffers=det_dict.get('buffers', 0))
                     else:
                         raise RuntimeError('data_method = %s not supported' % meth)
                     self._detectors[detid]['data_method'] = f
@@ -265,7 +386,13 @@ class LCLSTranslator(object):
 
     def next_event(self):
         """Grabs the next event and returns the translated version"""           
-        if self.timestamps:            
+        if self.timestamps is not None:
+            if self.i >= self.batch_end:
+                # Talk to the master on the main thread, also when prefetching
+                self.i, self.batch_end = on_main_thread(ipc.mpi.next_batch, self.dsrc, len(self.timestamps),
+                                                        self.batch_size, self.index_offset)
+                if self.i >= self.batch_end:
+                    return None
             try:
                 evt = self.run.event(self.timestamps[self.i])
             except (IndexError, StopIteration) as e:
@@ -306,13 +433,37 @@ class LCLSTranslator(object):
 
     def event_keys(self, evt):
         """Returns the translated keys available"""
-        native_keys = evt.keys()
-        common_keys = set()
-        for k in native_keys:
-            for c in self._native_to_common(k):
-                common_keys.add(c)
         # parameters corresponds to the EPICS values, analysis is for values added later on
-        return list(common_keys)+['parameters']+['analysis']
+        return list(self._keys_of_run(evt).keys())+['parameters']+['analysis']
+
+    def _keys_of_run(self, evt):
+        """Returns the native keys, with the functions translating them,
+        by Hummingbird key. They are only looked up again when the run,
+        or the keys in the event, change."""
+        if getattr(self._last_event, 'evt', None) is not evt:
+            # Only look at the keys once per event, each thread
+            # (reading ahead or running onEvent) has an event of its own
+            event_keys = evt.keys()
+            event_id = evt.get(psana.EventId)
+            self._last_event.run = (event_id.run() if event_id is not None else None,
+                                    frozenset([(k.type(), str(k.src()), k.key()) for k in event_keys]))
+            self._last_event.keys = event_keys
+            self._last_event.evt = evt
+        run = self._last_event.run
+        if self._run_keys is None or run != self._run_keys_run:
+            run_keys = {}
+            for k in self._last_event.keys:
+                if k.type() in self._translators:
+                    run_keys.setdefault(self._n2c[k.type()], []).append((k, self._translators[k.type()]))
+                elif k.type() in self._n2c and k.type() not in self._unsupported:
+                    logging.warning('%s not yet supported, skipping it' % k.type())
+                    self._unsupported.add(k.type())
+            if self._run_keys_run is None or run[0] != self._run_keys_run[0]:
+                # The configuration may change with the run
+                self._acqiris_configs = {}
+            self._run_keys = run_keys
+            self._run_keys_run = run
+        return self._run_keys
 
     def _native_to_common(self, key):
         """Translates a native key to a hummingbird one"""
@@ -388,42 +539,10 @@ class LCLSTranslator(object):
         Core keys include  all except: parameters, any psana create key,
         any native key."""
         values = {}
-        native_keys = self._c2n[key]
-        event_keys = evt.keys()
-        for k in event_keys:
-            if(k.type() in native_keys):
-                obj = evt.get(k.type(), k.src(), k.key())
-                if(isinstance(obj, psana.Bld.BldDataFEEGasDetEnergy) or
-                   isinstance(obj, psana.Bld.BldDataFEEGasDetEnergyV1)):
-                    self._tr_bld_data_fee_gas_det_energy(values, obj)
-                elif(isinstance(obj, psana.Lusi.IpmFexV1)):
-                    self._tr_lusi_ipm_fex(values, obj, k)
-                elif(key == 'photonEnergies'):
-                    self._tr_bld_data_ebeam(values, obj)
-                elif(isinstance(obj, psana.CsPad2x2.ElementV1)):
-                    self._tr_cspad2x2(values, obj)
-                elif(isinstance(obj, psana.CsPad.DataV2)):
-                    self._tr_cspad(values, obj, k)
-                # AMO
-                elif(isinstance(obj, psana.PNCCD.FullFrameV1)):
-                    self._tr_pnccdFullFrame(values, obj, k)
-                elif(isinstance(obj, psana.PNCCD.FramesV1)):
-                    self._tr_pnccdFrames(values, obj, k)
-                # --
-                elif(isinstance(obj, psana.Acqiris.DataDescV1)):
-                    self._tr_acqiris(values, obj, k)
-                elif(isinstance(obj, psana.Camera.FrameV1)):
-                    self._tr_camera(values, obj)
-                elif(isinstance(obj, psana.EventId)):
-                    self._tr_event_id(values, obj)
-                elif(isinstance(obj, psana.EvrData.DataV3) or
-                     isinstance(obj, psana.EvrData.DataV4)):
-                    self._tr_event_codes(values, obj)
-                else:
-                    print(type(obj))
-                    print(k)
-                    raise RuntimeError('%s not yet supported' % (type(obj)))
-                
+        for k, translate in self._keys_of_run(evt).get(key, []):
+            obj = evt.get(k.type(), k.src(), k.key())
+            if obj is not None:
+                translate(values, obj, k)
         return values
 
     def event_id(self, evt):
@@ -435,7 +554,7 @@ class LCLSTranslator(object):
         """Returns the LCLS time, a 64-bit integer as an alterative ID"""
         return self.translate(evt, 'eventID')['Timestamp'].timestamp2
 
-    def _tr_bld_data_ebeam(self, values, obj):
+    def _tr_bld_data_ebeam(self, values, obj, evt_key=None):
         """Translates BldDataEBeam to hummingbird photon energy and other beam properties"""
         try:
             photon_energy_ev = obj.ebeamPhotonEnergy()
@@ -472,7 +591,7 @@ class LCLSTranslator(object):
         except AttributeError:
             print("Couldn't translate electron beam properties from BldDataEBeam")
 
-    def _tr_bld_data_fee_gas_det_energy(self, values, obj):
+    def _tr_bld_data_fee_gas_det_energy(self, values, obj, evt_key=None):
         """Translates gas monitor detector to hummingbird pulse energy"""
         # convert from mJ to J
         add_record(values, 'pulseEnergies', 'f_11_ENRC', obj.f_11_ENRC(), ureg.mJ)
@@ -485,14 +604,14 @@ class LCLSTranslator(object):
         to hummingbird pulse energy"""
         add_record(values, 'pulseEnergies', 'IpmFex - '+str(evt_key.src()), obj.sum(), ureg.ADU)
 
-    def _tr_cspad2x2(self, values, obj):
+    def _tr_cspad2x2(self, values, obj, evt_key=None):
         """Translates CsPad2x2 to hummingbird numpy array"""
-        try:
-            add_record(values, 'photonPixelDetectors', 'CsPad2x2S', obj.data(), ureg.ADU)
-        except AttributeError:
-            add_record(values, 'photonPixelDetectors', 'CsPad2x2', obj.data16(), ureg.ADU)
+        if hasattr(obj, 'data'):
+            add_record(values, 'photonPixelDetectors', 'CsPad2x2S', _locked(obj.data), ureg.ADU)
+        else:
+            add_record(values, 'photonPixelDetectors', 'CsPad2x2', _locked(obj.data16), ureg.ADU)
 
-    def _tr_camera(self, values, obj):
+    def _tr_camera(self, values, obj, evt_key=None):
         """Translates Camera frame to hummingbird numpy array"""
         #if obj.depth == 16 or obj.depth() == 12:
         #    data = obj.data16()
@@ -514,42 +633,69 @@ class LCLSTranslator(object):
             add_record(values, 'camera', 'onAxis', data, ureg.ADU)
 
     def _tr_cspad(self, values, obj, evt_key):
-        """Translates CsPad to hummingbird numpy array, quad by quad"""
+        """Translates CsPad to hummingbird numpy array, quad by quad.
+        The quads are only read when used."""
         n_quads = obj.quads_shape()[0]
         for i in range(0, n_quads):
             add_record(values, 'photonPixelDetectors', '%sQuad%d' % (self._s2c[str(evt_key.src())], i),
-                       obj.quads(i).data(), ureg.ADU)
+                       _locked(lambda i=i: obj.quads(i).data()), ureg.ADU)
     def _tr_pnccdFullFrame(self, values, obj, evt_key):
         """Translates full pnCCD frame to hummingbird numpy array"""
-        add_record(values, 'photonPixelDetectors', '%sfullFrame' % self._s2c[str(evt_key.src())], obj.data(), ureg.ADU)
+        add_record(values, 'photonPixelDetectors', '%sfullFrame' % self._s2c[str(evt_key.src())],
+                   _locked(obj.data), ureg.ADU)
     def _tr_pnccdFrames(self, values, obj, evt_key):
-        """Translates pnCCD frames to hummingbird numpy array, frame by frame"""
+        """Translates pnCCD frames to hummingbird numpy array, frame by frame.
+        The frames are only read when used."""
         n_frames = obj.frame_shape()[0]
         for i in range(0, n_frames):
             add_record(values, 'photonPixelDetectors', '%sFrame%d' % (self._s2c[str(evt_key.src())], i),
-                       obj.frame(i).data(), ureg.ADU)
+                       _locked(lambda i=i: obj.frame(i).data()), ureg.ADU)
+    def _acqiris_config(self, evt_key):
+        """Returns the sampling interval, slopes and offsets of an Acqiris,
+        which are read from the configuration once per run"""
+        src = str(evt_key.src())
+        if src not in self._acqiris_configs:
+            config_store = self.data_source.env().configStore()
+            acq_config = config_store.get(psana.Acqiris.ConfigV1, evt_key.src())
+            verts = acq_config.vert()
+            slopes = numpy.array([v.slope() for v in verts], dtype=numpy.float32)
+            offsets = numpy.array([v.offset() for v in verts], dtype=numpy.float32)
+            self._acqiris_configs[src] = {'samp_interval': acq_config.horiz().sampInterval(),
+                                          'slopes': slopes[:, numpy.newaxis],
+                                          'offsets': offsets[:, numpy.newaxis],
+                                          'times': {}}
+        return self._acqiris_configs[src]
+
     def _tr_acqiris(self, values, obj, evt_key):
-        """Translates Acqiris TOF data to hummingbird numpy array"""
-        config_store = self.data_source.env().configStore()
-        acq_config = config_store.get(psana.Acqiris.ConfigV1, evt_key.src())
-        samp_interval = acq_config.horiz().sampInterval()
+        """Translates Acqiris TOF data to hummingbird numpy array.
+        The waveforms of all the channels are converted together,
+        the first time one of them is used."""
+        config = self._acqiris_config(evt_key)
         n_channels = obj.data_shape()[0]
-        for i in range(0, n_channels):
-            vert = acq_config.vert()[i]
-            elem = obj.data(i)
-            timestamp = elem.timestamp()[0].value()
-            raw = elem.waveforms()[0]
-            if(elem.nbrSamplesInSeg() == 0):
+        elems = [obj.data(i) for i in range(0, n_channels)]
+        n_samples = [elem.nbrSamplesInSeg() for elem in elems]
+        volts = []
+        def convert():
+            if not volts:
+                data = numpy.zeros((n_channels, max(n_samples)), dtype=numpy.float32)
+                for i, elem in enumerate(elems):
+                    data[i, :n_samples[i]] = elem.waveforms()[0][:n_samples[i]]
+                data *= config['slopes'][:n_channels]
+                data -= config['offsets'][:n_channels]
+                volts.append(data)
+            return volts[0]
+        for i, elem in enumerate(elems):
+            if(n_samples[i] == 0):
                 logging.warning("Warning: TOF data for "
                                 "detector %s is missing.", evt_key)
-            data = raw*vert.slope() - vert.offset()
+            if n_samples[i] not in config['times']:
+                config['times'][n_samples[i]] = config['samp_interval'] * numpy.arange(0, n_samples[i])
             rec = Record('%s Channel %d' %(self._s2c[str(evt_key.src())], i),
-                         data, ureg.V)
-            rec.time = (timestamp +
-                        samp_interval * numpy.arange(0, elem.nbrSamplesInSeg()))
+                         _locked(lambda i=i: convert()[i, :n_samples[i]]), ureg.V)
+            rec.time = elem.timestamp()[0].value() + config['times'][n_samples[i]]
             values[rec.name] = rec
 
-    def _tr_event_id(self, values, obj):
+    def _tr_event_id(self, values, obj, evt_key=None):
         """Translates LCLS eventID into a hummingbird one"""
         timestamp = obj.time()[0]+obj.time()[1]*1e-9
         time = datetime.datetime.fromtimestamp(timestamp, tz=timezone('utc'))
@@ -565,7 +711,7 @@ class LCLSTranslator(object):
         rec.timestamp2 = obj.time()[0] << 32 | obj.time()[1]
         values[rec.name] = rec
 
-    def _tr_event_codes(self, values, obj):
+    def _tr_event_codes(self, values, obj, evt_key=None):
         """Translates LCLS event codes into a hummingbird ones"""
         codes = []
         for fifo_event in obj.fifoEvents():
@@ -0,0 +1,212 @@
+# --------------------------------------------------------------------------------------
+# Copyright 2016, Benedikt J. Daurer, Filipe R.N.C. Maia, Max F. Hantke, Carl Nettelblad
+# Hummingbird is distributed under the terms of the Simplified BSD License.
+# -------------------------------------------------------------------------
+"""Reads and translates events on a background thread.
+
+The translator is called from two threads, the prefetching one and the
+one running ``onEvent``. Its calls are serialized by
+:data:`~hummingbird.backend.event_translator.translator_lock`, and calls
+which must stay on the main thread, such as MPI communication, go
+through :func:`on_main_thread`.
+"""
+from __future__ import (absolute_import,  # Compatibility with python 2 and 3
+                        print_function)
+
+import collections
+import logging
+import threading
+
+from .event_translator import translator_lock
+from .record import Record
+
+# Marks the end of the event stream
+_END = object()
+
+# The prefetcher whose thread is the current one, if any
+_local = threading.local()
+
+
+class _Stopped(Exception):
+    """Raised in the prefetching thread when it is asked to stop"""
+
+
+def on_main_thread(func, *args):
+    """Returns func(*args), calling it on the main thread when
+    called from the prefetching thread"""
+    prefetcher = getattr(_local, 'prefetcher', None)
+    if prefetcher is None:
+        return func(*args)
+    return prefetcher._call(func, args)
+
+
+class _Call(object):
+    """A call waiting to be done on the main thread"""
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+        self.done = False
+        self.result = None
+        self.error = None
+
+    def run(self):
+        try:
+            self.result = self.func(*self.args)
+        except Exception as e: # pylint: disable=broad-except
+            self.error = e
+        self.done = True
+
+
+class EventPrefetcher(object):
+    """Reads and translates events on a background thread.
+
+    Keeps up to ``depth`` events read from the translator, so that I/O
+    of the next events overlaps with the analysis of the current one.
+    The keys listed in ``keys`` are translated, and their data read,
+    in the background as well.
+
+    Args:
+        translator: The facility specific translator.
+        depth (int): Maximum number of events kept in the queue.
+        keys (list): Hummingbird keys (e.g. 'photonPixelDetectors')
+            to translate before the event is handed out.
+    """
+    def __init__(self, translator, depth, keys=None):
+        self._translator = translator
+        self._keys = list(keys or [])
+        self._depth = max(1, int(depth))
+        # The events read and the calls for the main thread, both guarded by _cond
+        self._events = collections.deque()
+        self._calls = collections.deque()
+        self._cond = threading.Condition()
+        # The event read while being asked to stop
+        self._leftover = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        # Make sure the program exits even when the thread is still reading
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _put(self, item):
+        """Put an item in the queue, giving up if we are asked to stop"""
+        with self._cond:
+            while len(self._events) >= self._depth and not self._stop.is_set():
+                self._cond.wait(0.1)
+            if self._stop.is_set():
+                self._leftover = item
+                return False
+            self._events.append(item)
+            self._cond.notify_all()
+        return True
+
+    def _call(self, func, args):
+        """Returns func(*args), called on the main thread by next_event"""
+        call = _Call(func, args)
+        # Let the main thread translate while waiting for it
+        held = 0
+        while True:
+            try:
+                translator_lock.release()
+            except RuntimeError:
+                break
+            held += 1
+        try:
+            with self._cond:
+                self._calls.append(call)
+                self._cond.notify_all()
+                while not call.done:
+                    if self._stop.is_set():
+                        raise _Stopped()
+                    self._cond.wait(0.1)
+        finally:
+            for i in range(held):
+                translator_lock.acquire()
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def _run(self):
+        """Read events until the end of the stream or until stopped"""
+        _local.prefetcher = self
+        while not self._stop.is_set():
+            try:
+                with translator_lock:
+                    evt = self._translator.next_event()
+            except _Stopped:
+                return
+            except AttributeError as e:
+                logging.warning("Attribute error during event translation. Skipping event. (%s)" % e)
+                continue
+            except IndexError:
+                continue
+            except Exception as e: # pylint: disable=broad-except
+                # Let the event loop decide what to do with it
+                if self._put(e):
+                    self._put(_END)
+                return
+            if evt is None:
+                self._put(_END)
+                return
+            for key in self._keys:
+                try:
+                    self._decode(evt[key])
+                except Exception: # pylint: disable=broad-except
+                    # Missing data is dealt with when the analysis asks for it
+                    pass
+            if not self._put(evt):
+                return
+
+    @staticmethod
+    def _decode(values):
+        """Evaluate the lazy Records among the translated values"""
+        if not isinstance(values, dict):
+            return
+        with translator_lock:
+            for value in values.values():
+                if isinstance(value, Record):
+                    value.data # pylint: disable=pointless-statement
+
+    def next_event(self):
+        """Returns the next prefetched event, or None at the end of the stream.
+
+        Exceptions raised by the translator are re-raised here. Has to be
+        called on the main thread, which also does the calls the
+        prefetching thread made through :func:`on_main_thread`."""
+        with self._cond:
+            while True:
+                while self._calls:
+                    self._calls.popleft().run()
+                    self._cond.notify_all()
+                if self._events:
+                    item = self._events[0]
+                    # Keep returning None if asked again
+                    if item is not _END:
+                        self._events.popleft()
+                        self._cond.notify_all()
+                    break
+                self._cond.wait()
+        if item is _END:
+            return None
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+    def qsize(self):
+        """Returns the number of events waiting in the queue"""
+        with self._cond:
+            return len([e for e in self._events if e is not _END])
+
+    def stop(self):
+        """Stop reading and return the events read but not handed out yet,
+        including the one being read, once the thread has exited."""
+        self._stop.set()
+        with self._cond:
+            self._cond.notify_all()
+        self._thread.join()
+        with self._cond:
+            items = list(self._events)
+            self._events.clear()
+            if self._leftover is not None:
+                items.append(self._leftover)
+                self._leftover = None
+        return [item for item in items if item is not _END and not isinstance(item, Exception)]
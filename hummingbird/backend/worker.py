@@ -13,6 +13,7 @@ import signal
 import time
 
 from hummingbird import ipc
+from .prefetcher import EventPrefetcher
 
 
 class Worker(object):
@@ -44,6 +45,9 @@ class Worker(object):
         signal.signal(signal.SIGUSR1, self.raise_interruption)
         self.oldHandler = signal.signal(signal.SIGINT, self.ctrlcevent)
         self.translator = None
+        self.prefetcher = None
+        # Events read ahead by a prefetcher which was stopped
+        self.prefetched = []
         self.load_conf()
         try:
             Worker.state['_config_file'] = config_file
@@ -82,6 +86,8 @@ class Worker(object):
 
     def raise_interruption(self, signum, stack):
         self.reloadnow = True
+        # Pass the signal on to any locally forked workers
+        ipc.local.forward_signal(signum)
         
     def load_conf(self):
         """Load or reload the configuration file."""
@@ -102,6 +108,9 @@ class Worker(object):
             # Only copy the keys that exist in the newly loaded state
             for k in Worker.conf.state:
                 Worker.state[k] = Worker.conf.state[k]
+        ipc.mpi.reduction_period = Worker.state.get('reduction_period', 1)
+        ipc.broadcast.outbox_interval = Worker.state.get('broadcast_interval', 0.1)
+        ipc.broadcast.outbox_size = Worker.state.get('broadcast_batch_size', 100)
             
     def start(self):
         """Start the event loop."""
@@ -119,6 +128,7 @@ class Worker(object):
             print('End of run (worker %i/%i) ...' % (ipc.mpi.worker_index()+1, ipc.mpi.nr_workers()))
             self.conf.end_of_run()
         if not ipc.mpi.is_master():
+            ipc.broadcast.flush_outbox(force=True)
             ipc.mpi.slave_done()
         
     def ctrlcevent(self, whatSignal, stack):
@@ -141,7 +151,7 @@ class Worker(object):
                             return
                     else:
                         try:
-                            evt = self.translator.next_event()
+                            evt = self.next_event()
                             if evt is None:
                                 return
                         except RuntimeError as e:
@@ -163,7 +173,9 @@ class Worker(object):
                         except StopIteration:
                             logging.warning("Stopping iteration.")
                             return
+                        ipc.broadcast.flush_outbox()
             except KeyboardInterrupt:
+                self.stop_prefetching()
                 try:
                     print("Hit Ctrl+c again in the next second to quit...")
                     time.sleep(1)
@@ -174,8 +186,15 @@ class Worker(object):
                     break
             if self.reloadnow:
                 self.reloadnow = False
+                self.stop_prefetching()
+                ipc.broadcast.flush_outbox(force=True)
                 print("Reloading configuration file.")
                 self.load_conf()
+                # The translator is reconfigured when reloading,
+                # so the events read ahead are translated again
+                for evt in self.prefetched:
+                    evt.clear_cache()
+        self.stop_prefetching()
         try:
             Worker.conf.close()
         except:
@@ -183,6 +202,32 @@ class Worker(object):
         signal.signal(signal.SIGINT, self.oldHandler)
 
 
+    def next_event(self):
+        """Returns the next event from the translator.
+
+        If ``state['prefetch_events']`` is larger than 0 the events are read
+        in the background, keeping up to that many events ready while
+        ``onEvent`` runs. The keys listed in ``state['prefetch_keys']``
+        are also translated, and their data read, in the background.
+        """
+        if self.prefetched:
+            return self.prefetched.pop(0)
+        depth = Worker.state.get('prefetch_events', 0)
+        if not depth:
+            return self.translator.next_event()
+        if self.prefetcher is None:
+            self.prefetcher = EventPrefetcher(self.translator, depth,
+                                              Worker.state.get('prefetch_keys'))
+        return self.prefetcher.next_event()
+
+    def stop_prefetching(self):
+        """Stop the background reading of events, if running.
+        The events read ahead are kept for next_event."""
+        if self.prefetcher is not None:
+            self.prefetched.extend(self.prefetcher.stop())
+            self.prefetcher = None
+
+
 def init_translator(state):
     """Initialize the translator, depending on the state['Facility']."""
     if('Facility' not in state):
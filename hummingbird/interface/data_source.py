@@ -3,15 +3,23 @@
 # Hummingbird is distributed under the terms of the Simplified BSD License.
 # -------------------------------------------------------------------------
 """Manages a connection with one backend"""
+import json
 import logging
+import threading
 
 import numpy
 import zmq
 from zmq import REQ, SUB
 
+from hummingbird.ipc import framing, views
+
+from .decoder import BroadcastDecoder
 from .plotdata import PlotData
 from .Qt import QtCore, QtGui
-from .zmqsocket import ZmqSocket
+from .zmqsocket import ZmqSocket, decode_broadcast
+
+# The dtypes of the timestamps, by the dtype they were received with
+_timestamp_dtypes = {}
 
 
 class DataSource(QtCore.QObject):
@@ -26,10 +34,21 @@ class DataSource(QtCore.QObject):
         self._ssh_tunnel = ssh_tunnel
         self.connected = False
         self._plotdata = {}
+        # Guards conf and _plotdata, which the GUI thread replaces
+        # while the decoder threads use them
+        self._lock = threading.Lock()
         self._subscribed_titles = {}
         self._recorded_titles = {}
         self._recorder = None
+        # The binned/cropped views requested for each title
+        self._views = {}
+        self.supports_views = False
+        # The ctrl socket can only have one request pending
+        self._requests = []
+        self._request_pending = False
         self._data_socket = ZmqSocket(SUB, parent=None)
+        # Decodes the broadcasts and stores their data, off the GUI thread
+        self._decoder = BroadcastDecoder(self._process_frames)
 
         self.thread = QtCore.QThread()
         # Move the data socket to its own thread to ensure it's not blocked by the GUI
@@ -37,6 +56,7 @@ class DataSource(QtCore.QObject):
         self.thread.started.connect(self._data_socket.init_socket)
         self.thread.start()
         self._data_socket.closed.connect(self.thread.quit)
+        self._data_socket.closed.connect(self._decoder.stop)
 
         self.conf = conf
         self._group_structure = {}
@@ -60,7 +80,7 @@ class DataSource(QtCore.QObject):
         if title not in self._subscribed_titles:
             self._subscribed_titles[title] = [plot]
             try:
-                self._data_socket.subscribe(title)
+                self._data_socket.subscribe(self._key_name(title))
                 self.subscribed.emit(title)
                 logging.debug("Subscribing to %s on %s.", title, self.name())
             # socket might still not exist
@@ -75,13 +95,16 @@ class DataSource(QtCore.QObject):
         self._subscribed_titles[title].remove(plot)
         # Check if list is empty
         if not self._subscribed_titles[title]:
-            self._data_socket.unsubscribe(title)
+            self._data_socket.unsubscribe(self._key_name(title))
             self.unsubscribed.emit(title)
             logging.debug("Unsubscribing from %s on %s.", title, self.name())
             self._subscribed_titles.pop(title)
+            self._views.pop(title, None)
 
     def subscribe_for_recording(self, title):
         """Subscribe to the broadcast named title, and associate it with recorder"""
+        # Always record the full images
+        self.set_view(title)
         # Only subscribe if we are not already subscribing for plotting
         if title in self._subscribed_titles:
             return
@@ -105,6 +128,36 @@ class DataSource(QtCore.QObject):
             logging.debug("Unsubscribing from %s on %s.", title, self.name())
             self._recorded_titles.pop(title)
             
+    def set_view(self, title, binning=1, roi=None):
+        """Ask the backend to send the images of title binned by binning
+        and cropped to roi (see :mod:`hummingbird.ipc.views`).
+        Without arguments the full images are sent again."""
+        view = views.normalize(binning, roi)
+        if view is not None and (not self.supports_views or self._recorded_titles.get(title)):
+            view = None
+        if view == self._views.get(title):
+            return
+        subscribed = self._key_name(title) in self._data_socket.filters
+        if subscribed:
+            self._data_socket.unsubscribe(self._key_name(title))
+        if view is None:
+            self._views.pop(title)
+        else:
+            self._views[title] = view
+            self._send_request(['view'.encode('UTF-8'),
+                                json.dumps({'title': title, 'binning': view[0],
+                                            'roi': view[1]}).encode('UTF-8')])
+        if subscribed:
+            self._data_socket.subscribe(self._key_name(title))
+        logging.debug("Receiving %s on %s.", self._key_name(title), self.name())
+        # Do not mix images of different sizes
+        if title in self._plotdata:
+            self._plotdata[title].clear()
+
+    def _key_name(self, title):
+        """Returns the name under which title is subscribed"""
+        return views.name(title, self._views.get(title))
+
     def name(self):
         """Return a string representation of the data source"""
         if(self._ssh_tunnel):
@@ -137,17 +190,26 @@ class DataSource(QtCore.QObject):
         QtGui.QMessageBox.warning(self.parent(), "Connection failed!", "Could not connect to %s" % self.name())     
         
 
+    def _send_request(self, msg):
+        """Send a request to the backend, or queue it if
+        the reply to the previous one did not arrive yet"""
+        if self._request_pending:
+            self._requests.append(msg)
+            return
+        self._request_pending = True
+        self._ctrl_socket.send_multipart(msg)
+
     def _get_data_port(self):
         """Ask to the backend for the data port"""
-        self._ctrl_socket.send_multipart(['data_port'.encode('UTF-8')])
+        self._send_request(['data_port'.encode('UTF-8')])
 
     def query_configuration(self):
         """Ask to the backend for the configuration"""
-        self._ctrl_socket.send_multipart(['conf'.encode('UTF-8')])
+        self._send_request(['conf'.encode('UTF-8')])
 
     def query_reloading(self):
         """Ask the backend to reload its configuration"""
-        self._ctrl_socket.send_multipart(['reload'.encode('UTF-8')])
+        self._send_request(['reload'.encode('UTF-8')])
         
     def _get_request_reply(self, socket=None):
         """Handle the reply of the backend to a previous request"""
@@ -156,89 +218,124 @@ class DataSource(QtCore.QObject):
         if(socket is None):
             socket = self.sender()
         reply = socket.recv_json()
+        self._request_pending = False
         if(reply[0] == 'data_port'):
             self._data_port = reply[1]
             logging.debug("Data source '%s' received data_port=%s", self.name(), self._data_port)
             addr = "tcp://%s:%s" % (self._hostname, self._data_port)
+            if len(reply) > 2 and 'binary' in reply[2].get('encodings', []):
+                self._data_socket.key_prefix = framing.KEY_PREFIX
+                if reply[2].get('batches', False):
+                    # Take the scalars sent together as they are
+                    self._data_socket.key_prefix = framing.BATCH_KEY_PREFIX
+            self.supports_views = len(reply) > 2 and reply[2].get('views', False)
             # When the data socket has data ready it will be handled by the data socket thread!
             self._data_socket.ready_read.connect(self._get_broadcast, QtCore.Qt.DirectConnection)
             self._data_socket.connect_socket(addr, self._ssh_tunnel)
             self.parent().add_backend(self)
             # Subscribe to stuff already requested
             for title in self._subscribed_titles.keys():
-                self._data_socket.subscribe(title)
+                self._data_socket.subscribe(self._key_name(title))
                 self.subscribed.emit(title)
                 logging.debug("Subscribing to %s on %s.", title, self.name())
             self.query_configuration()
         elif(reply[0] == 'conf'):
-            self.conf = reply[1]
-            self.titles = self.conf.keys()
-            self.data_type = {}
-            for k in self.conf.keys():
-                if('data_type' not in self.conf[k]):
-                    # Broadcasts without any data will not have a data_type
-                    # Let's remove them from the title list and continue
-                    self.titles.remove(k)
-                    continue
-                self.data_type[k] = self.conf[k]['data_type']
-                if(k not in self._plotdata):
-                    if "group" in self.conf[k]:
-                        group = self.conf[k]["group"]
-                        if group is None:
+            added = []
+            with self._lock:
+                self.conf = reply[1]
+                self.titles = self.conf.keys()
+                self.data_type = {}
+                for k in self.conf.keys():
+                    if('data_type' not in self.conf[k]):
+                        # Broadcasts without any data will not have a data_type
+                        # Let's remove them from the title list and continue
+                        self.titles.remove(k)
+                        continue
+                    self.data_type[k] = self.conf[k]['data_type']
+                    if(k not in self._plotdata):
+                        if "group" in self.conf[k]:
+                            group = self.conf[k]["group"]
+                            if group is None:
+                                group = "No group"
+                        else:
                             group = "No group"
-                    else:
-                        group = "No group"
 
-                    self._plotdata[k] = PlotData(self, k, group=group)
-                    self.plotdata_added.emit(self._plotdata[k])
-                    self.add_item_to_group_structure(k, group)
-            # Remove PlotData which is no longer in the conf
-            for k in list(self._plotdata.keys()):
-                if k not in self.titles:
-                    self._plotdata.pop(k)
+                        self._plotdata[k] = PlotData(self, k, group=group)
+                        added.append((k, group))
+                # Remove PlotData which is no longer in the conf
+                for k in list(self._plotdata.keys()):
+                    if k not in self.titles:
+                        self._plotdata.pop(k)
+            for k, group in added:
+                self.plotdata_added.emit(self._plotdata[k])
+                self.add_item_to_group_structure(k, group)
+        elif(reply[0] == 'view'):
+            logging.debug("Data source '%s' publishes %s", self.name(), reply[1])
+        if self._requests and not self._request_pending:
+            self._send_request(self._requests.pop(0))
 
     def _get_broadcast(self):
-        """Receive a data package on the data socket"""
-        socket = self._data_socket
-        socket.blockSignals(True)
-        QtCore.QCoreApplication.processEvents()
-        socket.blockSignals(False)
-
-        # Discard key
-        socket.recv()
-        data = socket.recv_json()
-        for i in range(len(data)):
-            if data[i] == '__ndarray__':
-                data[i] = socket.recv_array()
-        self._process_broadcast(data)
+        """Receive a data package on the data socket, and queue it for decoding"""
+        self._decoder.submit(self._data_socket.recv_frames())
+
+    def _process_frames(self, frames):
+        """Decode and handle a data package, on a decoder thread"""
+        self._process_broadcast(decode_broadcast(frames))
 
     def _process_broadcast(self, payload):
         """Handle a data package received by the data socket"""
         cmd = payload[1]
         title = payload[2]
         data = payload[3]
-        if(title not in self.conf):
-            # We're getting data we were not expecting
-            # Let's discard it and order an immediate reconfigure
-            logging.debug("Received unexpected data with title %s on %s. Reconfiguring...", title, self.name())
-            return
+        with self._lock:
+            conf = self.conf.get(title)
+            plotdata = self._plotdata.get(title)
+            if(conf is None or plotdata is None):
+                # We're getting data we were not expecting
+                # Let's discard it and order an immediate reconfigure
+                logging.debug("Received unexpected data with title %s on %s. Reconfiguring...", title, self.name())
+                return
+            if(cmd == 'new_data'):
+                if not self._is_requested_view(title, payload[5].get('view')):
+                    # Sent before the view of the title changed
+                    return
+                if 'view' not in payload[5]:
+                    conf.pop('view', None)
+            conf.update(payload[5])
         if(cmd == 'new_data'):
-            data_x = payload[4]
             # At the moment x is always a timestamp so I'll add some metadata to show it
-            data_x = numpy.asarray(data_x)
-            data_x.dtype = numpy.dtype(data_x.dtype, metadata={'units': 's'})
+            data_x = _timestamp(payload[4])
 
             conf = payload[5]
-            self.conf[title].update(conf)
-            if self._plotdata[title].recordhistory:
+            if plotdata.recordhistory:
                 self._recorder.append(title, data, data_x)
             msg = conf.get('msg','')                
             if 'sum_over' in conf and conf['sum_over']:
-                self._plotdata[title].sum_over(data, data_x, msg, op='sum')
+                plotdata.sum_over(data, data_x, msg, op='sum')
             elif 'max_over' in conf and conf['max_over']:
-                self._plotdata[title].sum_over(data, data_x, msg, op='max')                
+                plotdata.sum_over(data, data_x, msg, op='max')                
             else:
-                self._plotdata[title].append(data, data_x, msg)
+                plotdata.append(data, data_x, msg)
+        elif(cmd == 'new_data_batch'):
+            # Scalars sent together, one array for y and one for x
+            conf = payload[5]
+            for y, x, msg in zip(data, payload[4].tolist(), payload[6]):
+                data_x = _timestamp(x)
+                if plotdata.recordhistory:
+                    self._recorder.append(title, y, data_x)
+                if conf.get('sum_over'):
+                    plotdata.sum_over(y, data_x, msg or '', op='sum')
+                elif conf.get('max_over'):
+                    plotdata.sum_over(y, data_x, msg or '', op='max')
+                else:
+                    plotdata.append(y, data_x, msg or '')
+
+    def _is_requested_view(self, title, view):
+        """Returns True if the received view is the one requested for title"""
+        requested = self._views.get(title)
+        if view is None or requested is None:
+            return view is None and requested is None
+        return (view['binning'], view['roi']) == requested
 
     @property
     def hostname(self):
@@ -271,7 +368,8 @@ class DataSource(QtCore.QObject):
                 group = pds["group"]
                 pd = PlotData(self, k, group=group)
                 pd.restore_state(pds, self)
-                self._plotdata[k] = pd            
+                with self._lock:
+                    self._plotdata[k] = pd
                 self.plotdata_added.emit(self._plotdata[k])
                 self.add_item_to_group_structure(k, group)
 
@@ -284,3 +382,13 @@ class DataSource(QtCore.QObject):
             self.group_structure[group].append(title)
         else:
             self.group_structure[group] = [title]
+
+
+def _timestamp(x):
+    """Returns x as an array with a dtype marked as a time in seconds"""
+    x = numpy.asarray(x)
+    dtype = _timestamp_dtypes.get(x.dtype)
+    if dtype is None:
+        dtype = numpy.dtype(x.dtype, metadata={'units': 's'})
+        _timestamp_dtypes[x.dtype] = dtype
+    return x.view(dtype)
@@ -0,0 +1,66 @@
+# --------------------------------------------------------------------------------------
+# Copyright 2016, Benedikt J. Daurer, Filipe R.N.C. Maia, Max F. Hantke, Carl Nettelblad
+# Hummingbird is distributed under the terms of the Simplified BSD License.
+# -------------------------------------------------------------------------
+"""Decodes and stores the received broadcasts on background threads."""
+import hashlib
+import logging
+import queue
+import threading
+
+# Tells a worker to stop
+_STOP = object()
+
+
+class BroadcastDecoder(object):
+    """Hands the broadcasts received on the data socket to worker threads.
+
+    The broadcasts with the same key always go to the same worker, so
+    the data of each title is handled in the order it was received.
+    A broadcast is dropped when its worker has ``depth`` broadcasts
+    waiting already, rather than holding up the other titles.
+
+    Args:
+        handler: Called on a worker thread with the frames of each broadcast.
+        workers (int): Number of worker threads.
+        depth (int): Maximum number of broadcasts waiting for each worker.
+    """
+    def __init__(self, handler, workers=2, depth=100):
+        self._handler = handler
+        self._queues = []
+        for i in range(max(1, int(workers))):
+            q = queue.Queue(maxsize=max(1, int(depth)))
+            t = threading.Thread(target=self._run, args=(q,))
+            # Make sure the program exits even when the thread is still decoding
+            t.daemon = True
+            t.start()
+            self._queues.append(q)
+        self.dropped = 0
+
+    def submit(self, frames):
+        """Queue the frames of a broadcast, the first one being its key"""
+        key = bytes(frames[0])
+        # Python's hash of bytes changes between runs, md5 does not
+        index = hashlib.md5(key).digest()[0] % len(self._queues)
+        try:
+            self._queues[index].put_nowait(frames)
+        except queue.Full:
+            self.dropped += 1
+            logging.debug("Decoder falling behind, dropped a broadcast (%d so far)", self.dropped)
+
+    def _run(self, q):
+        """Decode and store broadcasts until stopped"""
+        while True:
+            frames = q.get()
+            if frames is _STOP:
+                return
+            try:
+                self._handler(frames)
+            except Exception: # pylint: disable=broad-except
+                # A broken broadcast should not stop the others
+                logging.exception("Could not handle a broadcast")
+
+    def stop(self):
+        """Stop the workers once they handled the broadcasts already queued"""
+        for q in self._queues:
+            q.put(_STOP)
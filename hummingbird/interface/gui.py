@@ -5,8 +5,9 @@
 """Displays the results of the analysis to the user, using images and plots."""
 import logging
 import os
+import time
 
-from . import DataSource
+from . import DataSource, memory
 from .Qt import QtCore, QtGui
 from .recorder import H5Recorder
 from .ui import (AddBackendDialog, ImageWindow, PlotWindow, PreferencesDialog,
@@ -97,6 +98,9 @@ class GUI(QtGui.QMainWindow, Ui_mainWindow):
             settings.setValue("plotFontSize", "13")
         if not settings.contains("plotRefresh"):
             settings.setValue("plotRefresh", "1000")            
+        if not settings.contains("historyMemory"):
+            settings.setValue("historyMemory", "1024")
+        memory.manager.budget = int(settings.value("historyMemory"))*1024*1024
         self._recorder = H5Recorder(settings.value("outputPath"), 100)
 
     def _restore_data_windows(self, settings, data_sources):
@@ -219,8 +223,10 @@ class GUI(QtGui.QMainWindow, Ui_mainWindow):
             pass
             #self._replot_timer.stop()
         
+        now = time.time()
+        period = self._replot_timer.interval()/1000.
         for p in self._data_windows:
-            p.replot()
+            p.replot_if_needed(now, period)
         self.plotdata_widget.update()
         
         if self._replot_timer is not None:
@@ -241,6 +247,9 @@ class GUI(QtGui.QMainWindow, Ui_mainWindow):
             plot_refresh = diag.plotRefresh.value()
             self.settings.setValue("plotRefresh", plot_refresh)
             self._replot_timer.setInterval(plot_refresh)              
+            history_memory = diag.historyMemory.value()
+            self.settings.setValue("historyMemory", history_memory)
+            memory.manager.budget = history_memory*1024*1024
 
     def _recorder_toggled(self, turn_on):
         """Start/Stop the recorder"""
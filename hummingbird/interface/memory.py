@@ -0,0 +1,169 @@
+# --------------------------------------------------------------------------------------
+# Copyright 2016, Benedikt J. Daurer, Filipe R.N.C. Maia, Max F. Hantke, Carl Nettelblad
+# Hummingbird is distributed under the terms of the Simplified BSD License.
+# -------------------------------------------------------------------------
+"""Shares a memory budget between the histories of the array broadcasts.
+
+Each displayed title gets an equal share of the budget. A history which
+does not fit in its share keeps as many of its newest frames in memory
+as fit, and the older ones in a memory-mapped temporary file, so the
+full history can still be scrolled through. When the budget runs out the
+histories of the titles which are not displayed are dropped, least
+recently used first.
+"""
+import logging
+import numbers
+import tempfile
+import threading
+import time
+
+import numpy
+
+
+class MemoryManager(object):
+    """Keeps track of the memory taken by the histories of the PlotData
+
+    Args:
+        budget (int): Number of bytes the histories can take in memory.
+    """
+    def __init__(self, budget=1024*1024*1024):
+        self.budget = budget
+        # The buffers in memory by PlotData
+        self._buffers = {}
+        # PlotData release their buffer while they are evicted
+        self._lock = threading.RLock()
+
+    def allocate(self, plotdata, shape, dtype):
+        """Returns an empty history buffer for plotdata, replacing its
+        previous one. If the buffer does not fit in the share of plotdata
+        it is a :class:`History`, or a memory-mapped file if not even
+        one frame fits."""
+        dtype = numpy.dtype(dtype)
+        nbytes = int(numpy.prod(shape))*dtype.itemsize
+        if nbytes == 0:
+            return numpy.empty(shape, dtype)
+        frame_nbytes = nbytes // shape[0]
+        with self._lock:
+            self._buffers.pop(plotdata, None)
+            frames = min(shape[0], self._share(plotdata) // frame_nbytes)
+            if frames > 0:
+                self._evict(frames*frame_nbytes)
+                frames = min(frames, (self.budget - self.used) // frame_nbytes)
+            if frames == shape[0]:
+                self._buffers[plotdata] = nbytes
+                return numpy.empty(shape, dtype)
+            if frames > 0:
+                self._buffers[plotdata] = frames*frame_nbytes
+                logging.debug("Keeping all but the newest %d frames of %s on disk", frames, plotdata.title)
+                return History(shape, dtype, frames)
+        logging.debug("Keeping the history of %s on disk", plotdata.title)
+        return spill(shape, dtype)
+
+    def release(self, plotdata):
+        """The history of plotdata is no longer used"""
+        with self._lock:
+            self._buffers.pop(plotdata, None)
+
+    @property
+    def used(self):
+        """Returns the number of bytes taken by the histories in memory"""
+        return sum(self._buffers.values())
+
+    def _share(self, plotdata):
+        """Returns the number of bytes plotdata can take"""
+        displayed = set([pd for pd in self._buffers if pd.displayed])
+        displayed.add(plotdata)
+        return self.budget // len(displayed)
+
+    def _evict(self, nbytes):
+        """Drop the histories of titles not displayed, least recently
+        used first, until there is room for nbytes more"""
+        candidates = [pd for pd in self._buffers if not pd.displayed]
+        candidates.sort(key=lambda pd: pd.last_used)
+        for pd in candidates:
+            if self.used + nbytes <= self.budget:
+                return
+            if pd.evict():
+                logging.info("Dropped the history of %s, last displayed %d s ago",
+                             pd.title, time.time() - pd.last_used)
+                self._buffers.pop(pd, None)
+
+
+class History(object):
+    """A buffer of frames, like an array of the given shape, which keeps
+    the frames written last in memory and the older ones on disk.
+
+    Only whole frames can be written. Reading is safe while another
+    thread writes, apart from the frames being written.
+
+    Args:
+        shape (tuple): Number of frames followed by the shape of a frame.
+        dtype: Type of the values.
+        frames (int): Number of frames kept in memory.
+    """
+    def __init__(self, shape, dtype, frames):
+        self.shape = tuple(shape)
+        self.dtype = numpy.dtype(dtype)
+        self._disk = spill(self.shape, self.dtype)
+        self._memory = numpy.empty((frames,)+self.shape[1:], self.dtype)
+        # The slot in memory of each frame, and the frame in each slot
+        self._slot = numpy.full(self.shape[0], -1, dtype=int)
+        self._frame = numpy.full(frames, -1, dtype=int)
+        self._writes = 0
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def nbytes(self):
+        """Returns the number of bytes of the frames"""
+        return self._disk.nbytes
+
+    def __setitem__(self, index, value):
+        """Write frame number index"""
+        slot = self._slot[index]
+        if slot < 0:
+            # Take the slot of the oldest frame in memory
+            slot = self._writes % len(self._memory)
+            self._writes += 1
+            old = self._frame[slot]
+            if old >= 0:
+                # Readers find it on disk before the slot is reused
+                self._disk[old] = self._memory[slot]
+                self._slot[old] = -1
+            self._frame[slot] = index
+            self._slot[index] = slot
+        self._memory[slot] = value
+
+    def __getitem__(self, index):
+        """Returns a copy of a frame, or of a slice of frames"""
+        if isinstance(index, numbers.Integral):
+            slot = self._slot[index]
+            if slot >= 0:
+                value = self._memory[slot].copy()
+                if self._frame[slot] == index % len(self):
+                    return value
+            return numpy.array(self._disk[index])
+        frames = numpy.arange(len(self))[index]
+        values = numpy.array(self._disk[index])
+        slots = self._slot[frames]
+        in_memory = slots >= 0
+        values[in_memory] = self._memory[slots[in_memory]]
+        # Frames moved to disk while copying
+        moved = numpy.flatnonzero(in_memory)
+        moved = moved[self._frame[slots[moved]] != frames[moved]]
+        values[moved] = self._disk[frames[moved]]
+        return values
+
+
+def spill(shape, dtype):
+    """Returns an empty array in a memory-mapped temporary file,
+    which is deleted when the array is no longer used"""
+    if 0 in shape:
+        # Empty files cannot be mapped
+        return numpy.empty(shape, dtype)
+    return numpy.memmap(tempfile.TemporaryFile(prefix='hummingbird-'),
+                        dtype=dtype, mode='w+', shape=tuple(shape))
+
+
+manager = MemoryManager()
@@ -3,11 +3,13 @@
 # Hummingbird is distributed under the terms of the Simplified BSD License.
 # -------------------------------------------------------------------------
 """Stores the data associated with a given broadcast"""
+import time
+
 import numpy
 
-from .ringbuffer import RingBuffer, RingBufferStr
+from . import memory
+from .ringbuffer import RingBuffer, RingBufferStr, RingBufferView
 from .Qt import QtCore
-import copy
 
 class PlotData(object):
     """Stores the data associated with a given broadcast"""
@@ -24,6 +26,12 @@ class PlotData(object):
         self.ishistory = (title[:7] == 'History')
         self.recordhistory = False
         self.clear_histogram = False
+        # When the data was last displayed
+        self.last_used = time.time()
+        # Increases whenever the data changes
+        self._version = 0
+        # Only serializes the changes to the buffers,
+        # they can be read at any time through snapshot()
         self.mutex = QtCore.QMutex()
         if title in parent.conf:
             if('history_length' in parent.conf[title]):
@@ -34,11 +42,10 @@ class PlotData(object):
         self.mutex.lock()
         if(self._y is None):
             if(isinstance(y, numpy.ndarray)):
-                # Make sure the image ringbuffers don't take more than
-                # 200 MBs. The factor of 2 takes into account the fact
-                # that the buffer is twice as big as its usable size
-                self._maxlen = max(1, min(self._maxlen, 1024*1024*200//(2*y.nbytes)))
-            self._y = RingBuffer(self._maxlen)
+                # Arrays share the memory budget of the interface
+                self._y = RingBuffer(self._maxlen, self._allocate)
+            else:
+                self._y = RingBuffer(self._maxlen)
         if(self._x is None):
             self._x = RingBuffer(self._maxlen)
         if(self._l is None):
@@ -47,6 +54,7 @@ class PlotData(object):
         self._x.append(x)
         self._l.append(l)
         self._num = None
+        self._version += 1
         self.mutex.unlock()
 
     def sum_over(self, y, x, l, op='sum'):
@@ -55,19 +63,18 @@ class PlotData(object):
             self._y = RingBuffer(1)
             self._x = RingBuffer(1)
             self._l = RingBufferStr(1)
-            self._x.append(x)
-            self._y.append(y.astype('f8'))
-            self._l.append(l)
             self._num = 1.
-            self._y._data[0] = y
+            y = y.astype('f8')
         else:
             self._num += 1.
             if(op == 'sum'):
-                self._y._data[0] = self._y._data[0] * (self._num-1)/self._num + y/self._num
+                y = self._y[-1] * (self._num-1)/self._num + y/self._num
             elif(op == 'max'):
-                self._y._data[0] = numpy.maximum(self._y._data[0], y)
-            self._x.append(x)
-            self._l.append(l)
+                y = numpy.maximum(self._y[-1], y)
+        self._y.append(y)
+        self._x.append(x)
+        self._l.append(l)
+        self._version += 1
         self.mutex.unlock()
 
     def resize(self, new_maxlen):
@@ -80,20 +87,44 @@ class PlotData(object):
         if(self._l is not None):
             self._l.resize(new_maxlen)
         self._maxlen = new_maxlen
+        self._version += 1
         self.mutex.unlock()
 
     def clear(self):
         """Clear the buffers"""
         self.mutex.lock()
-        if(self._y is not None):
-            self._y.clear()
-            self._y = None
-        if(self._x is not None):
-            self._x.clear()
-        if(self._l is not None):
-            self._l.clear()
-        self.clear_histogram = True
+        self._clear()
+        self.mutex.unlock()
+
+    def evict(self):
+        """Clear the buffers to free memory, unless they are being changed.
+        Returns True if they were cleared."""
+        # Do not wait, whoever changes them might be waiting for us
+        if not self.mutex.tryLock():
+            return False
+        self._clear()
         self.mutex.unlock()
+        return True
+
+    def _clear(self):
+        """Clear the buffers, with the mutex locked"""
+        # New buffers are made for the next data, so that
+        # they are all numbered the same again
+        self._y = None
+        self._x = None
+        self._l = None
+        memory.manager.release(self)
+        self.clear_histogram = True
+        self._version += 1
+
+    def _allocate(self, shape, dtype):
+        """Returns an empty buffer for the y ringbuffer"""
+        return memory.manager.allocate(self, shape, dtype)
+
+    @property
+    def displayed(self):
+        """Returns True if any window is showing the data"""
+        return self._title in self._parent.subscribed_titles
 
     @property
     def title(self):
@@ -105,12 +136,38 @@ class PlotData(object):
         """Returns the plot group"""
         return self._group
 
+    @property
+    def x(self):
+        """Returns the x ringbuffer"""
+        return self._x
+
+    @property
+    def y(self):
+        """Returns the y ringbuffer"""
+        return self._y
+
+    @property
+    def l(self): # pylint: disable=invalid-name
+        """Returns the l ringbuffer"""
+        return self._l
+
     def snapshot(self):
-        """Returns a copy of the x,y and l ringbuffers"""
-        self.mutex.lock()
-        ret = (copy.deepcopy(self._x), copy.deepcopy(self._y), copy.deepcopy(self._l))
-        self.mutex.unlock()
-        return ret[0], ret[1], ret[2]
+        """Returns views of the x, y and l ringbuffers, of the same length,
+        which do not change when new data arrives.
+        Taking them does not copy any data and does not lock."""
+        x, y, l = self._x, self._y, self._l
+        if x is None or y is None or l is None:
+            return None, None, None
+        self.last_used = time.time()
+        # The data is appended to y, then x, then l
+        views = [l.snapshot(), x.snapshot(), y.snapshot()]
+        RingBufferView.align(views)
+        return views[1], views[2], views[0]
+
+    @property
+    def version(self):
+        """Returns a number which increases whenever the data changes"""
+        return self._version
 
     @property
     def maxlen(self):
@@ -129,7 +186,7 @@ class PlotData(object):
         """Returns the number of bytes taken by the three buffers"""
         self.mutex.lock()
         if(self._y is not None):
-            ret = self._y.nbytes + self._x.nbytes + self._y.nbytes
+            ret = self._y.nbytes + self._x.nbytes + self._l.nbytes
         else:
             ret = 0
         self.mutex.unlock()
@@ -157,10 +214,11 @@ class PlotData(object):
         self.parent = parent
         if 'x' in state:
             self._x = RingBuffer.restore_state(state['x'])
-            self._y = RingBuffer.restore_state(state['y'])
+            self._y = RingBuffer.restore_state(state['y'], self._allocate)
             self._l = RingBufferStr.restore_state(state['l'])
             self.restored = True
         self._title = state['title']
         self._maxlen = state['maxlen']
         self.recordhistory = state['recordhistory']
+        self._version += 1
         self.mutex.unlock()
@@ -4,41 +4,82 @@
 # -------------------------------------------------------------------------
 from __future__ import print_function  # Compatibility with python 2 and 3
 
-import re
-import sys
+import logging
+import os
+import threading
 import time
 
 import h5py
+import numpy
 
 
 class H5Recorder:
     """Recording event variables to an HDF5 file.
 
+    Each variable is stored in a group with the name of the variable,
+    holding the timestamps in the dataset ``x`` and the values, which
+    can be scalars, vectors or images, in the dataset ``y``.
+    The appended values are kept in memory and written in batches by a
+    background thread every ``flushInterval`` seconds. When the file
+    gets larger than ``maxFileSizeMB`` a new one is started.
+
     .. note::
         When reading from the recorder file, it might be necesssary to sort them using the timestamp before comparing different datasets.
     """
-    def __init__(self, outpath, maxFileSizeMB=1):
+    def __init__(self, outpath, maxFileSizeMB=1, flushInterval=1.):
         if outpath is None:
             outpath = '/reg/neh/home/benedikt/cxi86715/'
         self.outpath   = outpath
         self.maxMBytes = maxFileSizeMB
-        self._fileBytes = 0
-        self._indices  = {}
-        
+        self.flushInterval = flushInterval
+        self._file = None
+        # The values waiting to be written, as lists of (x, y) by variable
+        self._pending = {}
+        # The broadcasts are appended from the decoder threads, which
+        # should not wait for the file to be written
+        self._lock = threading.Lock()
+        self._file_lock = threading.RLock()
+        self._stop = None
+        self._thread = None
+
     def _timestamp(self):
         t = time.localtime()
         timestamp = str(t.tm_year) + '%02d' %t.tm_mon + '%02d' %t.tm_mday + \
-                    '_' + '%02d' %t.tm_hour + '%02d' %t.tm_min
+                    '_' + '%02d' %t.tm_hour + '%02d' %t.tm_min + '%02d' %t.tm_sec
         return timestamp
-        
+
+    def _filename(self):
+        """Returns the name of a file which does not exist yet"""
+        base = self.outpath + '/history_' + self._timestamp()
+        filename = base + '.h5'
+        n = 1
+        while os.path.exists(filename):
+            filename = base + '_%d.h5' % n
+            n += 1
+        return filename
+
     def openfile(self):
         """Open new file using a unique filename."""
+        with self._file_lock:
+            if not self._openfile():
+                return False
+        with self._lock:
+            # Values appended since the last file was closed do not belong in it
+            self._pending = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(self._stop,))
+        # Make sure the program exits even when the thread is still running
+        self._thread.daemon = True
+        self._thread.start()
+        return True
+
+    def _openfile(self):
         if self.outpath is None:
             print("No outputpath specified")
             return False
-        filename = self.outpath + '/history_' + self._timestamp() + '.h5'
+        filename = self._filename()
         try:
-            self._file = h5py.File(filename, 'a')
+            self._file = h5py.File(filename, 'w-')
         except IOError:
             print("Could not open file: ", filename)
             return False
@@ -46,24 +87,80 @@ class H5Recorder:
         return True
 
     def closefile(self):
-        """Close existing file."""
+        """Write the values still waiting and close existing file."""
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        with self._file_lock:
+            self._flush()
+            self._closefile()
+
+    def _closefile(self):
+        if self._file is None:
+            return
         print("Closed file: ", self._file.filename)
-        time.sleep(1)
         self._file.close()
+        self._file = None
 
     def append(self, title, data, data_x):
         """Append a tuple of time and event variable to dataset with the name of the variable."""
         key = title.split('(')[-1].split(')')[0].split('/')[-1]
-        #print(key, re.sub(r'[^\w]', ' ', key))
-        if key not in self._file.keys():
-            self._file.create_dataset(key, (2, 1000), maxshape=(2, None), dtype=type(data_x))
-            self._indices[key] = 0
-        self._file[key][:,self._indices[key]] = [data_x, data]
-        self._indices[key] += 1
-        if self._indices[key] == self._file[key].shape[1]:
-            self._file[key].resize((2, self._file[key].shape[1]+1000))
-        self._fileBytes += (sys.getsizeof(data) + sys.getsizeof(data_x))
-        if int(self._fileBytes > (2*1024*1024*self.maxMBytes)):
-            self.closefile()
-            self._fileBytes = 0
-            self.openfile()
+        with self._lock:
+            self._pending.setdefault(key, []).append((data_x, data))
+
+    def flush(self):
+        """Write the values appended so far to the file."""
+        with self._file_lock:
+            self._flush()
+
+    def _run(self, stop):
+        """Write the appended values every flushInterval seconds until stopped"""
+        while not stop.wait(self.flushInterval):
+            try:
+                self.flush()
+            except Exception: # pylint: disable=broad-except
+                # Keep recording the values which can be written
+                logging.exception("Could not write to the recorder file")
+
+    def _flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if self._file is None:
+            return
+        for key, values in pending.items():
+            x = numpy.array([v[0] for v in values], dtype=numpy.float64)
+            try:
+                y = numpy.array([v[1] for v in values])
+            except ValueError:
+                logging.warning("Not recording %s, the shape of its values changed", key)
+                continue
+            if y.dtype.kind not in 'biuf':
+                logging.warning("Not recording %s, values of type %s are not supported", key, y.dtype)
+                continue
+            try:
+                self._write(key, x, y)
+            except (TypeError, ValueError):
+                logging.warning("Not recording %s, the values do not fit in %s/y", key, key)
+        self._file.flush()
+        if os.path.getsize(self._file.filename) > 1024*1024*self.maxMBytes:
+            self._closefile()
+            self._openfile()
+
+    def _write(self, key, x, y):
+        """Add the timestamps x and values y to the datasets of key"""
+        if key not in self._file:
+            group = self._file.create_group(key)
+            for name, values in (('x', x), ('y', y)):
+                # Chunks of about 1000 scalars, or of single images
+                chunks = (max(1, min(1000, 1024*1024//max(1, values[0].nbytes))),)+values.shape[1:]
+                group.create_dataset(name, shape=(0,)+values.shape[1:], maxshape=(None,)+values.shape[1:],
+                                     dtype=values.dtype, chunks=chunks,
+                                     compression='gzip', compression_opts=1, shuffle=True)
+        group = self._file[key]
+        if y.shape[1:] != group['y'].shape[1:]:
+            raise ValueError('The shape of %s changed' % key)
+        n = group['x'].shape[0]
+        for name, values in (('x', x), ('y', y)):
+            group[name].resize(n+len(values), axis=0)
+            group[name][n:] = values
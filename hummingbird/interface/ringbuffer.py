@@ -2,239 +2,337 @@
 # Copyright 2016, Benedikt J. Daurer, Filipe R.N.C. Maia, Max F. Hantke, Carl Nettelblad
 # Hummingbird is distributed under the terms of the Simplified BSD License.
 # -------------------------------------------------------------------------
-"""Provides a ring buffer for scalar and numpy data.
-It's always possible to retrieve the buffer data as a numpy array in O(1)
-This is achieve by always inserting two copies of any appended data, so
-it's a bit slower to add data, and it takes twice as much memory as a
-regular buffer.
+"""Provides ring buffers for scalar, numpy and string data.
+
+Every appended value is written once, value number n going to position
+n % maxlen of the buffer. The buffers are written by the data thread and
+read by the GUI thread through snapshots, which are taken in O(1) without
+any locking. A snapshot only copies the values when they are read, and
+drops the oldest values if they got overwritten in the meantime.
 """
+import copy
+import numbers
 
 import numpy
 
 
 class RingBuffer(object):
     """Provides a ring buffer for scalar and numpy data.
-    It's always possible to retrieve the buffer data as a numpy array in O(1)
-    This is achieve by always inserting two copies of any appended data, so
-    it's a bit slower to add data, and it takes twice as much memory as a
-    regular buffer.
+
+    Only one thread may append to the buffer. Any other thread can read
+    it through :meth:`snapshot`. The buffer for arrays is returned by
+    allocate(shape, dtype), numpy.empty by default.
     """
-    def __init__(self, maxlen, data = None, index = 0, length = 0):
-        self._index = index
-        self._len = length
+    def __init__(self, maxlen, allocate=None):
         self._maxlen = maxlen
-        self._data = data
-        self._counter = 0
-        
+        self._allocate = allocate or numpy.empty
+        # The buffer, the number of the oldest value in it and the number
+        # of values appended so far. They are replaced together, so that
+        # readers always see a consistent state.
+        self._state = (None, 0, 0)
+        # The number of the value which is being, or was last, written
+        self._writing = -1
+
     def append(self, x):
         """Append a value to the end of the buffer"""
-        if(self._data is None):
-            self._init_data(x)
+        data, first, counter = self._state
+        if(data is None):
+            data = self._init_data(x)
+            self._state = (data, counter, counter)
+        self._writing = counter
         try:
-            self._data[self._index] = x
+            data[counter % self._maxlen] = x
         except ValueError:
-            self._init_data(x)
-            self._index = 0
-            self._len = 0
-            self._data[self._index] = x
-
-        self._data[self._index + self._maxlen] = x
-        self._index = (self._index + 1) % self._maxlen
-        if(self._len < self._maxlen):
-            self._len += 1
-        self._counter += 1
+            # The shape of the values changed, start again
+            data = self._init_data(x)
+            first = counter
+            self._state = (data, first, counter)
+            data[counter % self._maxlen] = x
+        self._state = (data, first, counter+1)
 
     def resize(self, new_maxlen):
         """Change the capacity of the buffers"""
-        tmp_data = self._data
-        x = self[-1]
-        # Initialize new array
-        prev_maxlen = self._maxlen
+        data, first, counter = self._state
         self._maxlen = new_maxlen
-        self._init_data(x)
-        # Copy existing data
-        self._len = min(self._len,new_maxlen)
-        self._data[0:self._len] = tmp_data[prev_maxlen+self._index-self._len:prev_maxlen+self._index]
-        self._data[self._maxlen:self._maxlen+self._len] = tmp_data[prev_maxlen+self._index-self._len:prev_maxlen+self._index]
-        self._index = self._len % self._maxlen
-        # Preserve dtype, otherwise dtype.metadata is lost
-        self._data.dtype = tmp_data.dtype
+        if data is not None:
+            values = RingBufferView(self).copy()[-new_maxlen:]
+            first = counter - len(values)
+            # Make the buffer like an array of the values rather than
+            # like one value, which would lose the metadata of the dtype
+            data = self._init_data(data[0:1].reshape(data.shape[1:])
+                                   if not isinstance(data, list) else None)
+            self._fill(data, values, first)
+            self._state = (data, first, counter)
 
     def _init_data(self, x):
-        """Initialize the buffer with the given data"""
+        """Returns an empty buffer for values like x"""
         try:
-            self._data = numpy.empty(tuple([2*self._maxlen]+list(x.shape)),
-                                     x.dtype)
+            return self._allocate(tuple([self._maxlen]+list(x.shape)), x.dtype)
         except AttributeError:
-            self._data = numpy.empty([2*self._maxlen], type(x))
+            return numpy.empty([self._maxlen], type(x))
+
+    def _fill(self, data, values, first):
+        """Put values, numbered from first, in their place in data"""
+        for n, value in enumerate(values):
+            data[(first+n) % self._maxlen] = value
 
-    def __array__(self):
+    def snapshot(self, end=None):
+        """Returns a :class:`RingBufferView` of the values in the buffer,
+        up to value number end, which does not change when values
+        are appended"""
+        return RingBufferView(self, end)
+
+    def __array__(self, dtype=None, copy=None):
         """Return a numpy array with the buffer data"""
-        return self._data[self._maxlen+self._index-self._len:self._maxlen+self._index]
+        return self.snapshot().__array__(dtype)
 
     def __len__(self):
         """Return the length of the buffer"""
-        return self._len
+        data, first, counter = self._state
+        return min(counter - first, self._maxlen)
 
     def clear(self):
         """Empty the buffer"""
-        self._len = 0
-        self._index = 0
+        data, first, counter = self._state
+        self._state = (data, counter, counter)
 
     @property
     def shape(self):
         """Returns the shape of the buffer, like a numpy array"""
-        if(len(self._data.shape) == 1):
-            return (self._len,)
-        else:
-            return (self._len,)+self._data.shape[1:]
+        return self.snapshot().shape
 
     @property
     def max(self):
         """Returns the maximum value in the buffer, like a numpy array"""
-        return self.__array__().max()
+        return self.snapshot().max
 
     @property
     def min(self):
         """Returns the minimum value in the buffer, like a numpy array"""
-        return self.__array__().min()
-    
-    def _convert_dim(self, args):
-        """Convert getitem arguments into internal indexes"""
-        if(isinstance(args, slice)):
-            start = self._maxlen+self._index-self._len
-            if(args.start is None):
-                if(args.step is not None and args.step < 0):
-                    start = self._maxlen+self._index-1
-            elif(args.start > 0):
-                start += args.start
-            elif(args.start < 0):
-                start += args.start + self._len
-
-            stop = self._maxlen+self._index
-            if(args.stop is None):
-                if(args.step is not None and args.step < 0):
-                    stop = self._maxlen+self._index-self._len-1
-            elif(args.stop > 0):
-                stop += args.stop-self._len
-            elif(args.stop < 0):
-                stop += args.stop
-            return slice(start, stop, args.step)
-        else:
-            if args < 0:
-                args = self._len + args
-            return self._maxlen+self._index-self._len + args
+        return self.snapshot().min
 
     def __getitem__(self, args):
         """Returns items from the buffer, just like a numpy array"""
-        if(isinstance(args, tuple)):
-            args = list(args)
-            args[0] = self._convert_dim(args[0])
-            return self._data[tuple(args)]
-        else:
-            return self._data[self._convert_dim(args)]
-        
+        return self.snapshot()[args]
+
     @property
     def nbytes(self):
         """Returns the number of bytes taken by the buffer"""
-        return self._data.nbytes
+        data = self._state[0]
+        return 0 if data is None else data.nbytes
 
     def save_state(self):
         """Return a serialized representation of the RingBuffer for saving to disk"""
         rs = {}
-        rs['index'] = self._index
-        rs['len'] = self._len
+        rs['data'] = self.snapshot().copy()
+        rs['len'] = len(rs['data'])
+        rs['index'] = rs['len'] % self._maxlen
         rs['maxlen'] = self._maxlen
-        rs['data'] = self._data
         return rs
-        
+
+    @classmethod
+    def restore_state(cls, state, allocate=None):
+        """Returns a buffer with the values saved by save_state"""
+        values = cls._saved_values(state)
+        rb = cls(state['maxlen'], allocate)
+        if len(values):
+            data = rb._init_data(values[0])
+            rb._fill(data, values, 0)
+            rb._state = (data, 0, len(values))
+            rb._writing = len(values) - 1
+        return rb
+
     @staticmethod
-    def restore_state(state):
+    def _saved_values(state):
+        """Returns the values of a saved state, oldest first"""
         data = numpy.array(state['data'])
-        index = state['index']
-        length = state['len']
-        maxlen = state['maxlen']
-        rb = RingBuffer(maxlen, data = data, index = index, length = length)
-        return rb
+        maxlen, index, length = state['maxlen'], state['index'], state['len']
+        if len(data) == 2*maxlen:
+            # Saved by the old buffers, which kept two copies of each value
+            return data[maxlen+index-length:maxlen+index]
+        return data[:length]
 
     @property
     def number_of_added_elements(self):
-        return self._counter
+        return self._state[2]
 
-        
-class RingBufferStr(object):
-    """Provides a ring buffer for strings."""
-    def __init__(self, maxlen, data = None, index = 0, length = 0):
-        self._index = index
-        self._len = length
-        self._maxlen = maxlen
-        self._data = data
-        self._counter = 0
-        
-    def append(self, x):
-        """Append a value to the end of the buffer"""
-        if(self._data is None):
-            self._init_data()
-        self._data[self._index] = x
-        self._index = (self._index + 1) % self._maxlen
-        if(self._len < self._maxlen):
-            self._len += 1
-        self._counter = 0
 
-    def resize(self, new_maxlen):
-        """Change the capacity of the buffers"""
-        tmp_data = self._data
-        # Initialize new list
-        prev_maxlen = self._maxlen
-        self._maxlen = new_maxlen
-        self._init_data()
-        # Copy existing data
-        self._len = min(self._len,new_maxlen)
-        self._data[:self._len] = tmp_data
-        self._index = self._len % self._maxlen
-
-    def _init_data(self):
-        """Initialize the buffer with the given data"""
-        self._data = [None for i in range(self._maxlen)]
-        
-    def __len__(self):
-        """Return the length of the buffer"""
-        return self._len
+class RingBufferStr(RingBuffer):
+    """Provides a ring buffer for strings."""
+    def _init_data(self, x=None):
+        """Returns an empty buffer"""
+        return [None for i in range(self._maxlen)]
 
-    def clear(self):
-        """Empty the buffer"""
-        self._len = 0
-        self._index = 0
-
-    def __getitem__(self, index):
-        """Returns items from the buffer"""
-        if index == (self._len - 1):
-            index = self._index - 1
-        return self._data[index]
-    
     @property
     def nbytes(self):
         """Returns the number of bytes taken by the buffer"""
-        return self._data.nbytes
+        data = self._state[0]
+        return 0 if data is None else sum([len(s) for s in data if s is not None])
 
-    def save_state(self):
-        """Return a serialized representation of the buffer for saving to disk"""
-        rs = {}
-        rs['index'] = self._index
-        rs['len'] = self._len
-        rs['maxlen'] = self._maxlen
-        rs['data'] = self._data
-        return rs
-        
     @staticmethod
-    def restore_state(state):
-        data = state['data']
-        index = state['index']
-        length = state['len']
-        maxlen = state['maxlen']
-        rb = RingBufferStr(maxlen, data = data, index = index, length = length)
-        return rb
-        
+    def _saved_values(state):
+        """Returns the values of a saved state, oldest first"""
+        data = list(state['data'])
+        maxlen, index, length = state['maxlen'], state['index'], state['len']
+        # The old buffers saved all maxlen positions, with the next one at index
+        return [data[(index-length+k) % maxlen] for k in range(length)]
+
+
+class RingBufferView(object):
+    """The values of a ring buffer at the time it was taken.
+
+    The values are copied from the buffer the first time they are read.
+    Values which the buffer overwrote before then are left out, so a view
+    can get shorter when it is read. Reading single values or slices does
+    not copy the rest of the values. Histories kept in a memory-mapped file
+    are read in place when possible, as a read-only array which shows the
+    newer values once they overwrite the ones read.
+    """
+    def __init__(self, ring, end=None):
+        self._ring = ring
+        self._data, first, counter = ring._state
+        if end is not None:
+            counter = min(counter, end)
+        self._end = counter
+        if self._data is None:
+            self._start = counter
+        else:
+            self._start = max(first, counter - len(self._data))
+        self._values = None
+        self._group = [self]
+
+    @staticmethod
+    def align(views):
+        """Make the views cover the same values, and copy them
+        together, such that they stay the same length"""
+        end = min([v._end for v in views])
+        start = min(max([v._start for v in views]), end)
+        for v in views:
+            v._end = end
+            v._start = start
+            v._group = views
+
+    def _read(self):
+        """Copy the values of all the views of the group from their buffers"""
+        if self._values is not None:
+            return
+        start = self._start
+        for v in self._group:
+            v._values = v._copy()
+            if v._data is not None:
+                # The values written while copying might be broken
+                start = max(start, v._ring._writing - len(v._data) + 1)
+        for v in self._group:
+            v._values = v._values[start-v._start:]
+            v._start = start
+
+    def _copy(self):
+        """Returns the values, oldest first"""
+        length = max(self._end - self._start, 0)
+        data = self._data
+        if data is None:
+            return []
+        first = self._start % len(data)
+        count = min(length, len(data)-first)
+        if isinstance(data, list):
+            return data[first:first+count] + data[:length-count]
+        if isinstance(data, numpy.memmap) and count == length:
+            # Do not bring histories kept on disk into memory,
+            # the values are read in place
+            values = data[first:first+count]
+            values.flags.writeable = False
+            return values
+        values = numpy.empty((length,)+data.shape[1:], dtype=data.dtype)
+        values[:count] = data[first:first+count]
+        values[count:] = data[:length-count]
+        return values
+
+    def copy(self):
+        """Returns the values, oldest first, as an array (or a list for strings)"""
+        self._read()
+        return self._values
+
+    def __array__(self, dtype=None, copy=None):
+        """Return a numpy array with the values"""
+        return numpy.asarray(self.copy(), dtype=dtype)
+
+    def __len__(self):
+        """Return the number of values"""
+        if self._values is not None:
+            return len(self._values)
+        return max(self._end - self._start, 0)
+
+    @property
+    def shape(self):
+        """Returns the shape of the values, like a numpy array"""
+        if self._data is None or isinstance(self._data, list):
+            return (len(self),)
+        return (len(self),)+self._data.shape[1:]
+
+    @property
+    def ndim(self):
+        """Returns the number of dimensions of the values, like a numpy array"""
+        return len(self.shape)
+
+    @property
+    def max(self):
+        """Returns the maximum value, like a numpy array"""
+        return self.__array__().max()
+
+    @property
+    def min(self):
+        """Returns the minimum value, like a numpy array"""
+        return self.__array__().min()
+
+    @property
+    def nbytes(self):
+        """Returns the number of bytes of the values"""
+        return self.__array__().nbytes
+
+    @property
+    def ring(self):
+        """Returns the ring buffer the view was taken from"""
+        return self._ring
+
+    @property
+    def version(self):
+        """Returns the number of values added to the buffer up to this view"""
+        return self._end
+
     @property
     def number_of_added_elements(self):
-        return self._counter
+        return self._end
+
+    def __getitem__(self, args):
+        """Returns items, just like a numpy array"""
+        index = args[0] if isinstance(args, tuple) else args
+        if self._values is None and isinstance(index, numbers.Integral):
+            # Read single values directly from the buffer
+            length = len(self)
+            if index < 0:
+                index += length
+            if index < 0 or index >= length:
+                raise IndexError('index %d is out of bounds for size %d' % (index, length))
+            number = self._start + index
+            value = self._data[number % len(self._data)]
+            if isinstance(args, tuple):
+                value = value[args[1:]]
+            if isinstance(value, numpy.ndarray):
+                value = value.copy()
+            if self._ring._writing < number + len(self._data):
+                return value
+            # The value got overwritten, maybe while copying it,
+            # so leave it out like when reading all the values
+        if self._values is None and isinstance(index, slice) and index.step in (None, 1):
+            # Only copy the values asked for
+            start, stop, _ = index.indices(len(self))
+            view = copy.copy(self)
+            view._start = self._start + start
+            view._end = self._start + max(start, stop)
+            view._group = [view]
+            values = view.copy()
+            if isinstance(args, tuple):
+                return values[(slice(None),)+args[1:]]
+            return values
+        self._read()
+        return self._values[args]
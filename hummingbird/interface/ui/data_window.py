@@ -4,6 +4,7 @@
 # -------------------------------------------------------------------------
 """Base class for all the data display windows"""
 import logging
+import time
 
 from ..Qt import QtCore, QtGui
 
@@ -11,6 +12,11 @@ from ..Qt import QtCore, QtGui
 class DataWindow(QtGui.QMainWindow):
     """Base class for all the data display windows
     (e.g. PlotWindow, ImageWindow)"""
+    # How many plot refresh periods to wait between replots,
+    # when the window is visible and when it is not
+    refresh_periods = 1
+    hidden_refresh_periods = 10
+
     def __init__(self, parent=None):
         QtGui.QMainWindow.__init__(self, None)
         self.setAttribute(QtCore.Qt.WA_DeleteOnClose)
@@ -25,6 +31,9 @@ class DataWindow(QtGui.QMainWindow):
         self.restored = False
         self.alertBlinking = False
         self.set_sounds_and_volume()
+        # The versions of the data at the last scheduled replot, and when it was
+        self._replotted_versions = None
+        self._replotted_time = 0
 
     # This is to fix a resizing bug on Mac
     def resizeEvent(self, event):
@@ -184,6 +193,32 @@ class DataWindow(QtGui.QMainWindow):
         self._parent.data_windows.remove(self)
         event.accept()
 
+    def data_versions(self):
+        """Returns the versions of the data shown, which change whenever the data does"""
+        versions = []
+        for source, title in self.source_and_titles():
+            pd = source.plotdata.get(title)
+            versions.append((source, title, id(pd), None if pd is None else pd.version))
+        return versions
+
+    def replot_if_needed(self, now, period):
+        """Replot if the data changed, no sooner than refresh_periods periods
+        after the last time. The window the user is working with is
+        always replotted, so that it follows their changes."""
+        if self.isVisible() and not self.isMinimized():
+            periods = self.refresh_periods
+        else:
+            periods = self.hidden_refresh_periods
+        # Allow for the timer firing a bit early
+        if now - self._replotted_time < (periods - 0.5)*period:
+            return
+        versions = self.data_versions()
+        if versions == self._replotted_versions and not self.isActiveWindow():
+            return
+        self._replotted_versions = versions
+        self._replotted_time = now
+        self.replot()
+
     def source_and_titles(self):
         """Iterate through all available broadcasts"""
         for source in self._enabled_sources.keys():
@@ -16,6 +16,7 @@ import numpy
 import pyqtgraph
 
 from ..Qt import QtCore, QtGui, loadUiType
+from ..ringbuffer import RingBufferView
 from . import uidir
 
 Ui_Form, base = loadUiType(uidir + '/image_view.ui')
@@ -54,6 +55,12 @@ class ImageView(QtGui.QWidget):
         self._parent = parent
         self.levelMax = 4096
         self.levelMin = 0
+        self.autoLevelMin = 0
+        self.autoLevelMax = 4096
+        # The frame shown, converted for the image item,
+        # and the index and shape of the images it came from
+        self._frame = None
+        self._shown = None
         self.name = name
         self.image = None
         self.axes = {}
@@ -120,7 +127,7 @@ class ImageView(QtGui.QWidget):
         if hasattr(img, 'implements') and img.implements('MetaArray'):
             img = img.asarray()
         
-        if not isinstance(img, numpy.ndarray):
+        if not isinstance(img, (numpy.ndarray, RingBufferView)):
             raise Exception("Image must be specified as ndarray.")
         self.image = img
         
@@ -159,8 +166,10 @@ class ImageView(QtGui.QWidget):
             self.axes[x] = self.axes.get(x, None)
             
         self.imageDisp = None
+        self._shown = None
         
-        self.currentIndex = 0
+        # Start with the newest image
+        self.currentIndex = img.shape[0]-1 if self.axes['t'] is not None else 0
         self.updateImage(autoHistogramRange=autoHistogramRange)
         if levels is None and autoLevels:
             self.autoLevels()
@@ -191,7 +200,7 @@ class ImageView(QtGui.QWidget):
 
     def autoLevels(self):
         """Set the min/max intensity levels automatically to match the image data."""
-        self.setLevels(self.levelMin, self.levelMax)
+        self.setLevels(self.autoLevelMin, self.autoLevelMax)
 
     def setLevels(self, min, max):
         """Set the min/max (bright and dark) levels."""
@@ -203,13 +212,15 @@ class ImageView(QtGui.QWidget):
         self.view.autoRange()
         
     def getProcessedImage(self):
-        """Returns the image data after it has been processed by any normalization options in use.
-        This method also sets the attributes self.levelMin and self.levelMax 
-        to indicate the range of data in the image."""
+        """Returns the image data. This method also sets the attributes
+        self.levelMin and self.levelMax to indicate the range of data in
+        the newest image, and self.autoLevelMin and self.autoLevelMax to
+        the levels which show most of it."""
         if self.imageDisp is None:
-            image = self.normalize(self.image)
-            self.imageDisp = image
-            self.levelMin, self.levelMax = list(map(float, ImageView.quickMinMax(self.imageDisp)))
+            self.imageDisp = self.image
+            newest = () if self.axes['t'] is None else (self.image.shape[0]-1,)
+            levels = ImageView.quickLevels(self.image, newest)
+            self.levelMin, self.autoLevelMin, self.autoLevelMax, self.levelMax = levels
             
         return self.imageDisp
         
@@ -273,7 +284,17 @@ class ImageView(QtGui.QWidget):
 
     def setCurrentIndex(self, ind, autoHistogramRange=True):
         """Set the currently displayed frame index."""
-        self.currentIndex = numpy.clip(ind, 0, self.getProcessedImage().shape[0]-1)
+        image = self.getProcessedImage()
+        ind = numpy.clip(ind, 0, image.shape[0]-1)
+        if isinstance(image, RingBufferView) and ind != image.shape[0]-1:
+            # Look through the newest history, of which
+            # only the frame shown is read
+            history = image.ring.snapshot()
+            if len(history):
+                ind = max(len(history) - (image.shape[0]-ind), 0)
+                self.image = self.imageDisp = history
+                self._shown = None
+        self.currentIndex = ind
         self.updateImage(autoHistogramRange=autoHistogramRange)
 
     def jumpFrames(self, n):
@@ -294,9 +315,88 @@ class ImageView(QtGui.QWidget):
             data = data[tuple(sl)]
         return data.min(), data.max()
 
+    @staticmethod
+    def quickLevels(data, index=(), samples=1e5, percentiles=(0, 0.1, 99.9, 100)):
+        """Returns the percentiles of a subsample of data[index], leaving out NaNs.
+        Only the subsample is read from data."""
+        shape = list(data.shape[len(index):])
+        steps = [1]*len(shape)
+        while numpy.prod(shape) > samples:
+            ax = int(numpy.argmax(shape))
+            shape[ax] = (shape[ax]+1)//2
+            steps[ax] *= 2
+        sample = data[tuple(index) + tuple([slice(None, None, st) for st in steps])]
+        sample = numpy.asarray(sample).ravel()
+        if sample.dtype.kind == 'f':
+            sample = sample[numpy.isfinite(sample)]
+        if sample.size == 0:
+            return [0., 0., 1., 1.]
+        return list(map(float, numpy.percentile(sample, percentiles)))
+
+    @staticmethod
+    def trend(data, name, chunk_bytes=64*1024*1024):
+        """Returns the mean, median, std, min or max of the frames in data,
+        like numpy does along the first axis. The frames are read in chunks
+        of about chunk_bytes, so a history is never copied as a whole."""
+        frame = numpy.asarray(data[0:1])
+        length = len(data)
+        step = max(1, int(chunk_bytes // max(1, frame.nbytes)))
+        if name == 'median':
+            # Needs all the frames of a pixel at once, so take bands of rows
+            if frame.ndim == 1:
+                return numpy.median(numpy.asarray(data[:]), axis=0)
+            rows = frame.shape[1]
+            band = max(1, min(rows, (step*rows)//max(1, length)))
+            result = numpy.empty(frame.shape[1:])
+            for r in range(0, rows, band):
+                values = [numpy.asarray(data[i:i+step])[:, r:r+band] for i in range(0, length, step)]
+                result[r:r+band] = numpy.median(numpy.concatenate(values), axis=0)
+            return result
+        count, result, m2 = 0, None, None
+        for i in range(0, length, step):
+            chunk = numpy.asarray(data[i:i+step])
+            if not len(chunk):
+                break
+            if name in ('min', 'max'):
+                value = getattr(numpy, name)(chunk, axis=0)
+                result = value if result is None else getattr(numpy, name + 'imum')(result, value)
+                continue
+            # Combine the means and the squared deviations of the chunks
+            mean = chunk.mean(axis=0)
+            deviations = ((chunk - mean)**2).sum(axis=0)
+            if result is None:
+                result, m2 = mean, deviations
+            else:
+                delta = mean - result
+                total = count + len(chunk)
+                result = result + delta*len(chunk)/total
+                m2 = m2 + deviations + delta**2*count*len(chunk)/total
+            count += len(chunk)
+        if name == 'std':
+            return numpy.sqrt(m2/count)
+        return result
+
     def normalize(self, image):
-        image[numpy.isnan(image)] = 0
-        return image
+        """Returns the image as shown by the image item. 2D images are
+        copied to a buffer which is reused, in float32 for floats, with
+        NaNs replaced by 0."""
+        image = numpy.asarray(image)
+        if image.ndim != 2:
+            image = image.copy()
+            image[numpy.isnan(image)] = 0
+            return image
+        dtype = numpy.float32 if image.dtype.kind == 'f' else image.dtype
+        if self._frame is None or self._frame.shape != image.shape or self._frame.dtype != dtype:
+            # The image item shows the transpose of the image,
+            # which it does not need to copy when the buffer is in Fortran order
+            self._frame = numpy.empty(image.shape, dtype=dtype, order='F')
+        # Copying bands of rows keeps the transposition within the cache
+        for i in range(0, image.shape[0], 64):
+            numpy.copyto(self._frame[i:i+64], image[i:i+64], casting='unsafe')
+        if dtype == numpy.float32:
+            # NaNs would make the image item draw the slow way
+            numpy.copyto(self._frame, 0, where=numpy.isnan(self._frame))
+        return self._frame
 
 
     def updateImage(self, autoHistogramRange=True):
@@ -308,10 +408,14 @@ class ImageView(QtGui.QWidget):
 
         if autoHistogramRange:
             self.ui.histogram.setHistogramRange(self.levelMin, self.levelMax)
+        if self._shown == (self.currentIndex, image.shape):
+            # Already showing this image
+            return
+        self._shown = (self.currentIndex, image.shape)
         if self.axes['t'] is None:
-            self.imageItem.updateImage(image)
+            self.imageItem.updateImage(self.normalize(image))
         else:
-            self.imageItem.updateImage(image[self.currentIndex])
+            self.imageItem.updateImage(self.normalize(image[self.currentIndex]))
 
     def getView(self):
         """Return the ViewBox (or other compatible object) which displays the ImageItem"""
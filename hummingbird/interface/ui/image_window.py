@@ -16,9 +16,24 @@ from ..Qt import QtCore, QtGui
 from . import DataWindow, Ui_imageWindow
 
 
+def _log_lookup_table(n=256):
+    """Returns a grayscale lookup table with a logarithmic scale.
+    It has one entry for each 8 bit level of the images, so the
+    image item can show them directly as indexed images."""
+    grad = numpy.log(numpy.linspace(1, 1e5, n))
+    lut = numpy.empty((n, 4), dtype=numpy.ubyte)
+    lut[:, :3] = (255 * grad / grad.max())[:, numpy.newaxis]
+    lut[:, 3] = 255
+    return lut
+
+_LOG_LUT = _log_lookup_table()
+
+
 class ImageWindow(DataWindow, Ui_imageWindow):
     """Window to display images"""
     acceptable_data_types = ['image', 'vector', 'triple', 'running_hist']
+    # Images take longer to draw than lines
+    refresh_periods = 2
 
     def __init__(self, parent=None):
         # This also sets up the UI part
@@ -32,7 +47,8 @@ class ImageWindow(DataWindow, Ui_imageWindow):
         self.meanmap = None
         self.last_x = None
         self.last_y = None
-        self.mm_last = None
+        # The number of triples added to the mean map
+        self.mm_added = None
         self.vline = None
         self.hline = None
 
@@ -90,6 +106,7 @@ class ImageWindow(DataWindow, Ui_imageWindow):
         self._circular_rois = []
         
         self.actionReset_cache.triggered.connect(self.on_reset_cache)
+        self.actionDownsample.triggered.connect(self.update_views)
 
         self.updateFonts()
 
@@ -141,8 +158,17 @@ class ImageWindow(DataWindow, Ui_imageWindow):
         xmin = conf.get('xmin', 0)
         ymin = conf.get('ymin', 0)
 
-        xmax = img.shape[-1] + xmin
-        ymax = img.shape[-2] + ymin
+        # Binned or cropped images are shown in the pixels of the full images
+        view = conf.get('view')
+        shape = view['shape'] if view else img.shape
+        view_transform = QtGui.QTransform()
+        if view:
+            view_transform.scale(view['binning'], view['binning'])
+            if view['roi'] is not None:
+                view_transform *= QtGui.QTransform().translate(view['roi'][0], view['roi'][2])
+
+        xmax = shape[-1] + xmin
+        ymax = shape[-2] + ymin
         if "xmax" in conf:
             if(conf['xmax'] <= xmin):
                 logging.warning("xmax <= xmin for title %s on %s. Ignoring xmax", title, source.name())
@@ -159,8 +185,8 @@ class ImageWindow(DataWindow, Ui_imageWindow):
 
         # The order of dimensions in the scale call is (y,x) as in the numpy
         # array the last dimension corresponds to the x.
-        scale_transform = QtGui.QTransform().scale((ymax-ymin)/img.shape[-2],
-                                                   (xmax-xmin)/img.shape[-1])
+        scale_transform = QtGui.QTransform().scale((ymax-ymin)/shape[-2],
+                                                   (xmax-xmin)/shape[-1])
         
         #rotate_transform = QtGui.QTransform()
         #if source.data_type[title] == 'image':
@@ -179,7 +205,7 @@ class ImageWindow(DataWindow, Ui_imageWindow):
                                                     1, 0, 0,
                                                     0, 0, 1)
             
-        transform = scale_transform * translate_transform * transpose_transform
+        transform = view_transform * scale_transform * translate_transform * transpose_transform
         #transform = scale_transform * translate_transform * rotate_transform * transpose_transform
         
         # print('|%f %f %f|' % (transform.m11(), transform.m12(), transform.m13()))
@@ -235,11 +261,7 @@ class ImageWindow(DataWindow, Ui_imageWindow):
                 self.plot.getView().setLabel(axis_labels[ylabel_index], self.settingsWidget.ui.y_label.text()) #pylint: disable=no-member
 
     def _set_logscale_lookuptable(self):
-        N = 255
-        self.lut = numpy.empty((N,4), dtype=numpy.ubyte)
-        grad = numpy.log(numpy.linspace(1, 1e5, N))
-        self.lut[:,:3] = (255 * grad / grad.max()).reshape(N,1)
-        self.lut[:, 3] = 255
+        self.lut = _LOG_LUT
         
     def _set_logscale(self, source, title):
         conf = source.conf[title]
@@ -265,8 +287,8 @@ class ImageWindow(DataWindow, Ui_imageWindow):
         self.mm_ymax = ymax
         self.mm_xbins = xbins
         self.mm_ybins = ybins
-        self.mm_dx = numpy.float(self.mm_xmax - self.mm_xmin)/self.mm_xbins
-        self.mm_dy = numpy.float(self.mm_ymax - self.mm_ymin)/self.mm_ybins
+        self.mm_dx = float(self.mm_xmax - self.mm_xmin)/self.mm_xbins
+        self.mm_dy = float(self.mm_ymax - self.mm_ymin)/self.mm_ybins
         self.meanmap = numpy.zeros((3, self.mm_ybins, self.mm_xbins), dtype=numpy.float64)
         self._update_meanmap_transform()
 
@@ -314,50 +336,41 @@ class ImageWindow(DataWindow, Ui_imageWindow):
             self.mm_ybins = ybins
             self._update_meanmap_transform()
         
-    def _fill_meanmap(self, times, triples, xmin=0, xmax=100, ymin=0, ymax=100, xbins=100, ybins=100, dynamic_extent=False, initial_reset=False):
-
-        triples_new = triples
-        if self.meanmap is not None:
-            w = numpy.where(self.mm_last==times)
-            if len(w) > 0:
-                if w[0] > 0:
-                    triples_new = triples[:w[0],:]
-        x = triples_new[:,0]
-        y = triples_new[:,1]
-        z = triples_new[:,2]
-
-        self.last_x = x[-1]
-        self.last_y = y[-1] 
-        
+    def _fill_meanmap(self, triples, xmin=0, xmax=100, ymin=0, ymax=100, xbins=100, ybins=100, dynamic_extent=False, initial_reset=False):
+        """Add the triples appended to the ring buffer since the last call to the mean map"""
+        added = triples.number_of_added_elements
+        if self.mm_added is None or added < self.mm_added:
+            # The first time, or the buffers were cleared
+            number_of_new = len(triples)
+        else:
+            number_of_new = min(added - self.mm_added, len(triples))
+        first_fill = self.mm_added is None
+        self.mm_added = added
+
         if self.meanmap is None:
             self._init_meanmap(xmin, xmax, ymin, ymax, xbins, ybins)
 
-        if self.mm_last is None and initial_reset:
-            self._reset_meanmap_cache()
-            
-        self.mm_last = times[0]
-            
-        if dynamic_extent:
-            self._extend_meanmap(triples_new[:,0], triples_new[:,1])                    
+        if number_of_new > 0:
+            triples_new = numpy.asarray(triples[len(triples)-number_of_new:])
+            x = triples_new[:,0]
+            y = triples_new[:,1]
+            z = triples_new[:,2]
+            self.last_x = x[-1]
+            self.last_y = y[-1]
 
-        for x,y,z in triples_new:
-            
-            ix = numpy.round((x - (self.mm_xmin+self.mm_dx/2.))/self.mm_dx).astype(int)
-            iy = numpy.round((y - (self.mm_ymin+self.mm_dy/2.))/self.mm_dy).astype(int)
-            
-            if (ix < 0):                    
-                ix = 0
-            elif (ix >= self.mm_xbins):
-                ix = self.mm_xbins - 1
-            if (iy < 0):
-                iy = 0
-            elif (iy >= self.mm_ybins):
-                iy = self.mm_ybins - 1
-
-            self.meanmap[0,iy,ix] += z
-            self.meanmap[1,iy,ix] += 1
+            if first_fill and initial_reset:
+                self._reset_meanmap_cache()
+
+            if dynamic_extent:
+                self._extend_meanmap(x, y)
+
+            ix = numpy.round((x - (self.mm_xmin+self.mm_dx/2.))/self.mm_dx).astype(int).clip(0, int(self.mm_xbins) - 1)
+            iy = numpy.round((y - (self.mm_ymin+self.mm_dy/2.))/self.mm_dy).astype(int).clip(0, int(self.mm_ybins) - 1)
+            numpy.add.at(self.meanmap[0], (iy, ix), z)
+            numpy.add.at(self.meanmap[1], (iy, ix), 1)
             self.meanmap[2,iy,ix] = self.meanmap[0,iy,ix]/self.meanmap[1,iy,ix]
 
+        x, y = self.last_x, self.last_y
         if (self.settingsWidget.ui.show_heatmap.isChecked()):
             return self.meanmap[0], self.meanmap_transform, x, y
         elif (self.settingsWidget.ui.show_visitedmap.isChecked()):
@@ -409,8 +422,32 @@ class ImageWindow(DataWindow, Ui_imageWindow):
         self.settingsWidget.ui.runningHistMax.setText(str(conf["hmax"]))
         self.running_hist_initialised = True
 
+    def update_views(self):
+        """Ask the sources for images binned down to the size of the window,
+        if downsampling is enabled, otherwise for the full images"""
+        for source, title in self.source_and_titles():
+            if source.data_type is None or source.data_type.get(title) != 'image':
+                continue
+            binning = 1
+            view = source.conf[title].get('view')
+            if self.actionDownsample.isChecked():
+                if view:
+                    shape = view['shape']
+                elif title in source.plotdata and source.plotdata[title]._y is not None:
+                    shape = source.plotdata[title]._y.shape[1:]
+                else:
+                    continue
+                size = self.plot.getView().getViewBox().size()
+                if size.width() < 2 or size.height() < 2:
+                    # Not shown yet
+                    continue
+                # Never bin below one image pixel per screen pixel
+                binning = int(min(shape[-2]/size.height(), shape[-1]/size.width()))
+            source.set_view(title, binning)
+
     def replot(self):
         """Replot data"""
+        self.update_views()
         for source, title in self.source_and_titles():
             if(title not in source.plotdata):
                 continue
@@ -464,7 +501,8 @@ class ImageWindow(DataWindow, Ui_imageWindow):
                 hmax   = img.shape[1]
                 length = pd.maxlen
             else:
-                img = numpy.asarray(pd_y)
+                # The image view only copies the images it shows
+                img = pd_y
             self._configure_axis(source, title)
             transform = self._image_transform(img, source, title)
             
@@ -485,9 +523,7 @@ class ImageWindow(DataWindow, Ui_imageWindow):
                     auto_rage = True
                     auto_histogram = True
                 if "data_type" in conf and conf["data_type"] == "triple":
-                    triples = numpy.asarray(pd.y)
-                    times   = numpy.asarray(pd.x)
-                    img, transform, x, y = self._fill_meanmap(times, triples,
+                    img, transform, x, y = self._fill_meanmap(pd_y,
                                                               xmin=conf["xmin"], xmax=conf["xmax"], ymin=conf["ymin"], ymax=conf["ymax"],
                                                               ybins=conf["ybins"], xbins=conf["xbins"],
                                                               dynamic_extent=conf.get("dynamic_extent", False),
@@ -496,12 +532,11 @@ class ImageWindow(DataWindow, Ui_imageWindow):
                 else:
                     x, y = (0,0)
                 if (self.settingsWidget.ui.show_trend.isChecked()):
-                    _trend = getattr(numpy, str(self.settingsWidget.ui.trend_options.currentText()))
-                    img = _trend(img, axis=0)
+                    img = self.plot.trend(img, str(self.settingsWidget.ui.trend_options.currentText()))
 
                 if self.settingsWidget.ui.modelVisibility.value() > 0:
                     # We should overwrite part of the image with a model
-                    img = self._apply_model_to_img(img)
+                    img = self._apply_model_to_img(numpy.array(img))
 
                 if(img.ndim == 3):
                     self.plot.setImage(img,
@@ -543,8 +578,10 @@ class ImageWindow(DataWindow, Ui_imageWindow):
         
         cmin = self.settingsWidget.ui.colormap_min
         cmax = self.settingsWidget.ui.colormap_max
-        data_min = numpy.min(self.plot.image)
-        data_max = numpy.max(self.plot.image)
+        # Read in chunks, not to copy the whole history of the image view
+        data = self.plot.image
+        data_min = numpy.min(self.plot.trend(data, 'min'))
+        data_max = numpy.max(self.plot.trend(data, 'max'))
         cmin.setText(str(data_min))
         cmax.setText(str(data_max))
         self.set_colormap_range()
@@ -669,6 +706,7 @@ class ImageWindow(DataWindow, Ui_imageWindow):
         settings['histogram_view'] = self.actionHistogram.isChecked()
         settings['crosshair'] = self.actionCrosshair.isChecked()
         settings['circular_roi'] = self.actionCircularROI.isChecked()
+        settings['downsample'] = self.actionDownsample.isChecked()
         settings['gradient_mode'] = self.plot.getHistogramWidget().item.gradient.saveState()
         
         return DataWindow.get_state(self, settings)
@@ -703,6 +741,7 @@ class ImageWindow(DataWindow, Ui_imageWindow):
         self.actionCrosshair.triggered.emit(settings['crosshair'])
         self.actionCircularROI.setChecked(settings['circular_roi'])
         self.actionCircularROI.triggered.emit(settings['circular_roi'])
+        self.actionDownsample.setChecked(settings.get('downsample', False))
 
         self.plot.getHistogramWidget().item.gradient.restoreState(settings['gradient_mode'])
         
@@ -17,38 +17,70 @@ from .pg_time_axis import DateAxisItem
 
 
 class Histogram(object):
+    """Counts the values of a ring buffer in fixed bins. Only the values
+    added to the buffer since the last call are counted each time."""
     def __init__(self, hmin, hmax, bins):
-        self._bins = bins
-        self._range = (hmin, hmax)
-        self._step = (hmax-hmin) / float(bins)
+        self._set_bins(hmin, hmax, bins)
         self._histogram = numpy.zeros(self._bins)
         self._last_add_index = 0
 
-    def _value_to_index(self, value):
-        index = int((value - self._range[0]) / self._step)
-        if index < 0 or index >= self._bins:
-            return None
-        else:
-            return index
-        
+    def _set_bins(self, hmin, hmax, bins):
+        self._bins = int(bins)
+        self._range = (hmin, hmax)
+        self._step = (hmax-hmin) / float(bins)
+
+    def _values_to_indices(self, values):
+        """Returns the bins of the values within the range,
+        and which of the values those are"""
+        indices = numpy.floor((numpy.asarray(values, dtype=numpy.float64) - self._range[0]) / self._step)
+        # NaNs are never inside
+        inside = (indices >= 0) & (indices < self._bins)
+        return indices[inside].astype(numpy.intp), inside
+
+    def _count(self, values, weights=None):
+        """Returns the histogram of values, optionally weighted"""
+        indices, inside = self._values_to_indices(values)
+        if weights is not None:
+            weights = numpy.asarray(weights, dtype=numpy.float64)[inside]
+        return numpy.bincount(indices, weights=weights, minlength=self._bins)
+
     def add_value(self, value):
-        index = self._value_to_index(value)
-        if index is not None:
-            self._histogram[index] += 1
+        self.add_values([value])
 
-    def add_values_from_ringbuffer(self, ringbuffer):
+    def add_values(self, values):
+        self._histogram += self._count(values)
+
+    def _new_values(self, ringbuffer):
+        """Returns the values added to ringbuffer since the last call, or None"""
         current_index = ringbuffer.number_of_added_elements
         number_of_values_to_add = current_index-self._last_add_index
-        if number_of_values_to_add > 0:
-            values = numpy.asarray(ringbuffer)[-(current_index-self._last_add_index):]
-        else:
-            return
-        for this_value in values:
-            self.add_value(this_value)
+        if number_of_values_to_add <= 0:
+            return None
         self._last_add_index = current_index
+        # Values which were already overwritten are lost
+        number_of_values_to_add = min(number_of_values_to_add, len(ringbuffer))
+        return numpy.asarray(ringbuffer[len(ringbuffer)-number_of_values_to_add:])
+
+    def add_values_from_ringbuffer(self, ringbuffer):
+        values = self._new_values(ringbuffer)
+        if values is not None:
+            self.add_values(values)
+
+    def rebin(self, hmin, hmax, bins):
+        """Change the bins, without counting the values again. The counts of
+        each old bin go to the new bin containing its centre, which is exact
+        when the new bins are made of whole old bins."""
+        if (hmin, hmax) == self._range and int(bins) == self._bins:
+            return
+        centres = self.values_x
+        self._set_bins(hmin, hmax, bins)
+        self._rebinned(centres)
+
+    def _rebinned(self, centres):
+        """Move the counts of the old bins, with the given centres, to the current bins"""
+        self._histogram = self._count(centres, self._histogram)
 
     def reset(self):
-        print("Reset histogram!")
         self._histogram[:] = 0
         self._last_add_index = 0
 
@@ -61,27 +93,27 @@ class Histogram(object):
         return self._histogram
 
 class NormalizedHistogram(Histogram):
+    """Averages the weights of the values of a ring buffer in fixed bins.
+    The ring buffer holds (value, weight) pairs."""
     def __init__(self, hmin, hmax, bins):
         super(NormalizedHistogram, self).__init__(hmin, hmax, bins)
         self._weight = numpy.zeros(self._histogram.shape)
 
     def add_value(self, value, weight):
-        index = self._value_to_index(value)
-        if index is not None:
-            self._histogram[index] += weight
-            self._weight[index] += 1.
+        self.add_values([value], [weight])
+
+    def add_values(self, values, weights):
+        self._histogram += self._count(values, weights)
+        self._weight += self._count(values)
 
     def add_values_from_ringbuffer(self, ringbuffer):
-        current_index = ringbuffer.number_of_added_elements
-        number_of_values_to_add = (current_index-self._last_add_index)
-        if number_of_values_to_add > 0:
-            values = numpy.asarray(ringbuffer)[-number_of_values_to_add:, 0]
-            weights = numpy.asarray(ringbuffer)[-number_of_values_to_add:, 1]
-        else:
-            return
-        for this_value, this_weight in zip(values, weights):
-            self.add_value(this_value, this_weight)
-        self._last_add_index = current_index
+        values = self._new_values(ringbuffer)
+        if values is not None:
+            self.add_values(values[:, 0], values[:, 1])
+
+    def _rebinned(self, centres):
+        super(NormalizedHistogram, self)._rebinned(centres)
+        self._weight = self._count(centres, self._weight)
 
     def reset(self):
         super(NormalizedHistogram, self).reset()
@@ -93,6 +125,171 @@ class NormalizedHistogram(Histogram):
         return_hist[self._weight > 0.] /= self._weight[self._weight > 0.]
         return return_hist
             
+def _bucket_size(length, points):
+    """Returns the smallest power of two such that length values
+    make at most points buckets"""
+    size = 1
+    while length > size*points:
+        size *= 2
+    return size
+
+def _group_extremes(low, high, offset, size):
+    """Split the values into groups of size, the first group missing its
+    first offset values. Returns the positions of the minimum of low and
+    of the maximum of high in each group."""
+    length = len(low)
+    groups = -(-(offset + length) // size)
+    pad = (offset, groups*size - offset - length)
+    low = numpy.pad(numpy.asarray(low, dtype=numpy.float64), pad, constant_values=numpy.inf)
+    high = numpy.pad(numpy.asarray(high, dtype=numpy.float64), pad, constant_values=-numpy.inf)
+    start = numpy.arange(groups)*size - offset
+    # The padding can only win when the values are infinite
+    imin = (start + low.reshape(groups, size).argmin(axis=1)).clip(0, length-1)
+    imax = (start + high.reshape(groups, size).argmax(axis=1)).clip(0, length-1)
+    return imin, imax
+
+def _ordered(imin, imax):
+    """Returns the positions of the minimum and maximum of each group,
+    in the order of the values"""
+    index = numpy.stack([numpy.minimum(imin, imax), numpy.maximum(imin, imax)], axis=1)
+    return index.ravel()
+
+def decimate(x, y, points):
+    """Returns the values with the minimum and the maximum of y in each of
+    at most points groups of consecutive values, which look the same
+    when drawn on points pixels"""
+    size = _bucket_size(len(y), points)
+    if size == 1:
+        return x, y
+    index = _ordered(*_group_extremes(y, y, 0, size))
+    return x[index], y[index]
+
+class Envelope(object):
+    """Keeps the minimum and maximum of the values of a ring buffer in
+    buckets of consecutive values, like decimate(). Only the values added
+    to the buffer since the last call are looked at, unless the buckets
+    need to get smaller. It also keeps track of whether x is sorted."""
+    def __init__(self):
+        self._ring = None
+        self._reset(1, 0)
+
+    def _reset(self, size, end):
+        self._size = size
+        # The number of values looked at so far
+        self._end = end
+        # The bucket number of the first bucket
+        self._first = end // size
+        # The numbers of the values with the minimum and the maximum
+        # of each bucket, and their x and y
+        self._n = numpy.zeros((0, 2), dtype=numpy.int64)
+        self._x = None
+        self._y = None
+        # The number of the last value which was smaller than the one before
+        self._unsorted = -1
+        self._start = end
+
+    @property
+    def monotonic(self):
+        """Returns True if the x in the buffer are sorted"""
+        return self._unsorted < self._start
+
+    def update(self, x, y, points):
+        """Add the values of the snapshots x and y of the ring buffers which
+        were added since the last call, with buckets for drawing on points pixels"""
+        end = y.number_of_added_elements
+        start = end - len(y)
+        size = _bucket_size(len(y), points)
+        if y.ring is not self._ring or end < self._end or size < self._size:
+            # New buffers, or smaller buckets
+            self._ring = y.ring
+            self._reset(size, start)
+        elif size > self._size:
+            self._merge(size)
+        self._start = start
+        self._drop(x, y, start)
+        new = max(self._end, start)
+        if new < end:
+            first = len(y) - (end - new)
+            self._add(numpy.asarray(x[first:]), numpy.asarray(y[first:]), new)
+        self._end = end
+
+    def _add(self, x, y, first):
+        """Add the values x and y, numbered from first"""
+        if self._x is None:
+            # Keep the dtype of x, whose metadata tells if x is a time
+            self._dtype = x.dtype
+            self._x = numpy.zeros((0, 2), dtype=x.dtype)
+            self._y = numpy.zeros((0, 2), dtype=y.dtype)
+            self._last_x = x[0]
+        if x[0] < self._last_x:
+            self._unsorted = first
+        descending = numpy.flatnonzero(numpy.diff(x) < 0)
+        if len(descending):
+            self._unsorted = first + descending[-1] + 1
+        self._last_x = x[-1]
+        imin, imax = _group_extremes(y, y, first % self._size, self._size)
+        index = numpy.stack([imin, imax], axis=1)
+        n, xs, ys = index + first, x[index], y[index]
+        if len(self._n) and self._first + len(self._n) - 1 == first // self._size:
+            # The first values go in the last bucket
+            n[0], xs[0], ys[0] = self._combine(self._n[-1], self._x[-1], self._y[-1], n[0], xs[0], ys[0])
+            self._n, self._x, self._y = self._n[:-1], self._x[:-1], self._y[:-1]
+        elif not len(self._n):
+            self._first = first // self._size
+        self._n = numpy.concatenate([self._n, n])
+        self._x = numpy.concatenate([self._x, xs])
+        self._y = numpy.concatenate([self._y, ys])
+
+    @staticmethod
+    def _combine(n0, x0, y0, n1, x1, y1):
+        """Returns the extremes of two buckets"""
+        n, x, y = n0.copy(), x0.copy(), y0.copy()
+        if y1[0] < y0[0]:
+            n[0], x[0], y[0] = n1[0], x1[0], y1[0]
+        if y1[1] > y0[1]:
+            n[1], x[1], y[1] = n1[1], x1[1], y1[1]
+        return n, x, y
+
+    def _merge(self, size):
+        """Make the buckets larger, without looking at the values again"""
+        factor = size // self._size
+        if len(self._n):
+            imin, imax = _group_extremes(self._y[:, 0], self._y[:, 1], self._first % factor, factor)
+            self._n = numpy.stack([self._n[imin, 0], self._n[imax, 1]], axis=1)
+            self._x = numpy.stack([self._x[imin, 0], self._x[imax, 1]], axis=1)
+            self._y = numpy.stack([self._y[imin, 0], self._y[imax, 1]], axis=1)
+        self._first //= factor
+        self._size = size
+
+    def _drop(self, x, y, start):
+        """Drop the values before start, which are no longer in the buffer"""
+        drop = min(max(start // self._size - self._first, 0), len(self._n))
+        if drop:
+            self._n, self._x, self._y = self._n[drop:], self._x[drop:], self._y[drop:]
+            self._first += drop
+        count = min((self._first+1)*self._size, self._end) - start
+        if len(self._n) and count <= 0:
+            # None of the values of the first bucket are left
+            self._n, self._x, self._y = self._n[1:], self._x[1:], self._y[1:]
+            self._first += 1
+        elif len(self._n) and self._n[0].min() < start:
+            # Look again at what is left of the first bucket
+            first_x, first_y = numpy.asarray(x[:count]), numpy.asarray(y[:count])
+            imin, imax = first_y.argmin(), first_y.argmax()
+            self._n[0] = [start + imin, start + imax]
+            self._x[0] = [first_x[imin], first_x[imax]]
+            self._y[0] = [first_y[imin], first_y[imax]]
+
+    def points(self):
+        """Returns the x and y of the minimum and the maximum of each bucket,
+        in the order of the values"""
+        if self._x is None:
+            return numpy.zeros(0), numpy.zeros(0)
+        swap = self._n[:, 0] > self._n[:, 1]
+        x, y = self._x.copy(), self._y.copy()
+        x[swap], y[swap] = x[swap, ::-1], y[swap, ::-1]
+        return x.ravel().view(self._dtype), y.ravel()
+
 class PlotWindow(DataWindow, Ui_plotWindow):
     """Window to display 2D plots"""
     acceptable_data_types = ['scalar', 'vector', 'tuple', 'triple', 'running_hist', 'histogram' , 'normalized_histogram']
@@ -122,6 +319,7 @@ class PlotWindow(DataWindow, Ui_plotWindow):
         self._settings_diag = LinePlotSettings(self)
         self._histograms = {}
         self._normalized_histograms = {}
+        self._envelopes = {}
         self.updateFonts()
 
         self.plot.scene().sigMouseMoved.connect(self._onMouseMoved)
@@ -320,7 +518,8 @@ class PlotWindow(DataWindow, Ui_plotWindow):
                 symbol_size = 3
             pd_x,pd_y,pd_l = pd.snapshot()
             if(source.data_type[title] == 'scalar') or (source.data_type[title] == 'running_hist'):
-                y = numpy.asarray(pd_y)
+                # Only read when the envelope is not enough
+                y = None
                 self.last_vector_y = {}
                 self.last_vector_x = None
             elif(source.data_type[title] == 'tuple'):
@@ -364,25 +563,40 @@ class PlotWindow(DataWindow, Ui_plotWindow):
             elif source.data_type[title] == 'histogram':
                 if title not in self._histograms:
                     self._histograms[title] = Histogram(conf["hmin"], conf["hmax"], conf["bins"])
+                self._histograms[title].rebin(conf["hmin"], conf["hmax"], conf["bins"])
                 x = self._histograms[title].values_x
                 y = self._histograms[title].values_y
             elif source.data_type[title] == 'normalized_histogram':
                 if title not in self._normalized_histograms:
                     self._normalized_histograms[title] = NormalizedHistogram(conf["hmin"], conf["hmax"],
                                                                     conf["bins"])
+                self._normalized_histograms[title].rebin(conf["hmin"], conf["hmax"], conf["bins"])
                 x = self._normalized_histograms[title].values_x
                 y = self._normalized_histograms[title].values_y
                 
             x = None
             if(source.data_type[title] == 'scalar') or (source.data_type[title] == 'running_hist'):
-                x = numpy.asarray(pd_x)
-                sorted_x = numpy.argsort(x)
-                x = x[sorted_x]
-                y = y[sorted_x]
-                if self._settings_diag.showTrendScalar.isChecked():
-                    wl = int(self._settings_diag.windowLength.text())
-                    y = utils.array.runningMean(y, min(y.size-1,wl))
-                    x = x[-y.size:]
+                # Draw about two points per pixel
+                points = max(self.plot.width(), 1)
+                envelope = self._envelopes.setdefault(title, Envelope())
+                envelope.update(pd_x, pd_y, points)
+                trend = self._settings_diag.showTrendScalar.isChecked()
+                histogram = self._settings_diag.histogram.isChecked()
+                if envelope.monotonic and not trend and not histogram:
+                    x, y = envelope.points()
+                else:
+                    x = numpy.asarray(pd_x)
+                    y = numpy.asarray(pd_y)
+                    if not envelope.monotonic:
+                        sorted_x = numpy.argsort(x)
+                        x = x[sorted_x]
+                        y = y[sorted_x]
+                    if trend:
+                        wl = int(self._settings_diag.windowLength.text())
+                        y = utils.array.runningMean(y, min(y.size-1,wl))
+                        x = x[-y.size:]
+                    if not histogram:
+                        x, y = decimate(x, y, points)
             elif(source.data_type[title] == 'tuple') or (source.data_type[title] == 'triple'):
                 x = pd_y[:,0]
             elif(source.data_type[title] == 'vector'):
@@ -428,10 +642,9 @@ class PlotWindow(DataWindow, Ui_plotWindow):
             elif(source.data_type[title] == "normalized_histogram"):
                 ringbuffer = pd_y
                 # Clear histogram if asked for
-                print("clear_histograms = {0}".format(pd.clear_histograms))
-                if pd.clear_histograms:
-                    self._histograms[title].reset()
-                    pd.clear_histograms = False
+                if pd.clear_histogram:
+                    self._normalized_histograms[title].reset()
+                    pd.clear_histogram = False
                 self._normalized_histograms[title].add_values_from_ringbuffer(ringbuffer)
                 x = self._normalized_histograms[title].values_x
                 y = self._normalized_histograms[title].values_y
@@ -16,3 +16,4 @@ class PreferencesDialog(QtGui.QDialog, Ui_preferences):
         self.outputPath.setText(settings.value("outputPath"))
         self.fontSize.setValue(int(settings.value("plotFontSize")))
         self.plotRefresh.setValue(int(settings.value("plotRefresh")))
+        self.historyMemory.setValue(int(settings.value("historyMemory")))
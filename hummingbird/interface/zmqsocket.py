@@ -6,10 +6,13 @@
 Provides a wrapper for a ZeroMQ socket. Adapted from PyZeroMQt.
 """
 import hashlib
+import json
 
 import numpy
 from zmq import EVENTS, FD, IDENTITY, POLLIN, RCVHWM, SUBSCRIBE, UNSUBSCRIBE
 
+from hummingbird.ipc import compression, framing
+
 from .Qt import QtCore
 from .zmqcontext import ZmqContext
 
@@ -23,6 +26,9 @@ class ZmqSocket(QtCore.QObject):
         QtCore.QObject.__init__(self, parent, **kwargs)
         self._type = _type
         self._socket = None
+        # Set to framing.KEY_PREFIX, or framing.BATCH_KEY_PREFIX
+        # to receive batches as well, to receive binary broadcasts
+        self.key_prefix = b''
         QtCore.QCoreApplication.instance().aboutToQuit.connect(self.close)
 
     def init_socket(self):
@@ -59,14 +65,14 @@ class ZmqSocket(QtCore.QObject):
         # scramble the filter to avoid spurious matches (like CCD matching CCD1)        
         m = hashlib.md5()
         m.update(title.encode('UTF-8'))
-        self._socket.setsockopt(SUBSCRIBE, m.digest())
+        self._socket.setsockopt(SUBSCRIBE, self.key_prefix + m.digest())
         self.filters.append(title)
 
     def unsubscribe(self, title):
         """Unsubscribe to a broadcast with the given title"""
         m = hashlib.md5()
         m.update(title.encode('UTF-8'))
-        self._socket.setsockopt(UNSUBSCRIBE, m.digest())
+        self._socket.setsockopt(UNSUBSCRIBE, self.key_prefix + m.digest())
         self.filters.remove(title)
 
     def bind(self, addr):
@@ -123,4 +129,34 @@ class ZmqSocket(QtCore.QObject):
         """Receive a numpy array"""
         md = self._socket.recv_json(flags=flags)
         msg = self._socket.recv(flags=flags, copy=copy, track=track)
-        return  numpy.ndarray(shape=md['shape'], dtype=md['dtype'], buffer=msg, strides=md['strides'])
+        return _decode_array(md, msg)
+
+    def recv_frames(self, flags=0):
+        """Receive the frames of a broadcast, without decoding them"""
+        return self._socket.recv_multipart(flags=flags, copy=False)
+
+    def recv_broadcast(self, flags=0):
+        """Receive a broadcast, in either encoding, as a list of items"""
+        return decode_broadcast(self.recv_frames(flags))
+
+
+def _decode_array(md, buf):
+    """Returns the array described by the metadata md from buf"""
+    if 'wire_dtype' in md:
+        # Compressed or downcast by the backend
+        return compression.decode(buf, md)
+    return  numpy.ndarray(shape=md['shape'], dtype=md['dtype'], buffer=buf, strides=md['strides'])
+
+def decode_broadcast(frames):
+    """Returns the items of a broadcast received as frames, in either encoding.
+    The arrays share the memory of the frames."""
+    if framing.is_key(bytes(frames[0])):
+        return framing.decode(frames[1:])
+    data = json.loads(bytes(frames[1]).decode('UTF-8'))
+    next_frame = 2
+    for i in range(len(data)):
+        if data[i] == '__ndarray__':
+            md = json.loads(bytes(frames[next_frame]).decode('UTF-8'))
+            data[i] = _decode_array(md, frames[next_frame+1].buffer)
+            next_frame += 2
+    return data
@@ -8,14 +8,30 @@ from __future__ import (absolute_import,  # Compatibility with python 2 and 3
 
 import hashlib
 import logging
+import time
+
 import numpy
 
+from hummingbird.backend.record import Record
+
 from . import mpi as ipc_mpi
+from .ratelimit import RateLimiter
 
 
 evt = None
 data_conf = {}
-sent_time = {}
+# Limits the titles with a send_rate
+rate_limiter = RateLimiter()
+
+# The slaves keep the data in an outbox and send it to the master at
+# most every outbox_interval seconds, or once outbox_size items are waiting.
+# Only the newest image or vector of a title is kept, while scalars
+# are sent together as arrays. Set outbox_interval to 0 to send right away.
+outbox_interval = 0.1
+outbox_size = 100
+_outbox = {}
+_outbox_count = 0
+_outbox_time = 0.
 
 
 def init_data(title, **kwds):
@@ -56,46 +72,115 @@ def new_data(title, data_y, mpi_reduce=False, **kwds):
     """Send a new data item, which will be appended to any existing
     values at the interface. If mpi_reduce is True data_y will be
     summed over all the slaves. All keywords pairs given will also be
-    transmitted and available at the interface."""
+    transmitted and available at the interface.
+
+    data_y can also be a function, or a Record, which is only evaluated
+    if the data is actually sent, e.g. when an interface is subscribed
+    to title. The data_type of title needs to be set with init_data for
+    this to save anything."""
     from .zmqserver import ipc_uuid, get_zmq_server as ipc_zmq
     from . import influx as ipc_influx
 
-    global sent_time
+    if 'data_type' not in data_conf.get(title, {}):
+        data_y = _evaluate(data_y)
     _check_type(title, data_y)
     event_id = evt.event_id()
 
-    # If send_rate is given limit the send rate to it
+    # If send_rate is given limit the send rate to it.
+    # No worker alone may exceed it, and the master keeps the budget
+    # shared by all the workers, so that it goes to the ones with data.
     if 'send_rate' in kwds and kwds['send_rate'] is not None:
-        send_rate = float(kwds['send_rate']) / ipc_mpi.nr_workers()
-        cur_time = event_id
-        if title in sent_time:
-            send_probability = (cur_time-sent_time[title])*send_rate
-        else:
-            send_probability = 1
-        sent_time[title] = cur_time
-        if numpy.random.random() > send_probability:
+        if not rate_limiter.allow(title, float(kwds['send_rate'])):
             # do not send the data
             return
 
     if(ipc_mpi.is_slave()):
         if(mpi_reduce):
+            # All the slaves need to take part in the reduction
+            data_y = _evaluate(data_y)
             ipc_mpi.send_reduce(title, 'new_data', data_y, event_id, **kwds)
         else:
             m = hashlib.md5()
             m.update(title.encode('UTF-8'))
             if m.digest() in ipc_mpi.subscribed:
-                ipc_mpi.send(title, [ipc_uuid, 'new_data', title, data_y,
-                                     event_id, kwds])
+                data_y = _evaluate(data_y)
+                _post(title, data_y, event_id, kwds)
             else:
                 logging.debug('%s not subscribed, not sending' % (title))
-    else:
+    elif not _is_lazy(data_y) or ipc_zmq().is_subscribed(title):
+        data_y = _evaluate(data_y)
         ipc_zmq().send(title, [ipc_uuid, 'new_data', title, data_y,
                                event_id, kwds])
         logging.debug("Sending data on source '%s'" % title)
-    if data_conf[title]["data_type"] == "scalar":
-        ipc_influx.write(title, data_y, event_id, kwds)
+    if data_conf[title]["data_type"] == "scalar" and ipc_influx.client is not None:
+        ipc_influx.write(title, _evaluate(data_y), event_id, kwds)
+
+def _is_lazy(data_y):
+    """Returns True if data_y still needs to be evaluated"""
+    return callable(data_y) or isinstance(data_y, Record)
+
+def _evaluate(data_y):
+    """Returns the value of lazy data"""
+    if isinstance(data_y, Record):
+        return data_y.data
+    if callable(data_y):
+        return data_y()
+    return data_y
         
 
+def _post(title, data_y, event_id, kwds):
+    """Put a data item in the outbox"""
+    global _outbox_count
+    if outbox_interval <= 0:
+        _send(title, [data_y], [event_id], [kwds])
+        return
+    if title not in _outbox:
+        _outbox[title] = ([], [], [])
+    ys, xs, ks = _outbox[title]
+    if(data_conf[title]["data_type"] != "scalar" and
+       not kwds.get('sum_over') and not kwds.get('max_over')):
+        # Only the newest one will be displayed anyway
+        del ys[:], xs[:], ks[:]
+    else:
+        _outbox_count += 1
+    if isinstance(data_y, numpy.ndarray):
+        # The analysis might reuse the array before it is sent
+        data_y = data_y.copy()
+    ys.append(data_y)
+    xs.append(event_id)
+    ks.append(kwds)
+    flush_outbox()
+
+def flush_outbox(force=False):
+    """Send the data in the outbox to the master,
+    if it is time to do so or if force is True."""
+    global _outbox_count, _outbox_time
+    now = time.time()
+    if not _outbox:
+        _outbox_time = now
+        return
+    if not force and _outbox_count < outbox_size and now - _outbox_time < outbox_interval:
+        return
+    for title in _outbox:
+        _send(title, *_outbox[title])
+    _outbox.clear()
+    _outbox_count = 0
+    _outbox_time = now
+
+def _send(title, ys, xs, ks):
+    """Send the data items of a title to the master"""
+    from .zmqserver import ipc_uuid
+    if data_conf[title]["data_type"] != "scalar" or len(ys) == 1:
+        for data_y, event_id, kwds in zip(ys, xs, ks):
+            ipc_mpi.send(title, [ipc_uuid, 'new_data', title, data_y,
+                                 event_id, kwds])
+    else:
+        # Only the messages are kept for every item, the other
+        # keywords are taken from the newest one
+        msgs = [kwds.get('msg') for kwds in ks]
+        ipc_mpi.send(title, [ipc_uuid, 'new_data_batch', title, numpy.array(ys),
+                             numpy.array(xs), ks[-1], msgs])
+
 def set_current_event(_evt):
     """Updates the current event, such that it can
     be accessed easily in analysis code"""
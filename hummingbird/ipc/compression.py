@@ -0,0 +1,194 @@
+# --------------------------------------------------------------------------------------
+# Copyright 2016, Benedikt J. Daurer, Filipe R.N.C. Maia, Max F. Hantke, Carl Nettelblad
+# Hummingbird is distributed under the terms of the Simplified BSD License.
+# -------------------------------------------------------------------------
+"""Compresses the arrays of broadcasts before they are sent to the interface.
+
+Broadcasts opt in through :func:`ipc.broadcast.init_data` keywords:
+
+    - ``compression``: 'lz4', 'zstd', 'blosc' or 'zlib'. The first three
+      need the python packages of the same name (zstandard for zstd),
+      otherwise zlib is used.
+    - ``compression_level``: Passed on to the compressor.
+    - ``downcast``: 'float16' or 'uint16' to send fewer bytes per value.
+      For 'uint16' the values are scaled to the range of the array,
+      which keeps about 4-5 significant digits, and NaN is kept.
+      Arrays which would not survive the downcast, with infinite values
+      for 'uint16' or values beyond the range of 'float16', are sent
+      unchanged.
+
+The arrays are described by a dictionary which travels with them
+and is all that is needed to decode them."""
+from __future__ import (absolute_import,  # Compatibility with python 2 and 3
+                        print_function)
+
+import logging
+import zlib
+
+import numpy
+
+_missing = set()
+_warned = set()
+# The uint16 value which stands for NaN
+_UINT16_NAN = 65535
+
+
+class Compressed(object):
+    """A compressed array ready to be sent, with its description"""
+    def __init__(self, data, md):
+        self.data = data
+        self.md = md
+
+    @property
+    def nbytes(self):
+        """Returns the number of bytes to send"""
+        return len(self.data)
+
+def compress(array, conf):
+    """Returns array compressed as a :class:`Compressed` if the configuration
+    of the broadcast asks for it, otherwise array itself"""
+    if not isinstance(array, numpy.ndarray) or not is_enabled(conf):
+        return array
+    return Compressed(*encode(array, conf))
+
+def is_enabled(conf):
+    """Returns True if the configuration of a broadcast asks
+    for compression or downcasting"""
+    return bool(conf) and bool(conf.get('compression') or conf.get('downcast'))
+
+def encode(array, conf):
+    """Compress array as asked in the broadcast configuration conf.
+    Returns the bytes to send and the dictionary describing them."""
+    md = {'shape': array.shape, 'dtype': array.dtype.str}
+    downcast = conf.get('downcast')
+    if downcast == 'float16':
+        finite = numpy.isfinite(array)
+        if finite.any() and numpy.abs(array[finite]).max() > numpy.finfo(numpy.float16).max:
+            _warn_once(downcast, "Values beyond the range of float16, not downcasting.")
+        else:
+            array = array.astype(numpy.float16)
+            md['downcast'] = downcast
+    elif downcast == 'uint16':
+        finite = numpy.isfinite(array)
+        if numpy.isinf(array).any():
+            _warn_once(downcast, "Infinite values cannot be scaled to uint16, not downcasting.")
+        else:
+            array = _to_uint16(array, finite, md)
+    elif downcast is not None:
+        raise ValueError("Unknown downcast '%s'" % downcast)
+    array = numpy.ascontiguousarray(array)
+    md['wire_dtype'] = array.dtype.str
+
+    codec = conf.get('compression')
+    if not codec:
+        return array.tobytes(), md
+    codec = _available(codec)
+    level = conf.get('compression_level')
+    if codec == 'blosc':
+        import blosc
+        # Blosc shuffles the bytes by itself
+        data = blosc.compress(array.tobytes(), typesize=array.itemsize,
+                              clevel=5 if level is None else level, shuffle=blosc.SHUFFLE)
+    else:
+        # Grouping the same bytes of every value helps the compressors a lot
+        data = _shuffle(array)
+        if codec == 'lz4':
+            import lz4.frame
+            data = lz4.frame.compress(data, compression_level=0 if level is None else level)
+        elif codec == 'zstd':
+            import zstandard
+            data = zstandard.ZstdCompressor(level=3 if level is None else level).compress(data)
+        else:
+            data = zlib.compress(data, 1 if level is None else level)
+        md['shuffle'] = True
+    md['codec'] = codec
+    return data, md
+
+def decode(buf, md):
+    """Returns the array described by md from the received buffer"""
+    codec = md.get('codec')
+    wire_dtype = numpy.dtype(md['wire_dtype'])
+    if codec is None:
+        array = numpy.frombuffer(buf, dtype=wire_dtype)
+    else:
+        if codec == 'blosc':
+            import blosc
+            data = blosc.decompress(bytes(buf))
+        elif codec == 'lz4':
+            import lz4.frame
+            data = lz4.frame.decompress(buf)
+        elif codec == 'zstd':
+            import zstandard
+            data = zstandard.ZstdDecompressor().decompress(buf)
+        elif codec == 'zlib':
+            data = zlib.decompress(buf)
+        else:
+            raise ValueError("Unknown compression '%s'" % codec)
+        if md.get('shuffle'):
+            array = _unshuffle(data, wire_dtype)
+        else:
+            array = numpy.frombuffer(data, dtype=wire_dtype)
+    array = array.reshape(md['shape'])
+    if md.get('downcast') == 'float16':
+        array = array.astype(numpy.float32)
+    elif md.get('downcast') == 'uint16':
+        nan = array == md['nan'] if 'nan' in md else None
+        array = array * numpy.float32(md['scale']) + numpy.float32(md['offset'])
+        if nan is not None:
+            array[nan] = numpy.nan
+    return array
+
+def _to_uint16(array, finite, md):
+    """Returns array scaled to uint16, with NaN stored as the largest value"""
+    if finite.any():
+        offset = float(array[finite].min())
+        scale = (float(array[finite].max()) - offset) / float(_UINT16_NAN - 1)
+    else:
+        offset, scale = 0., 0.
+    if scale == 0:
+        scale = 1.
+    if finite.all():
+        array = numpy.rint((array - offset) / scale).astype(numpy.uint16)
+    else:
+        array = numpy.where(finite, numpy.rint((array - offset) / scale), _UINT16_NAN).astype(numpy.uint16)
+        md['nan'] = _UINT16_NAN
+    md['downcast'] = 'uint16'
+    md['scale'] = scale
+    md['offset'] = offset
+    return array
+
+def _warn_once(downcast, message):
+    """Log message the first time downcast cannot be done"""
+    if downcast not in _warned:
+        logging.warning(message)
+        _warned.add(downcast)
+
+def _available(codec):
+    """Returns codec if its package can be imported, otherwise 'zlib'"""
+    if codec == 'zlib':
+        return codec
+    module = {'lz4': 'lz4.frame', 'zstd': 'zstandard', 'blosc': 'blosc'}.get(codec)
+    if module is None:
+        raise ValueError("Unknown compression '%s'" % codec)
+    try:
+        __import__(module)
+    except ImportError:
+        if codec not in _missing:
+            logging.warning("Could not import %s, using zlib compression instead of %s." % (module, codec))
+            _missing.add(codec)
+        return 'zlib'
+    return codec
+
+def _shuffle(array):
+    """Returns the bytes of the array, all first bytes of each value first,
+    then all second bytes and so on"""
+    if array.itemsize == 1:
+        return array.tobytes()
+    return array.reshape(-1).view(numpy.uint8).reshape(-1, array.itemsize).T.tobytes()
+
+def _unshuffle(data, dtype):
+    """Reverse _shuffle"""
+    if dtype.itemsize == 1:
+        return numpy.frombuffer(data, dtype=dtype)
+    shuffled = numpy.frombuffer(data, dtype=numpy.uint8).reshape(dtype.itemsize, -1)
+    return numpy.ascontiguousarray(shuffled.T).view(dtype).reshape(-1)
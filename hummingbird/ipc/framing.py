@@ -0,0 +1,161 @@
+# --------------------------------------------------------------------------------------
+# Copyright 2016, Benedikt J. Daurer, Filipe R.N.C. Maia, Max F. Hantke, Carl Nettelblad
+# Hummingbird is distributed under the terms of the Simplified BSD License.
+# -------------------------------------------------------------------------
+"""Binary encoding of the broadcasts sent by the zmq server.
+
+A broadcast is a list of items (uuid, command, title, data, timestamp,
+keywords, ...). It is encoded in one envelope frame, in which every item
+starts with a one byte type code, followed by one raw frame per array
+(or per compressed array, see :mod:`ipc.compression`).
+Compared to JSON this avoids converting numbers to text and parsing
+a separate JSON description for every array."""
+from __future__ import (absolute_import,  # Compatibility with python 2 and 3
+                        print_function)
+
+import copy
+import json
+import numbers
+import struct
+
+import numpy
+
+from . import compression
+
+# Identifies the encoding, in case it ever needs to change
+MAGIC = b'HB1'
+# Prefix of the zmq keys of binary broadcasts
+KEY_PREFIX = b'B'
+# Prefix of the zmq keys of binary broadcasts to the clients which also
+# take the batches of scalars ('new_data_batch'), the others get them one by one
+BATCH_KEY_PREFIX = b'S'
+
+_COUNT = struct.Struct('<3sB')
+_FLOAT = struct.Struct('<cd')
+_INT = struct.Struct('<cq')
+_BOOL = struct.Struct('<c?')
+_LENGTH = struct.Struct('<cI')
+_ARRAY = struct.Struct('<cBB')
+
+# Encoded JSON items, by title and position, which are reused
+# as long as the item does not change (typically the keywords)
+_json_cache = {}
+
+
+def key(digest):
+    """Returns the zmq key of binary broadcasts for the given md5 digest"""
+    return KEY_PREFIX + digest
+
+def batch_key(digest):
+    """Returns the zmq key of binary broadcasts, including batches, for the given md5 digest"""
+    return BATCH_KEY_PREFIX + digest
+
+def is_key(key_):
+    """Returns True if key_ is the zmq key of a binary broadcast"""
+    return len(key_) == 17 and key_[:1] in (KEY_PREFIX, BATCH_KEY_PREFIX)
+
+def base_key(key_):
+    """Returns the md5 digest of the title of a binary key"""
+    return key_[1:] if is_key(key_) else key_
+
+def encode(data, title=None):
+    """Encode the list data. Returns the list of frames to send,
+    the envelope followed by the arrays.
+
+    JSON items are cached per title if one is given."""
+    parts = [_COUNT.pack(MAGIC, len(data))]
+    arrays = []
+    for i, item in enumerate(data):
+        if item is None:
+            parts.append(b'n')
+        elif isinstance(item, (bool, numpy.bool_)):
+            parts.append(_BOOL.pack(b'b', item))
+        elif isinstance(item, numbers.Integral):
+            parts.append(_INT.pack(b'i', item))
+        elif isinstance(item, numbers.Real):
+            parts.append(_FLOAT.pack(b'f', item))
+        elif isinstance(item, str):
+            encoded = item.encode('UTF-8')
+            parts.append(_LENGTH.pack(b's', len(encoded)))
+            parts.append(encoded)
+        elif isinstance(item, numpy.ndarray):
+            if item.dtype.hasobject:
+                raise ValueError('Cannot broadcast arrays with dtype=object')
+            if not item.flags.c_contiguous:
+                item = item.copy()
+            dtype = item.dtype.str.encode('ascii')
+            parts.append(_ARRAY.pack(b'a', len(dtype), item.ndim))
+            parts.append(dtype)
+            parts.append(struct.pack('<%dq' % item.ndim, *item.shape))
+            arrays.append(item)
+        elif isinstance(item, compression.Compressed):
+            encoded = json.dumps(item.md).encode('UTF-8')
+            parts.append(_LENGTH.pack(b'z', len(encoded)))
+            parts.append(encoded)
+            arrays.append(item.data)
+        else:
+            encoded = _encode_json(title, i, item)
+            parts.append(_LENGTH.pack(b'j', len(encoded)))
+            parts.append(encoded)
+    return [b''.join(parts)] + arrays
+
+def _encode_json(title, index, item):
+    """JSON encode item, reusing the last encoding if it did not change"""
+    if title is None:
+        return json.dumps(item).encode('UTF-8')
+    cached = _json_cache.get((title, index))
+    if cached is not None and cached[0] == item:
+        return cached[1]
+    encoded = json.dumps(item).encode('UTF-8')
+    _json_cache[(title, index)] = (copy.deepcopy(item), encoded)
+    return encoded
+
+def decode(frames):
+    """Decode the frames of a broadcast encoded with encode.
+    The arrays share the memory of their frames."""
+    envelope = memoryview(frames[0])
+    magic, count = _COUNT.unpack_from(envelope, 0)
+    if magic != MAGIC:
+        raise ValueError('Unknown broadcast encoding %r' % magic)
+    offset = _COUNT.size
+    data = []
+    next_array = 1
+    for _ in range(count):
+        code = bytes(envelope[offset:offset+1])
+        if code == b'n':
+            data.append(None)
+            offset += 1
+        elif code == b'b':
+            data.append(_BOOL.unpack_from(envelope, offset)[1])
+            offset += _BOOL.size
+        elif code == b'i':
+            data.append(_INT.unpack_from(envelope, offset)[1])
+            offset += _INT.size
+        elif code == b'f':
+            data.append(_FLOAT.unpack_from(envelope, offset)[1])
+            offset += _FLOAT.size
+        elif code in (b's', b'j'):
+            length = _LENGTH.unpack_from(envelope, offset)[1]
+            offset += _LENGTH.size
+            text = bytes(envelope[offset:offset+length]).decode('UTF-8')
+            offset += length
+            data.append(text if code == b's' else json.loads(text))
+        elif code == b'a':
+            _, dtype_length, ndim = _ARRAY.unpack_from(envelope, offset)
+            offset += _ARRAY.size
+            dtype = bytes(envelope[offset:offset+dtype_length]).decode('ascii')
+            offset += dtype_length
+            shape = struct.unpack_from('<%dq' % ndim, envelope, offset)
+            offset += 8*ndim
+            data.append(numpy.frombuffer(frames[next_array], dtype=dtype).reshape(shape))
+            next_array += 1
+        elif code == b'z':
+            length = _LENGTH.unpack_from(envelope, offset)[1]
+            offset += _LENGTH.size
+            md = json.loads(bytes(envelope[offset:offset+length]).decode('UTF-8'))
+            offset += length
+            data.append(compression.decode(frames[next_array], md))
+            next_array += 1
+        else:
+            raise ValueError('Unknown item type %r in broadcast' % code)
+    return data
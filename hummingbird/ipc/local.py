@@ -0,0 +1,310 @@
+# --------------------------------------------------------------------------------------
+# Copyright 2016, Benedikt J. Daurer, Filipe R.N.C. Maia, Max F. Hantke, Carl Nettelblad
+# Hummingbird is distributed under the terms of the Simplified BSD License.
+# -------------------------------------------------------------------------
+"""Allows the backend to run several processes on a single node without MPI.
+
+The processes are forked from the one started by the user, which becomes
+the master (rank 0) and hosts the zmq server. The forked processes are the
+slaves and read and analyse events, just like the ranks started by mpirun.
+Messages are passed through multiprocessing queues by communicators which
+mimic the small part of the mpi4py interface used by :mod:`ipc.mpi`."""
+from __future__ import (absolute_import,  # Compatibility with python 2 and 3
+                        print_function)
+
+import collections
+import logging
+import multiprocessing
+import multiprocessing.resource_tracker
+import multiprocessing.shared_memory
+import os
+import pickle
+import queue
+import signal
+import sys
+import time
+import traceback
+
+from . import mpi as ipc_mpi
+
+# Use the same constants as MPI, so ipc.mpi does not need to care
+ANY_SOURCE = ipc_mpi.ANY_SOURCE
+ANY_TAG = ipc_mpi.ANY_TAG
+UNDEFINED = ipc_mpi.UNDEFINED
+
+# The pids of the forked processes, by rank
+_children = {}
+# Seconds between the checks that the other processes are still alive
+# while waiting for a message
+check_interval = 0.5
+
+
+class WorkerError(RuntimeError):
+    """Raised when another process of the backend died"""
+
+
+class Status(object):
+    """Stand-in for MPI.Status"""
+    def __init__(self):
+        self.source = ANY_SOURCE
+        self.tag = ANY_TAG
+
+    def Get_source(self): # pylint: disable=invalid-name
+        """Returns the rank of the process which sent the message"""
+        return self.source
+
+    def Get_tag(self): # pylint: disable=invalid-name
+        """Returns the tag of the message"""
+        return self.tag
+
+
+class Request(object):
+    """Stand-in for an MPI request. The sends of :class:`LocalComm`
+    never wait for the receiving process, so they complete right away."""
+    def Test(self): # pylint: disable=invalid-name
+        """Returns True if the operation completed"""
+        return True
+
+    def Wait(self): # pylint: disable=invalid-name
+        """Wait for the operation to complete"""
+
+
+class LocalGroup(object):
+    """Stand-in for an MPI group of processes"""
+    def __init__(self, ranks, world_rank):
+        self._ranks = list(ranks)
+        self._world_rank = world_rank
+        self.size = len(self._ranks)
+        if world_rank in self._ranks:
+            self.rank = self._ranks.index(world_rank)
+        else:
+            self.rank = UNDEFINED
+
+    def Incl(self, ranks): # pylint: disable=invalid-name
+        """Returns a new group with the given ranks of this group"""
+        return LocalGroup([self._ranks[r] for r in ranks], self._world_rank)
+
+
+class LocalComm(object):
+    """Stand-in for an MPI communicator between forked processes.
+
+    Every process has an inbox, a multiprocessing queue, in which
+    the other processes put pickled (source, tag, message) tuples.
+    Buffers sent with Send are passed in shared memory segments,
+    only their names go through the queue.
+    Only point to point communication is supported.
+
+    While waiting for a message, check() is called every check_interval
+    seconds. It raises :class:`WorkerError` if the process the message
+    should come from died."""
+    def __init__(self, inboxes, rank, check=None):
+        self._inboxes = inboxes
+        self._rank = rank
+        self._pending = collections.deque()
+        self._check = check
+
+    @property
+    def rank(self):
+        """Returns the rank of the process in the communicator"""
+        return self._rank
+
+    @property
+    def size(self):
+        """Returns the number of processes in the communicator"""
+        return len(self._inboxes)
+
+    def Get_rank(self): # pylint: disable=invalid-name
+        """Returns the rank of the process in the communicator"""
+        return self._rank
+
+    def Get_size(self): # pylint: disable=invalid-name
+        """Returns the number of processes in the communicator"""
+        return len(self._inboxes)
+
+    def Get_group(self): # pylint: disable=invalid-name
+        """Returns the group of all processes in the communicator"""
+        return LocalGroup(range(self.size), self._rank)
+
+    def Create(self, group): # pylint: disable=invalid-name,unused-argument
+        """All groups share the point to point channels of the communicator"""
+        return self
+
+    def send(self, obj, dest, tag=0):
+        """Send a python object to the process with rank dest"""
+        # Pickle right away, as the queue only pickles in a background thread
+        # and obj might have been modified by then
+        msg = pickle.dumps((self._rank, tag, obj), pickle.HIGHEST_PROTOCOL)
+        self._inboxes[dest].put(msg)
+
+    def isend(self, obj, dest, tag=0):
+        """Send a python object without waiting, like send"""
+        self.send(obj, dest, tag)
+        return Request()
+
+    def _match(self, source, tag, status):
+        """Remove and return the first pending message matching source and tag"""
+        for i, (src, tg, obj) in enumerate(self._pending):
+            if (source in (ANY_SOURCE, src)) and (tag in (ANY_TAG, tg)):
+                del self._pending[i]
+                if status is not None:
+                    status.source = src
+                    status.tag = tg
+                return True, obj
+        return False, None
+
+    def _fetch(self, block, timeout=None):
+        """Move one message from the inbox to the pending messages"""
+        try:
+            msg = self._inboxes[self._rank].get(block, timeout)
+        except queue.Empty:
+            return False
+        self._pending.append(pickle.loads(msg))
+        return True
+
+    def recv(self, buf=None, source=ANY_SOURCE, tag=ANY_TAG, status=None): # pylint: disable=unused-argument
+        """Receive a python object, blocking until a matching message arrives"""
+        while True:
+            found, obj = self._match(source, tag, status)
+            if found:
+                return obj
+            if not self._fetch(True, check_interval) and self._check is not None:
+                self._check()
+
+    def Send(self, buf, dest, tag=0): # pylint: disable=invalid-name
+        """Send a buffer to the process with rank dest through shared memory"""
+        buf = memoryview(buf).cast('B')
+        shm = multiprocessing.shared_memory.SharedMemory(create=True, size=max(1, buf.nbytes))
+        shm.buf[:buf.nbytes] = buf
+        # The receiving process unlinks the segment once it has been copied
+        multiprocessing.resource_tracker.unregister(shm._name, 'shared_memory') # pylint: disable=protected-access
+        name = shm.name
+        shm.close()
+        self.send(name, dest, tag)
+
+    def Isend(self, buf, dest, tag=0): # pylint: disable=invalid-name
+        """Send a buffer without waiting, like Send"""
+        self.Send(buf, dest, tag)
+        return Request()
+
+    def Recv(self, buf, source=ANY_SOURCE, tag=ANY_TAG, status=None): # pylint: disable=invalid-name
+        """Receive a buffer sent with Send into buf"""
+        name = self.recv(None, source, tag, status)
+        shm = multiprocessing.shared_memory.SharedMemory(name=name)
+        try:
+            buf = memoryview(buf).cast('B')
+            buf[:] = shm.buf[:buf.nbytes]
+        finally:
+            shm.close()
+            shm.unlink()
+
+    def Iprobe(self, source=ANY_SOURCE, tag=ANY_TAG, status=None): # pylint: disable=invalid-name
+        """Returns True if a matching message is waiting to be received"""
+        while self._fetch(False):
+            pass
+        for src, tg, _ in self._pending:
+            if (source in (ANY_SOURCE, src)) and (tag in (ANY_TAG, tg)):
+                if status is not None:
+                    status.source = src
+                    status.tag = tg
+                return True
+        return False
+
+    def close(self):
+        """Make sure everything sent is flushed to the pipes"""
+        for inbox in self._inboxes:
+            inbox.close()
+            inbox.join_thread()
+
+
+def start(nr_workers, target):
+    """Fork nr_workers slave processes and run target() in all processes.
+
+    The calling process becomes the master (rank 0). It returns after
+    target() finished and all slaves exited. If a slave dies with an
+    error the other ones are stopped and the program exits."""
+    size = nr_workers + 1
+    comm_inboxes = [multiprocessing.Queue() for _ in range(size)]
+    reload_inboxes = [multiprocessing.Queue() for _ in range(size)]
+    master_pid = os.getpid()
+    for rank in range(1, size):
+        pid = os.fork()
+        if pid == 0:
+            _run_child(rank, master_pid, comm_inboxes, reload_inboxes, target)
+        _children[rank] = pid
+    logging.debug('Forked %d local worker processes.' % nr_workers)
+    ipc_mpi.init_local(LocalComm(comm_inboxes, 0, _check_children),
+                       LocalComm(reload_inboxes, 0))
+    failed = True
+    try:
+        target()
+        failed = False
+    except WorkerError as e:
+        logging.error('%s, stopping the other workers.', e)
+    finally:
+        _stop_children(0 if failed else 10.)
+    if failed:
+        sys.exit(1)
+
+def _check_children():
+    """Raise WorkerError if one of the forked processes exited with an error"""
+    for rank, pid in list(_children.items()):
+        done, status = os.waitpid(pid, os.WNOHANG)
+        if not done:
+            continue
+        del _children[rank]
+        if os.WIFSIGNALED(status):
+            raise WorkerError('Worker %d was killed by signal %d' % (rank, os.WTERMSIG(status)))
+        if os.WEXITSTATUS(status):
+            raise WorkerError('Worker %d exited with code %d' % (rank, os.WEXITSTATUS(status)))
+
+def _stop_children(timeout):
+    """Wait up to timeout seconds for the forked processes to exit, then kill them"""
+    end = time.time() + timeout
+    while True:
+        for rank, pid in list(_children.items()):
+            if os.waitpid(pid, os.WNOHANG)[0]:
+                del _children[rank]
+        if not _children or time.time() >= end:
+            break
+        time.sleep(0.05)
+    for rank, pid in list(_children.items()):
+        if timeout:
+            logging.warning('Worker %d did not exit, killing it.', rank)
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+        del _children[rank]
+
+def _run_child(rank, master_pid, comm_inboxes, reload_inboxes, target):
+    """Run target() in a forked process and exit"""
+    # The siblings are not children of this process
+    _children.clear()
+    def check_master():
+        if os.getppid() != master_pid:
+            raise WorkerError('The master exited')
+    comm = LocalComm(comm_inboxes, rank, check_master)
+    reload_comm = LocalComm(reload_inboxes, rank)
+    ipc_mpi.init_local(comm, reload_comm)
+    code = 0
+    try:
+        target()
+    except SystemExit as e:
+        code = e.code if isinstance(e.code, int) else 1
+    except BaseException: # pylint: disable=broad-except
+        traceback.print_exc()
+        code = 1
+    finally:
+        comm.close()
+        reload_comm.close()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        # Skip the exit handlers inherited from the parent process
+        # (MPI_Finalize hangs when called from a forked process)
+        os._exit(code) # pylint: disable=protected-access
+
+def forward_signal(signum):
+    """Send a signal on to the forked processes, if any"""
+    for pid in _children.values():
+        try:
+            os.kill(pid, signum)
+        except OSError:
+            pass
@@ -13,14 +13,27 @@ import time
 
 import numpy
 
+from .ratelimit import RateLimiter
+
 
 try:
     # Try to import MPI and create a group containing all the slaves
     from mpi4py import MPI
     # Only use MPI if there is more than one process
     use_mpi = MPI.COMM_WORLD.Get_size() > 1
+    ANY_SOURCE = MPI.ANY_SOURCE
+    ANY_TAG = MPI.ANY_TAG
+    UNDEFINED = MPI.UNDEFINED
 except ImportError:
+    MPI = None
     use_mpi = False
+    ANY_SOURCE = -1
+    ANY_TAG = -1
+    UNDEFINED = -32766
+# True if the processes were forked by ipc.local instead of started by mpirun.
+# In that case use_mpi is also True, as the communicators behave
+# like MPI ones for point to point communication.
+use_local = False
 
 if use_mpi:
     # World communicator
@@ -48,6 +61,21 @@ else:
     event_reader_comm = None
     logging.debug('Initialised for serial operation mode.')
 
+def init_local(local_comm, local_reload_comm):
+    """Use the communicators of processes forked by ipc.local instead of MPI.
+    Collective operations are not available, so slaves_comm stays None."""
+    global use_mpi, use_local, comm, rank, size # pylint: disable=global-statement
+    global slaves_group, slaves_comm, reload_comm # pylint: disable=global-statement
+    use_mpi = True
+    use_local = True
+    comm = local_comm
+    rank = comm.Get_rank()
+    size = comm.Get_size()
+    slaves_group = comm.Get_group().Incl(range(1, size))
+    slaves_comm = None
+    reload_comm = local_reload_comm
+    logging.debug('Initialised for local operation mode (size = %i, rank = %i).' % (size, rank))
+
 # MASTER PROCESS
 
 def is_master():
@@ -111,7 +139,7 @@ def is_event_reader():
     if use_mpi and event_reader_comm is None:
         logging.warning('Event reader communicator not initialised yet!')
         return None
-    return True if not use_mpi else (event_reader_group.rank != MPI.UNDEFINED)
+    return True if not use_mpi else (event_reader_group.rank != UNDEFINED)
         
 def is_main_event_reader():
     """Returns True if the process has rank == 0 in the reader communicator or if there is only one process."""
@@ -133,7 +161,7 @@ def event_reader_rank():
     if not use_mpi:
         return 0
     else:
-        if event_reader_group.rank == MPI.UNDEFINED:
+        if event_reader_group.rank == UNDEFINED:
             logging.warning('Cannot determine event reader rank for process that is not part of the event reader communicator.')
             return None
         else:
@@ -157,10 +185,77 @@ def is_zmqserver():
 
 # COMMUNICATIONS
 
+# Arrays with at least this many bytes are not pickled together with
+# the message, but sent as raw buffers right after it
+array_threshold = 64*1024
+_MSG_TAG = 0
+_ARRAY_TAG = 1
+# The replies to next_batch, kept apart from the other replies of the master
+_WORK_TAG = 2
+# The totals of sum() sent back to the main event reader
+_REDUCE_TAG = 3
+
+class _ArrayHeader(object):
+    """Takes the place of an array in a message.
+    The array data follows the message in a separate raw buffer."""
+    def __init__(self, array):
+        self.dtype = array.dtype
+        self.shape = array.shape
+
+def _pack(obj, arrays):
+    """Returns a copy of obj with large arrays in (nested) lists
+    replaced by headers. The arrays are appended to the given list."""
+    if isinstance(obj, list):
+        return [_pack(o, arrays) for o in obj]
+    if (isinstance(obj, numpy.ndarray) and obj.nbytes >= array_threshold and
+        obj.dtype.kind in 'biufc'):
+        arrays.append(numpy.ascontiguousarray(obj))
+        return _ArrayHeader(obj)
+    return obj
+
+def _unpack(obj, source):
+    """Receive the arrays which follow the message obj
+    and put them back in place of their headers."""
+    if isinstance(obj, list):
+        for i in range(len(obj)):
+            obj[i] = _unpack(obj[i], source)
+    elif isinstance(obj, _ArrayHeader):
+        array = numpy.empty(obj.shape, obj.dtype)
+        comm.Recv(array.reshape(-1).view(numpy.uint8), source=source, tag=_ARRAY_TAG)
+        return array
+    return obj
+
+def _send_packed(obj, dest, tag=_MSG_TAG):
+    """Send a message, with large arrays as raw buffers
+    to avoid pickling them."""
+    arrays = []
+    obj = _pack(obj, arrays)
+    comm.send(obj, dest, tag=tag)
+    for array in arrays:
+        comm.Send(array.reshape(-1).view(numpy.uint8), dest, tag=_ARRAY_TAG)
+
+def _isend_packed(obj, dest, tag=_MSG_TAG):
+    """Like _send_packed, but without waiting for the message to be
+    delivered. Returns the requests of the sends, the arrays of obj
+    must not be changed until they completed."""
+    arrays = []
+    obj = _pack(obj, arrays)
+    requests = [comm.isend(obj, dest, tag=tag)]
+    for array in arrays:
+        requests.append(comm.Isend(array.reshape(-1).view(numpy.uint8), dest, tag=_ARRAY_TAG))
+    return requests
+
+def _recv_packed(source=ANY_SOURCE, status=None, tag=_MSG_TAG):
+    """Receive a message sent by _send_packed"""
+    if status is None:
+        status = _new_status()
+    obj = comm.recv(None, source, tag=tag, status=status)
+    return _unpack(obj, status.Get_source())
+
 def send(title, data):
     """Send a list of data items to the master node."""
     if comm is not None:
-        comm.send([title, data], 0)
+        _send_packed([title, data], 0)
 
 # RELOADING OF CONFIGURATION FILE
 
@@ -187,78 +282,267 @@ def checkreload():
                 subscribed = msg[1]
     return False
 
+# WORK QUEUE
+
+# The next item to hand out of each work queue, by key
+_work_next = {}
+def next_batch(key, total, batch_size, start=0):
+    """Returns the range (start, stop) of the next batch of at most
+    batch_size items out of the total items of the work queue key,
+    which starts at item start. The master hands out the batches in
+    order, each to the event reader asking for one, so faster event
+    readers take more batches. The range is empty when all the items
+    have been handed out."""
+    if not use_mpi:
+        return _hand_out(key, total, batch_size, start)
+    _send_packed(['__work__', key, total, batch_size, start], 0)
+    return tuple(_recv_packed(0, tag=_WORK_TAG))
+
+def _hand_out(key, total, batch_size, start):
+    """Returns the range of the next batch of the work queue key"""
+    # Not using min(), which is the reduction of this module
+    first = _work_next.get(key, start)
+    if first > total:
+        first = total
+    last = first + int(batch_size) if batch_size > 1 else first + 1
+    if last > total:
+        last = total
+    _work_next[key] = last
+    return first, last
+
 # MASTER LOOP
 
 reducedata = {}
+reducetotal = {}
+# The sends of the totals to the main event reader not completed yet
+_reply_requests = []
 slavesdone = []
+# Maximum number of messages the master handles in one iteration
+master_batch_size = 1000
+# Number of messages handled by the master in the last iteration
+master_queue_depth = 0
 def master_loop():
     """Run the main loop on the master process.
     It retransmits all received messages using its zmqserver
-    and handles any possible reductions."""
-    status = MPI.Status()
-    msg = comm.recv(None, MPI.ANY_SOURCE, status = status)
-    if(msg[0] == '__data_conf__'):
+    and handles any possible reductions.
+
+    All the messages waiting are received at once. Configuration,
+    reductions and requests for work are handled before the data, and
+    only the newest of several images with the same title is sent on."""
+    global master_queue_depth
+    status = _new_status()
+    msg = _recv_packed(ANY_SOURCE, status)
+    control = []
+    reductions = []
+    work = []
+    data = []
+    latest_image = {}
+    exiting = []
+    depth = 0
+    while True:
+        depth += 1
+        if(msg[0] == '__data_conf__'):
+            control.append(msg)
+        elif(msg[0] == '__reduce__'):
+            reductions.append((msg, status.Get_source()))
+        elif(msg[0] == '__work__'):
+            work.append((msg, status.Get_source()))
+        elif(msg[0] == '__exit__'):
+            exiting.append(msg)
+        else:
+            if _is_replaceable(msg):
+                if msg[0] in latest_image:
+                    data[latest_image[msg[0]]] = None
+                latest_image[msg[0]] = len(data)
+            data.append(msg)
+        if depth >= master_batch_size or not comm.Iprobe(ANY_SOURCE, _MSG_TAG, status):
+            break
+        msg = _recv_packed(status.Get_source(), status)
+
+    master_queue_depth = depth
+    if depth > 1:
+        logging.debug('Master received %d messages at once, %d images dropped' %
+                      (depth, data.count(None)))
+
+    for msg in control:
         from .broadcast import data_conf as ipc_broadcast_data_conf
         ipc_broadcast_data_conf.update(msg[1])
-    elif(msg[0] == '__reduce__'):
-        cmd = msg[1]
-        if(msg[2] != ()):
-            data_y = numpy.zeros(msg[1])
-        else:
-            data_y = 0
-        incomingdata = msg[3]
-        getback = msg[4]
-        
-        source = status.Get_source()
-        
-        # This indicates that we really should have an object for the state
-        if cmd not in reducedata:
-            reducedata[cmd] = {}
-        reducedata[cmd][source] = incomingdata
-        
-        if getback:
-            cnt = 0
-            for data in reducedata[cmd]:
-                data_y = data_y + reducedata[cmd][data]
-            comm.send(data_y, source)
-    elif(msg[0] == '__exit__'):
+    for msg, source in reductions:
+        _reduce_contribution(msg, source)
+    for msg, source in work:
+        # The event reader waits for its next batch
+        _send_packed(list(_hand_out(*msg[1:])), source, _WORK_TAG)
+    for msg in data:
+        if msg is not None:
+            msg = _limit_send_rate(msg)
+        if msg is not None:
+            # Inject a proper UUID
+            from .zmqserver import get_zmq_server as ipc_zmq, ipc_uuid
+            msg[1][0] = ipc_uuid
+            ipc_zmq().send(msg[0], msg[1])
+    for msg in exiting:
         slavesdone.append(True)
         logging.info("Slave with rank = %d reports to be done" %msg[1])
         if len(slavesdone) == nr_slaves():
-            MPI.Finalize()
+            for request in _reply_requests:
+                request.Wait()
+            del _reply_requests[:]
+            if not use_local:
+                MPI.Finalize()
             return True
-    else:
-        # Inject a proper UUID
-        from .zmqserver import get_zmq_server as ipc_zmq, ipc_uuid
-        msg[1][0] = ipc_uuid
-        ipc_zmq().send(msg[0], msg[1])
+
+def _is_replaceable(msg):
+    """Returns True if the message is an image which is superseded
+    by a newer one with the same title"""
+    from .broadcast import data_conf as ipc_broadcast_data_conf
+    if msg[1][1] != 'new_data':
+        return False
+    if ipc_broadcast_data_conf.get(msg[0], {}).get('data_type') != 'image':
+        return False
+    # Images which are added up in the interface all count
+    kwds = msg[1][5]
+    return not kwds.get('sum_over') and not kwds.get('max_over')
+
+_master_rate_limiter = RateLimiter()
+def _limit_send_rate(msg):
+    """Returns the message, or None if sending it would exceed the
+    send_rate of its title summed over all the slaves. Every item of
+    a batch counts, and only the newest ones which fit are kept."""
+    kwds = msg[1][5]
+    if kwds.get('send_rate') is None:
+        return msg
+    send_rate = float(kwds['send_rate'])
+    if msg[1][1] != 'new_data_batch':
+        return msg if _master_rate_limiter.allow(msg[0], send_rate) else None
+    ys, xs, msgs = msg[1][3], msg[1][4], msg[1][6]
+    n = _master_rate_limiter.take(msg[0], send_rate, len(ys))
+    if n == 0:
+        return None
+    if n < len(ys):
+        msg[1][3:5] = [ys[-n:], xs[-n:]]
+        msg[1][6] = msgs[-n:]
+    return msg
+
+def _reduce_contribution(msg, source):
+    """Update the total of a reduction with the contribution of source
+    and send the total back if asked to"""
+    cmd = msg[1]
+    incomingdata = msg[3]
+    getback = msg[4]
+
+    # This indicates that we really should have an object for the state
+    if cmd not in reducedata:
+        reducedata[cmd] = {}
+        reducetotal[cmd] = 0
+    # Only add the change of the contribution of the source to the total
+    previous = reducedata[cmd].get(source, 0)
+    reducedata[cmd][source] = incomingdata
+    total = reducetotal[cmd] - previous + incomingdata
+    if not numpy.all(numpy.isfinite(total)):
+        # Do not let an inf or nan stick to the total forever
+        total = 0
+        for data in reducedata[cmd].values():
+            total = total + data
+    reducetotal[cmd] = total
+
+    if getback:
+        # The total is replaced, not changed, by the next contribution,
+        # so it can be sent without waiting for the main event reader
+        _reply_requests[:] = [r for r in _reply_requests if not r.Test()]
+        _reply_requests.extend(_isend_packed([cmd, total], source, _REDUCE_TAG))
+
+def _new_status():
+    """Returns an object to hold the status of a received message"""
+    if use_local:
+        from .local import Status
+        return Status()
+    return MPI.Status()
 
 def slave_done():
+    for reduction in _reductions.values():
+        reduction.done()
+    _reductions.clear()
     send('__exit__', rank)
-            
+
+# Number of calls of sum() with the same key between two contributions
+# sent to the master. sum() returns the newest total received meanwhile.
+reduction_period = 1
+
+_reductions = {}
+class _Reduction(object):
+    """The contributions of an event reader to sum() with the same key.
+
+    The master keeps the newest contribution of every event reader and
+    sends the total back to the main event reader. A new contribution is
+    only sent once the previous one was delivered, and its total received,
+    so sum() never waits for the other event readers, which do not need
+    to call it at all."""
+    def __init__(self, cmd):
+        self.cmd = cmd
+        self.calls = 0
+        # The contribution being sent, with the requests of the sends
+        self.sendbuf = None
+        self.requests = []
+        # True while the main event reader waits for a total
+        self.waiting = False
+        self.result = None
+
+    def _busy(self):
+        """Returns True if the last contribution is still on its way"""
+        self.requests = [r for r in self.requests if not r.Test()]
+        return bool(self.requests) or self.waiting
+
+    def update(self, array):
+        """Returns the newest total and sends the contribution when due"""
+        self.calls += 1
+        _receive_totals()
+        if self.calls >= reduction_period and not self._busy():
+            self.calls = 0
+            # The buffers must not be touched while they are sent
+            if isinstance(array, numbers.Number):
+                self.sendbuf = array
+            else:
+                self.sendbuf = numpy.array(array)
+            getback = bool(is_main_event_reader())
+            self.requests = _isend_packed(['__reduce__', self.cmd, numpy.shape(array),
+                                           self.sendbuf, getback], 0)
+            self.waiting = getback
+        return self.result
+
+    def done(self):
+        """Wait until the last contribution was delivered"""
+        for request in self.requests:
+            request.Wait()
+        self.requests = []
+        while self.waiting:
+            _receive_totals(block=True)
+
+def _receive_totals(block=False):
+    """Receive the totals the master sent back, waiting for one if block is True"""
+    while block or comm.Iprobe(0, _REDUCE_TAG):
+        cmd, total = _recv_packed(0, tag=_REDUCE_TAG)
+        reduction = _reductions.get(cmd)
+        if reduction is not None:
+            reduction.result = total
+            reduction.waiting = False
+        block = False
+
 def sum(cmd, array):
     """Element-wise sum of a numpy array across all processes of event readers.
-    The result is only available in the main event reader (rank 0 in event reader comm)."""
-    #_reduce(array, "SUM")
-    #return
+    The result is only available in the main event reader (rank 0 in event reader comm).
+
+    The contributions of the event readers are added up by the master.
+    The total is updated every ``reduction_period`` calls without waiting
+    for the other event readers, so it can lag behind a bit, and array
+    is left unchanged until the first total arrived."""
     if not use_mpi:
         return
+    if cmd not in _reductions:
+        _reductions[cmd] = _Reduction(cmd)
+    result = _reductions[cmd].update(array)
+    if result is not None and not isinstance(array, numbers.Number):
+        array[()] = result
 
-    getback = is_main_event_reader()
-    if(isinstance(array, numbers.Number)):
-        comm.send(['__reduce__', cmd, (), array, getback], dest=0)
-    else:
-        comm.send(['__reduce__', cmd, array.shape, array, getback], dest=0)
-    
-    if not getback:
-        return None
-    else:
-        databack = comm.recv(None, 0)
-        if(isinstance(databack, numbers.Number)):
-            array[()] = databack
-        else:
-            array[:] = databack[:]
-    
 # WE MIGHT WANT TO DELETE THE CODE BELOW (Benedikt? Carl?)
 
 def send_reduce(title, cmd, data_y, data_x, **kwds):
@@ -306,6 +590,9 @@ def _reduce(array, op):
     """Reduce a numpy array with the given MPI op across all the slave processes"""
     if(not isinstance(array,numpy.ndarray)):
         raise TypeError("argument must be a numpy ndarray")
+    if use_local:
+        raise NotImplementedError("%s reductions need MPI, they are not available "
+                                  "with the --workers option" % op)
     if(slaves_comm):
         if(is_main_slave()):
             slaves_comm.Reduce(MPI.IN_PLACE, array, op=getattr(MPI,op))
@@ -0,0 +1,84 @@
+# --------------------------------------------------------------------------------------
+# Copyright 2016, Benedikt J. Daurer, Filipe R.N.C. Maia, Max F. Hantke, Carl Nettelblad
+# Hummingbird is distributed under the terms of the Simplified BSD License.
+# -------------------------------------------------------------------------
+"""Limits the rate at which data is broadcast."""
+from __future__ import (absolute_import,  # Compatibility with python 2 and 3
+                        print_function)
+
+import time
+
+
+class TokenBucket(object):
+    """Allows on average ``rate`` units per second, in bursts of up to ``burst`` units.
+
+    The bucket holds up to ``burst`` tokens and is refilled with ``rate``
+    tokens per second of wall-clock time. Anything larger than the bucket
+    is let through when the bucket is full, leaving it in debt.
+
+    Args:
+        rate (float): Average number of units allowed per second.
+        burst (float): Size of the bucket, by default one second
+            worth of tokens (but at least 1).
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        if burst is None:
+            burst = max(1., self.rate)
+        self.burst = float(burst)
+        self._tokens = self.burst
+        self._time = time.monotonic()
+
+    def _refill(self):
+        """Add the tokens accumulated since the last call"""
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._time)*self.rate)
+        self._time = now
+
+    def consume(self, amount=1.):
+        """Take amount tokens from the bucket.
+        Returns False, without taking any, if there are not enough."""
+        self._refill()
+        if self._tokens < min(amount, self.burst):
+            return False
+        self._tokens -= amount
+        return True
+
+    def take(self, amount):
+        """Take up to amount whole tokens from the bucket, all of them
+        when the bucket is full. Returns the number of tokens taken."""
+        self._refill()
+        if self._tokens >= min(amount, self.burst):
+            taken = amount
+        else:
+            taken = max(0, int(self._tokens))
+        self._tokens -= taken
+        return taken
+
+    def charge(self, amount=1.):
+        """Take amount tokens from the bucket, even if there are not enough"""
+        self._refill()
+        self._tokens -= amount
+
+
+class RateLimiter(object):
+    """Keeps a :class:`TokenBucket` for each title,
+    with the rate given on every call."""
+    def __init__(self):
+        self._buckets = {}
+
+    def _bucket(self, title, rate):
+        """Returns the bucket of title, refilled at rate"""
+        bucket = self._buckets.get(title)
+        if bucket is None or bucket.rate != rate:
+            bucket = TokenBucket(rate)
+            self._buckets[title] = bucket
+        return bucket
+
+    def allow(self, title, rate, amount=1.):
+        """Returns True if sending amount for title keeps within rate"""
+        return self._bucket(title, rate).consume(amount)
+
+    def take(self, title, rate, amount):
+        """Returns how many of amount items of title can be sent within rate"""
+        return self._bucket(title, rate).take(amount)
@@ -0,0 +1,60 @@
+# --------------------------------------------------------------------------------------
+# Copyright 2016, Benedikt J. Daurer, Filipe R.N.C. Maia, Max F. Hantke, Carl Nettelblad
+# Hummingbird is distributed under the terms of the Simplified BSD License.
+# -------------------------------------------------------------------------
+"""Binned and cropped views of image broadcasts.
+
+Clients ask the zmq server for a view of a title with the 'view' command.
+The server then publishes the view under the key of its name, next to the
+full images, whenever someone subscribes to it."""
+from __future__ import (absolute_import,  # Compatibility with python 2 and 3
+                        print_function)
+
+import numpy
+
+
+def normalize(binning=1, roi=None):
+    """Returns the (binning, roi) of a view, or None for the full images.
+    The roi is given as [row_start, row_stop, column_start, column_stop]."""
+    binning = max(1, int(binning))
+    if roi is not None:
+        roi = [int(r) for r in roi]
+        if len(roi) != 4:
+            raise ValueError('The roi needs 4 values, not %d' % len(roi))
+    if binning == 1 and roi is None:
+        return None
+    return binning, roi
+
+def name(title, view):
+    """Returns the name under which a view of title is published"""
+    if view is None:
+        return title
+    binning, roi = view
+    view_name = '%s#bin=%d' % (title, binning)
+    if roi is not None:
+        view_name += '#roi=%d,%d,%d,%d' % tuple(roi)
+    return view_name
+
+def apply(array, view):
+    """Returns the view of a 2D array, cropped to the roi and binned
+    by averaging. Anything that is not an image is returned unchanged."""
+    if not isinstance(array, numpy.ndarray) or array.ndim != 2:
+        return array
+    binning, roi = view
+    if roi is not None:
+        array = array[roi[0]:roi[1], roi[2]:roi[3]]
+    if binning > 1:
+        rows = array.shape[0] // binning
+        cols = array.shape[1] // binning
+        array = array[:rows*binning, :cols*binning]
+        array = array.reshape(rows, binning, cols, binning)
+        if array.dtype.kind == 'f':
+            array = array.mean(axis=(1, 3), dtype=array.dtype)
+        else:
+            array = array.mean(axis=(1, 3), dtype=numpy.float32)
+    return array
+
+def describe(view, shape):
+    """Returns the description of a view which is sent with its images"""
+    binning, roi = view
+    return {'binning': binning, 'roi': roi, 'shape': list(shape)}
@@ -8,6 +8,7 @@ from __future__ import (absolute_import,  # Compatibility with python 2 and 3
                         print_function)
 
 import hashlib
+import json
 import logging
 import socket
 import threading
@@ -18,7 +19,10 @@ import zmq
 import zmq.eventloop
 import zmq.eventloop.zmqstream
 
+from . import compression, framing
+from . import views as ipc_views
 from . import mpi as ipc_mpi
+from .ratelimit import TokenBucket
 from hummingbird.utils.cmdline_args import argparser as _argparser
 
 eventLimit = 125
@@ -33,6 +37,9 @@ class ZmqServer(object):
     Analysis users do not need to deal with it."""
     def __init__(self, port):
         self._subscribed = set()
+        # Views of the titles by name, and the keys of the titles by view key
+        self._views = {}
+        self._view_keys = {}
         self.reloadmaster = False
         
         self._batch_mode = bool(_argparser.parse_args().batch_mode)
@@ -41,6 +48,8 @@ class ZmqServer(object):
 
         from hummingbird.backend import Worker
         self._state = Worker.state
+        # Limits the bytes per second sent by all broadcasts together
+        self._bandwidth = None
         #self._zmq_key = bytes('hummingbird')
         self._context = zmq.Context()
         self._ctrl_socket = self._context.socket(zmq.REP)
@@ -87,6 +96,9 @@ class ZmqServer(object):
 
     def _send_array(self, array, flags=0, copy=True, track=False):
         """Send a numpy array with metadata"""
+        if isinstance(array, compression.Compressed):
+            self._data_socket.send_json(array.md, flags|zmq.SNDMORE)
+            return self._data_socket.send(array.data, flags, copy=copy, track=track)
         md = dict(
             dtype=str(array.dtype),
             shape=array.shape,
@@ -101,20 +113,66 @@ class ZmqServer(object):
         """Send a list of data items to the broadcast named title"""
         if self._batch_mode:
             return
+        key = _key(title)
+        views = self._views.get(title, {}) if data[1] == 'new_data' else {}
+        sent_view = False
+        for view_name, view in views.items():
+            view_key = _key(view_name)
+            if (view_key in self._subscribed or framing.key(view_key) in self._subscribed or
+                framing.batch_key(view_key) in self._subscribed):
+                # Views are published only to those who asked for them
+                kwds = dict(data[5], view=ipc_views.describe(view, numpy.shape(data[3])))
+                view_data = data[:3] + [ipc_views.apply(data[3], view)] + data[4:5] + [kwds] + data[6:]
+                self._publish(view_key, view_name, view_data, only_subscribed=True)
+                sent_view = True
+        self._publish(key, title, data, only_subscribed=sent_view)
+
+    def _publish(self, key, title, data, only_subscribed=False):
+        """Send data on the data socket with the given key, in the encodings
+        subscribed to. Unless only_subscribed is True JSON is always sent.
+        Batches of scalars are only sent to the clients which asked for
+        them, the others get the items one by one."""
+        subscribed = self._subscribed
+        binary_keys = [k for k in (framing.key(key), framing.batch_key(key)) if k in subscribed]
+        send_json = key in subscribed or not (binary_keys or only_subscribed)
+        if data[1] != 'new_data_batch':
+            self._send_encoded(key, title, data, binary_keys, send_json)
+            return
+        batch_keys = [k for k in binary_keys if k[:1] == framing.BATCH_KEY_PREFIX]
+        binary_keys = [k for k in binary_keys if k not in batch_keys]
+        if binary_keys or send_json:
+            for item in _unbatch(data):
+                self._send_encoded(key, title, item, binary_keys, send_json)
+        self._send_encoded(key, title, data, batch_keys, False)
+
+    def _send_encoded(self, key, title, data, binary_keys, send_json):
+        """Send data with each of the binary keys, and with key in JSON if send_json is True"""
+        from .broadcast import data_conf as ipc_broadcast_data_conf
+        if not (binary_keys or send_json):
+            return
+        if len(data) > 3:
+            data[3] = compression.compress(data[3], ipc_broadcast_data_conf.get(data[2]))
+        if not self._within_bandwidth(data):
+            logging.debug("Bandwidth limit reached, not sending '%s'" % title)
+            return
+        if binary_keys:
+            frames = framing.encode(data, title)
+        for binary_key in binary_keys:
+            self._data_socket.send(binary_key, zmq.SNDMORE)
+            # The arrays received from the slaves are not used any more,
+            # so there is no need to copy them
+            self._data_socket.send_multipart(frames, copy=not ipc_mpi.is_master())
+        if not send_json:
+            return
         array_list = []
         for i in range(len(data)):
-            if(isinstance(data[i], numpy.ndarray)):
+            if(isinstance(data[i], (numpy.ndarray, compression.Compressed))):
                 array_list.append(data[i])
                 data[i] = '__ndarray__'
             elif(isinstance(data[i], numpy.number)):
                 # JSON can't deal with numpy scalars
                 data[i] = data[i].item()
-        # Use the md5sum of the title as the key to avoid clashing
-        # keys, when one title is a substring or another title
-        # (e.g. "CCD" and "CCD1")
-        m = hashlib.md5()
-        m.update(title.encode('UTF-8'))
-        self._data_socket.send(m.digest(), zmq.SNDMORE)
+        self._data_socket.send(key, zmq.SNDMORE)
         if(len(array_list)):
             self._data_socket.send_json(data, zmq.SNDMORE)
         else:
@@ -125,21 +183,78 @@ class ZmqServer(object):
             else:
                 self._send_array(array_list[i])
     
+    def _within_bandwidth(self, data):
+        """Returns True if sending the arrays in data keeps within
+        state['zmq_bandwidth_limit'] bytes per second"""
+        limit = self._state.get('zmq_bandwidth_limit')
+        if limit is None:
+            self._bandwidth = None
+            return True
+        if self._bandwidth is None or self._bandwidth.rate != limit:
+            self._bandwidth = TokenBucket(limit)
+        nbytes = 0
+        for d in data:
+            if isinstance(d, (numpy.ndarray, compression.Compressed)):
+                nbytes += d.nbytes
+        if nbytes == 0:
+            # Always send scalars, but count roughly their size
+            self._bandwidth.charge(256)
+            return True
+        return self._bandwidth.consume(nbytes)
+
     def _answer_command(self, stream, msg):
         """Reply to commands received on the _ctrl_stream"""
         if(msg[0] == 'conf'.encode('UTF-8')):
             from .broadcast import data_conf as ipc_broadcast_data_conf
             stream.socket.send_json(['conf', ipc_broadcast_data_conf])
         if(msg[0] == 'data_port'.encode('UTF-8')):
-            stream.socket.send_json(['data_port', self._broker_pub_port])
+            # Clients which do not know about the encodings only look at the port
+            stream.socket.send_json(['data_port', self._broker_pub_port,
+                                     {'encodings': ['json', 'binary'], 'views': True,
+                                      'batches': True}])
         if(msg[0] == 'uuid'):
             stream.socket.send_json(['uuid', ipc_uuid])
+        if(msg[0] == 'view'.encode('UTF-8')):
+            request = json.loads(msg[1].decode('UTF-8'))
+            view = ipc_views.normalize(request.get('binning', 1), request.get('roi'))
+            view_name = ipc_views.name(request['title'], view)
+            if view is not None:
+                self._add_view(request['title'], view_name, view)
+            stream.socket.send_json(['view', view_name])
         if(msg[0] == 'reload'.encode('UTF-8')):
             #TODO: Find a way to replace this with a direct function call (in all workers)
             stream.socket.send_json(['reload', True])
             print("Answering reload command")
             self.reloadmaster = True
             
+    def _add_view(self, title, view_name, view):
+        """Start publishing a view of title under view_name"""
+        if view_name in self._views.get(title, {}):
+            return
+        logging.debug("Adding view %s" % view_name)
+        # Replace rather than modify the dictionaries, as send()
+        # reads them from another thread
+        views = dict(self._views)
+        views[title] = dict(views.get(title, {}))
+        views[title][view_name] = view
+        self._views = views
+        view_keys = dict(self._view_keys)
+        view_keys[_key(view_name)] = _key(title)
+        self._view_keys = view_keys
+        # Someone might have subscribed to the view already
+        self._update_slaves_subscribed()
+
+    def _update_slaves_subscribed(self):
+        """Tell the slaves which titles are subscribed"""
+        if ipc_mpi.is_master():
+            # The slaves only need to know the titles, not the encodings or views
+            subscribed = set()
+            for k in self._subscribed:
+                k = framing.base_key(k)
+                subscribed.add(self._view_keys.get(k, k))
+            for i in range(1, ipc_mpi.size):
+                ipc_mpi.reload_comm.send(['__subscribed__', subscribed], i)
+
     def _ioloop(self):
         """Start the ioloop fires the callbacks when data is received
         on the control stream. Runs on a separate thread."""
@@ -150,23 +265,57 @@ class ZmqServer(object):
         self._xpub_stream.send_multipart(msg)
 
     def _forward_xpub(self, stream, msg):
+        # Replace rather than modify the set, as send() and
+        # is_subscribed() iterate over it from another thread
+        subscribed = set(self._subscribed)
         if (msg[0][0] == '\x00') or (msg[0][0] == 0):
             logging.debug("Got unsubscription for: %r" % msg[0][1:])
-            self._subscribed.discard(msg[0][1:])
+            subscribed.discard(msg[0][1:])
         elif (msg[0][0] == '\x01') or (msg[0][0] == 1):
             logging.debug("Got subscription for: %r" % msg[0][1:])
-            self._subscribed.add(msg[0][1:])
+            subscribed.add(msg[0][1:])
         else:
             raise ValueError('Unexpected message: %r' % msg[0])
-        if ipc_mpi.is_master():
-            for i in range(1, ipc_mpi.size):
-                ipc_mpi.reload_comm.send(['__subscribed__',self._subscribed], i)
+        self._subscribed = subscribed
+        self._update_slaves_subscribed()
         self._xsub_stream.send_multipart(msg)
 
     @property
     def subscribed(self):
         return self._subscribed
 
+    def is_subscribed(self, title):
+        """Returns True if anyone is subscribed to title,
+        in any encoding or view"""
+        key = _key(title)
+        for k in self._subscribed:
+            k = framing.base_key(k)
+            if self._view_keys.get(k, k) == key:
+                return True
+        return False
+
+
+def _unbatch(data):
+    """Returns the items of a batch of scalars as 'new_data' broadcasts"""
+    uuid, _, title, ys, xs, kwds, msgs = data
+    items = []
+    for y, x, msg in zip(ys.tolist(), xs.tolist(), msgs):
+        item_kwds = dict(kwds)
+        item_kwds.pop('msg', None)
+        if msg is not None:
+            item_kwds['msg'] = msg
+        items.append([uuid, 'new_data', title, y, x, item_kwds])
+    return items
+
+
+def _key(title):
+    """Returns the key of the broadcasts of title.
+    The md5sum of the title is used to avoid clashing keys, when one
+    title is a substring or another title (e.g. "CCD" and "CCD1")"""
+    m = hashlib.md5()
+    m.update(title.encode('UTF-8'))
+    return m.digest()
+
 
 _server = None
 ipc_hostname = socket.gethostname()
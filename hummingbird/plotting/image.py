@@ -3,8 +3,6 @@
 # Hummingbird is distributed under the terms of the Simplified BSD License.
 # -------------------------------------------------------------------------
 """A plotting module for images"""
-import numpy as np
-
 from hummingbird import ipc
 
 images = {}
@@ -34,10 +32,14 @@ def plotImage(record, history=10, vmin=None, vmax=None, log=False, mask=None, ms
     if(not n in images):
         ipc.broadcast.init_data(n, data_type='image', history_length=history, vmin=vmin, vmax=vmax, log=log, group=group, sum_over=sum_over, max_over=max_over)
         images[n] = True
-    image = record.data
-    sh = image.shape
-    if (image.ndim == 3):
-        image = image.reshape(sh[0]*sh[2], sh[1])
-    if mask is None:
-        mask = np.ones_like(image)
-    ipc.new_data(n, image*mask, msg=msg, alert=alert, send_rate=send_rate, center=roi_center, diameters=roi_diameters, aspect_ratio=aspect_ratio, sum_over=sum_over, log=log, max_over=max_over)
+    def image():
+        # Only evaluated if someone is looking
+        image = record.data
+        sh = image.shape
+        if (image.ndim == 3):
+            image = image.reshape(sh[0]*sh[2], sh[1])
+        if mask is None:
+            # Copied by the outbox if it is not sent right away
+            return image
+        return image*mask
+    ipc.new_data(n, image, msg=msg, alert=alert, send_rate=send_rate, center=roi_center, diameters=roi_diameters, aspect_ratio=aspect_ratio, sum_over=sum_over, log=log, max_over=max_over)
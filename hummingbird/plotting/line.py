@@ -69,15 +69,22 @@ def plotHistogram(param, hmin=None, hmax=None, bins=100, label='', density=False
     if(not param.name in histograms):
         ipc.broadcast.init_data(name, data_type='vector', xlabel=label, vline=vline, history_length=history, group=group)
         histograms[param.name] = True
-    data = param.data
-    if mask is not None:
-        data = data[mask]
-    if log10:
-        data=np.log10(data)
-    if hmin is None: hmin = data.min()
-    if hmax is None: hmax = data.max()
-    H,B = np.histogram(data.flat, range=(hmin, hmax), bins=bins, density=density)
-    ipc.new_data(name, H, xmin=B.min(), xmax=B.max(), vline=vline)
+    def histogram():
+        data = param.data
+        if mask is not None:
+            data = data[mask]
+        if log10:
+            data=np.log10(data)
+        _hmin = data.min() if hmin is None else hmin
+        _hmax = data.max() if hmax is None else hmax
+        return np.histogram(data.flat, range=(_hmin, _hmax), bins=bins, density=density)
+    if hmin is None or hmax is None:
+        # The range is needed for the keywords
+        H,B = histogram()
+        ipc.new_data(name, H, xmin=B.min(), xmax=B.max(), vline=vline)
+    else:
+        # Only histogram if someone is looking
+        ipc.new_data(name, lambda: histogram()[0], xmin=hmin, xmax=hmax, vline=vline)
 
 traces = {}
 def plotTrace(paramY, paramX=None, label='', history=10000, tracelen=None, name=None, group=None):
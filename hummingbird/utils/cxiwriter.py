@@ -1,20 +1,296 @@
-try:
-    import h5writer
-except ImportError:
-    print(100*"*")
-    print("ERROR: For using the utils.cxiwriter.CXIWriter class please install the package \'h5writer\'.")
-    print("\t $ pip install h5writer")
-    print("\t (Github repository: https://github.com/mhantke/h5writer)")
-    print(100*"*")
-    exit(1)
-    
+# --------------------------------------------------------------------------------------
+# Copyright 2016, Benedikt J. Daurer, Filipe R.N.C. Maia, Max F. Hantke, Carl Nettelblad
+# Hummingbird is distributed under the terms of the Simplified BSD License.
+# -------------------------------------------------------------------------
+"""Writes stacks of data, such as the hits of a run, to CXI files.
+
+When running with MPI each rank writes a file of its own, next to the
+requested one, and at close the first rank writes the requested file,
+with virtual datasets joining the stacks of all the ranks.
+"""
+import logging
+import os
+import queue
+import threading
+
+import h5py
+import numpy
+
 from hummingbird import ipc
 
-logger = h5writer.logger
+logger = logging.getLogger('cxiwriter')
+
+# Chunks are kept below this size, in bytes
+CHUNK_BYTES = 16*1024*1024
+
+# Tells the writer to stop
+_STOP = object()
+
+
+class CXIWriter(object):
+    """Writes dictionaries of data to a CXI file, as slices of stacks
+    (:meth:`write_slice`) or as single datasets (:meth:`write_solo`).
+    Dictionaries within the dictionaries are written as groups.
+    On the master, which reads no events, nothing is written.
+
+    The slices are collected in batches of ``chunksize``, which are
+    written by a background thread, each dataset in one go.
+
+    Args:
+        :filename(str): Name of the file
+
+    Kwargs:
+        :chunksize(int):   Number of slices written together, which is also the
+                           length of the chunks as long as they stay below 16 MB
+        :compression(str): Compression filter of the stacks, e.g. 'gzip' or 'lzf'
+        :compression_opts: Options of the compression filter
+        :comm:             MPI communicator of the ranks writing. By default all
+                           the slaves write when running with more than 2 ranks.
+        :queuesize(int):   Number of batches waiting to be written before write_slice blocks
+    """
+    def __init__(self, filename, chunksize=100, compression=None, compression_opts=None,
+                 comm=None, queuesize=4):
+        self._filename = os.path.expandvars(filename)
+        self._thread = None
+        if comm is None and ipc.mpi.size > 2:
+            comm = ipc.mpi.slaves_comm
+        base, ext = os.path.splitext(self._filename)
+        self._comm = None
+        self._rank_filename = self._filename
+        if _is_null(comm) or (comm is None and ipc.mpi.is_master()):
+            # The master is not one of the ranks writing, it has no file
+            logger.debug("CXI writer for file %s is not used on the master", self._filename)
+            return
+        if comm is not None and comm.size > 1:
+            self._comm = comm
+            self._rank_filename = '%s_rank%03d%s' % (base, comm.rank, ext)
+        elif comm is None and ipc.mpi.nr_workers() > 1:
+            # Without a communicator to join them, every worker keeps a file of its own
+            self._rank_filename = '%s_rank%03d%s' % (base, ipc.mpi.rank, ext)
+        if os.path.exists(self._rank_filename):
+            logger.warning("File %s exists and is being overwritten", self._rank_filename)
+        self._f = h5py.File(self._rank_filename, 'w')
+        self._chunksize = max(1, int(chunksize))
+        self._dataset_kwargs = {}
+        if compression is not None:
+            self._dataset_kwargs['compression'] = compression
+            self._dataset_kwargs['compression_opts'] = compression_opts
+        # The batch being collected, as arrays by dataset name
+        self._batch = None
+        self._nbatch = 0
+        # The number of slices written, only used by the writer thread
+        self._length = 0
+        self._queue = queue.Queue(maxsize=max(1, int(queuesize)))
+        self._thread = threading.Thread(target=self._run)
+        # Make sure the program exits even when the thread is still running
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write_slice(self, data_dict):
+        """Write the data as the next slice of the stacks. All the slices
+        need the same datasets as the first one, which creates them."""
+        if self._thread is None:
+            return
+        items = _flatten(data_dict)
+        if self._batch is None:
+            self._batch = dict([(name, _new_stack(self._chunksize, value)) for name, value in items])
+        if len(items) != len(self._batch):
+            raise ValueError("The slices written to %s need the same datasets" % self._filename)
+        for name, value in items:
+            self._batch[name][self._nbatch] = value
+        self._nbatch += 1
+        if self._nbatch == self._chunksize:
+            self.flush()
+
+    def write_solo(self, data_dict):
+        """Write datasets which have no stack dimension"""
+        if self._thread is None:
+            return
+        self._queue.put(('solo', _flatten(data_dict)))
+
+    def flush(self):
+        """Hand the slices collected so far to the writer"""
+        if self._thread is None or not self._nbatch:
+            return
+        batch = [(name, values[:self._nbatch]) for name, values in sorted(self._batch.items())]
+        self._queue.put(('slices', batch))
+        self._batch = None
+        self._nbatch = 0
+
+    def close(self, barrier=True):
+        """Write what is left and close the file. With MPI all the
+        ranks writing need to close, as the first one then writes
+        the file joining the files of all the ranks."""
+        if self._thread is None:
+            return
+        self.flush()
+        self._queue.put(_STOP)
+        self._thread.join()
+        self._thread = None
+        stacks = [(name, ds.shape[1:], ds.dtype) for name, ds in _datasets(self._f) if _is_stack(ds)]
+        solos = [name for name, ds in _datasets(self._f) if not _is_stack(ds)]
+        self._f.close()
+        logger.info("CXI writer for file %s closed", self._rank_filename)
+        if self._comm is None:
+            return
+        ranks = self._comm.gather((self._rank_filename, self._length, stacks, solos), root=0)
+        if self._comm.rank == 0:
+            _write_master(self._filename, ranks)
+            logger.info("Joined the files of %d ranks in %s", len(ranks), self._filename)
+        if barrier:
+            self._comm.Barrier()
+
+    def _run(self):
+        """Write the batches until stopped"""
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                break
+            kind, items = item
+            try:
+                if kind == 'solo':
+                    self._write_solo(items)
+                else:
+                    self._write_slices(items)
+            except Exception: # pylint: disable=broad-except
+                logger.exception("Could not write to %s", self._rank_filename)
+        # Cut the stacks to the slices written
+        for name, ds in _datasets(self._f):
+            if _is_stack(ds):
+                ds.resize(self._length, axis=0)
+
+    def _write_solo(self, items):
+        for name, value in items:
+            if value is None:
+                logger.warning("Data %s is None! Skipping this item as we cannot write this data type.", name)
+            elif name in self._f:
+                logger.warning("Dataset %s already exists! Not writing it again.", name)
+            else:
+                self._f[name] = value
+
+    def _write_slices(self, items):
+        """Write a batch of slices, each dataset in one go"""
+        start = self._length
+        stop = start + len(items[0][1])
+        for name, values in items:
+            if name not in self._f:
+                self._create_stack(name, values)
+            ds = self._f[name]
+            if ds.shape[0] < stop:
+                # Grow geometrically, the stacks are cut when closing
+                ds.resize(max(stop, 2*ds.shape[0]), axis=0)
+            ds[start:stop] = values
+        self._length = stop
+
+    def _create_stack(self, name, values):
+        """Create the dataset of a stack of slices like values"""
+        shape = values.shape[1:]
+        dtype = values.dtype
+        if dtype.kind == 'O':
+            dtype = h5py.string_dtype()
+        # Batches fill whole chunks
+        rows = self._chunksize
+        slice_bytes = max(1, dtype.itemsize*int(numpy.prod(shape)))
+        while rows > 1 and (rows*slice_bytes > CHUNK_BYTES or self._chunksize % rows):
+            rows -= 1
+        logger.debug("Create dataset %s [shape=%s, chunks=%s, dtype=%s]", name, shape, (rows,)+shape, dtype)
+        ds = self._f.create_dataset(name, (0,)+shape, maxshape=(None,)+shape, dtype=dtype,
+                                    chunks=(rows,)+shape, **self._dataset_kwargs)
+        ds.attrs.modify('axes', [numpy.bytes_(_axes(len(shape)))])
+
+
+def _is_null(comm):
+    """Returns True if comm is the null communicator, which
+    the ranks not taking part in a communicator get"""
+    return comm is not None and ipc.mpi.MPI is not None and comm == ipc.mpi.MPI.COMM_NULL
+
+
+def _flatten(data_dict, prefix='/'):
+    """Returns the values in a dictionary of dictionaries, by their name in the file"""
+    items = []
+    for k in sorted(data_dict.keys()):
+        name = prefix + str(k)
+        if isinstance(data_dict[k], dict):
+            items.extend(_flatten(data_dict[k], name + '/'))
+        else:
+            items.append((name, data_dict[k]))
+    return items
+
+
+def _new_stack(length, value):
+    """Returns an empty stack of length slices like value"""
+    value = numpy.asarray(value)
+    if value.dtype.kind in 'SU':
+        # Written as variable length strings
+        return numpy.empty((length,)+value.shape, dtype=object)
+    return numpy.empty((length,)+value.shape, dtype=value.dtype)
+
+
+def _axes(ndim):
+    """Returns the CXI axes of a stack of slices with ndim dimensions"""
+    axes = "experiment_identifier"
+    if ndim == 1: axes = axes + ":x"
+    elif ndim == 2: axes = axes + ":y:x"
+    elif ndim == 3: axes = axes + ":z:y:x"
+    return axes
+
+
+def _datasets(group, prefix='/'):
+    """Returns the datasets in group and its subgroups, by name"""
+    items = []
+    for k in sorted(group.keys()):
+        if isinstance(group[k], h5py.Dataset):
+            items.append((prefix + k, group[k]))
+        else:
+            items.extend(_datasets(group[k], prefix + k + '/'))
+    return items
+
+
+def _is_stack(ds):
+    """Returns True if the dataset is a stack of slices"""
+    axes = ds.attrs.get('axes')
+    return axes is not None and numpy.asarray(axes)[0].decode('utf-8').startswith('experiment_identifier')
+
 
-if ipc.mpi.size <= 2:
-    CXIWriter = h5writer.H5Writer
-else:
-    class CXIWriter(h5writer.H5WriterMPISW):
-        def __init__(self, filename, chunksize=100, compression=None):
-            h5writer.H5WriterMPISW.__init__(self, filename=filename, chunksize=chunksize, compression=compression, comm=ipc.mpi.slaves_comm)
+def _write_master(filename, ranks):
+    """Write the file joining the stacks of the ranks, given as tuples
+    (filename, length, stacks, solos) of the files they wrote"""
+    with h5py.File(filename, 'w') as f:
+        total = sum([length for _, length, _, _ in ranks])
+        stacks = {}
+        for _, _, rank_stacks, _ in ranks:
+            for name, shape, dtype in rank_stacks:
+                stacks.setdefault(name, (shape, dtype))
+        for name, (shape, dtype) in sorted(stacks.items()):
+            if h5py.check_string_dtype(dtype) is not None:
+                # Virtual datasets cannot hold variable length strings
+                values = []
+                for rank_filename, length, rank_stacks, _ in ranks:
+                    if length and name in [n for n, _, _ in rank_stacks]:
+                        with h5py.File(rank_filename, 'r') as rf:
+                            values.extend(rf[name][:length])
+                f.create_dataset(name, data=numpy.array(values, dtype=object), dtype=dtype)
+            else:
+                layout = h5py.VirtualLayout(shape=(total,)+tuple(shape), dtype=dtype)
+                offset = 0
+                for rank_filename, length, rank_stacks, _ in ranks:
+                    if length and name in [n for n, _, _ in rank_stacks]:
+                        # Relative to the joining file, so that the files can be moved together
+                        source = h5py.VirtualSource(os.path.basename(rank_filename), name,
+                                                    shape=(length,)+tuple(shape))
+                        layout[offset:offset+length] = source
+                    offset += length
+                f.create_virtual_dataset(name, layout)
+            f[name].attrs.modify('axes', [numpy.bytes_(_axes(len(shape)))])
+        for rank_filename, _, _, solos in ranks:
+            with h5py.File(rank_filename, 'r') as rf:
+                for name in solos:
+                    if name not in f:
+                        rf.copy(rf[name], f.require_group(os.path.dirname(name)),
+                                name=os.path.basename(name))
@@ -5,26 +5,67 @@
 from __future__ import absolute_import  # Compatibility with python 2 and 3
 from __future__ import print_function
 
+import atexit
 import datetime
 import logging
 import os
-import time
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 import h5py
 import numpy as np
 
+# Tells the writer to stop
+_STOP = object()
+
 
 class Recorder:
-    def __init__(self, outpath, events, rank, maxEvents=1000):
+    """Records events to one HDF5 file per run and rank.
+
+    The events are collected in batches of ``batchSize`` events, which are
+    written by a background thread. Only when ``queueSize`` batches are
+    waiting to be written does :meth:`append` wait for the disk.
+    Call :meth:`close` when done, which also happens when the program exits.
+
+    Args:
+        :outpath(str):  Directory of the files, named hits_<run>_<rank>.h5
+        :events(dict):  The datasets to record, by name (which must be in a group),
+                        each as a tuple (type, key) of the record in the event
+        :rank(int):     Rank of the process
+
+    Kwargs:
+        :batchSize(int): Number of events written together
+        :queueSize(int): Number of batches waiting to be written before append blocks
+    """
+    def __init__(self, outpath, events, rank, maxEvents=1000, batchSize=100, queueSize=10):
         self.outpath = outpath
         self.maxlen = maxEvents
         self.events = events
         self.rank = rank
         self.index = 0
         self.current_run = -1
-        #self.create_file()
+        self.batch_size = batchSize
         self.perm_vars = ['LCLS/'+name for name in ['timestamp', 'fiducial', 'run']]
         self.perm_types = [np.uint64, np.int32, np.int32]
+        self.filename = None
+        # The batch being collected, as arrays by dataset name
+        self._batch = None
+        self._batch_filename = None
+        self._nbatch = 0
+        # Only used by the writer thread
+        self._file = None
+        self._filename = None
+        self._length = 0
+        self._queue = queue.Queue(maxsize=max(1, int(queueSize)))
+        self._thread = threading.Thread(target=self._run)
+        # Make sure the program exits even when the thread is still running
+        self._thread.daemon = True
+        self._thread.start()
+        atexit.register(self.close)
 
     def _timestamp(self):
         dt64 = np.datetime64(datetime.datetime.utcnow())
@@ -32,77 +73,140 @@ class Recorder:
         return timestamp
 
     def setup_file_if_needed(self, evt):
+        """Returns True if the event is recorded, that is if it is part of a run.
+        When the run changes the events collected so far are handed to the writer."""
         # Test whether it is a new run, non-run data counts as run 0
         run = evt["eventID"]['Timestamp'].run
         if run > 1000:
             run = 0
-        #if run == self.current_run:
-        #    return True
+        if run == self.current_run:
+            return self.filename is not None
+        self.flush()
         self.current_run = run
-        
+
         # Filename: hits_<run>_<rank>
-        if run:
-            self.filename = self.outpath + '/hits_%.3d_%.2d.h5' % (run, self.rank)
-        else:
+        self.filename = None
+        if not run:
             return False
-            #self.filename = self.outpath + '/hits_%.3d_%.2d.h5' % (run, self.rank)
-        if os.path.isfile(self.filename):
-            try:
-                file = h5py.File(self.filename, 'a')
-                self.index = len(file['LCLS/fiducial'][:])
-            except IOError:
-                print("Could not open file: ", self.filename)
-                return False
-        else:
-            try:
-                file = h5py.File(self.filename, 'a')
-            except IOError:
-                print("Could not open file: ", self.filename)
+        for key in self.events:
+            if os.path.dirname(key) == '':
+                logging.error('Record entries need to be in a group')
                 return False
-            print("Opened new file: ", self.filename)
-
-            file.create_group('LCLS')
-            for key,type in zip(self.perm_vars,self.perm_types):
-                axes = 'experiment_identifier:value'
-                file.create_dataset(key, (1,), maxshape=(None,), dtype=type)
-                file[key].attrs.modify('axes', [axes])
-            
-            for key,item in self.events.items():
-                group = os.path.dirname(key)
-                if group == '':
-                    logging.error('Record entries need to be in a group')
-                    return False
-                else:
-                    self.make_group(file, group)
-                
-                item_shape = evt[item[0]][item[1]].data.shape
-                item_type = evt[item[0]][item[1]].data.dtype
-                ndims = len(item_shape)
-                
-                axes = "experiment_identifier"
-                if ndims == 0: axes = 'experiment_identifier:value'
-                elif ndims == 1: axes = axes + ":x"
-                elif ndims == 2: axes = axes + ":y:x"
-                elif ndims == 3: axes = axes + ":z:y:x"
-                
-                file.create_dataset(key, (0,) + item_shape, maxshape=(None,) + item_shape, dtype=item_type, chunks=(1,)+item_shape)
-                file[key].attrs.modify('axes', [axes])
-            file.close()
+        self.filename = self.outpath + '/hits_%.3d_%.2d.h5' % (run, self.rank)
         return True
 
     def append(self, evt):
-        if self.setup_file_if_needed(evt):
-            with h5py.File(self.filename, 'a') as file:
-                file['LCLS/timestamp'].resize(self.index+1, axis=0)
-                file['LCLS/timestamp'][self.index] = evt["eventID"]["Timestamp"].timestamp2
-                file['LCLS/fiducial'].resize(self.index+1, axis=0)
-                file['LCLS/fiducial'][self.index] = evt["eventID"]["Timestamp"].fiducials
-                file['LCLS/run'].resize(self.index+1, axis=0)
-                file['LCLS/run'][self.index] = evt["eventID"]["Timestamp"].run
-                for key, item in self.events.items():
-                    file[key].resize(self.index+1, axis=0)
-                    file[key][self.index] = evt[item[0]][item[1]].data
-            self.index += 1
+        """Add the event to the batch, which is handed to the writer once full"""
+        if not self.setup_file_if_needed(evt):
+            return
+        values = [('LCLS/timestamp', evt["eventID"]["Timestamp"].timestamp2),
+                  ('LCLS/fiducial', evt["eventID"]["Timestamp"].fiducials),
+                  ('LCLS/run', evt["eventID"]["Timestamp"].run)]
+        for key, item in self.events.items():
+            values.append((key, np.asarray(evt[item[0]][item[1]].data)))
+        if self._batch is None:
+            self._batch = self._new_batch(values)
+            self._batch_filename = self.filename
+        for key, value in values:
+            self._batch[key][self._nbatch] = value
+        self._nbatch += 1
+        self.index += 1
+        if self._nbatch == self.batch_size:
+            self.flush()
+
+    def _new_batch(self, values):
+        """Returns empty arrays for a batch of events with values like the given ones"""
+        batch = {}
+        for (key, value), dtype in zip(values, self.perm_types):
+            batch[key] = np.empty(self.batch_size, dtype=dtype)
+        for key, value in values[len(self.perm_types):]:
+            batch[key] = np.empty((self.batch_size,) + value.shape, dtype=value.dtype)
+        return batch
+
+    def flush(self):
+        """Hand the events collected so far to the writer"""
+        if not self._nbatch:
+            return
+        batch = dict([(key, values[:self._nbatch]) for key, values in self._batch.items()])
+        if self._queue.full():
+            logging.warning("Recorder waiting for the disk, consider a larger queueSize")
+        self._queue.put((self._batch_filename, batch))
+        self._batch = None
+        self._nbatch = 0
+
+    def close(self):
+        """Write the events collected so far and close the file"""
+        if self._thread is None:
+            return
+        self.flush()
+        self._queue.put(_STOP)
+        self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        """Write the batches until stopped"""
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                break
+            filename, batch = item
+            try:
+                self._write(filename, batch)
+            except Exception: # pylint: disable=broad-except
+                logging.exception("Could not write %d events to %s",
+                                  len(batch['LCLS/run']), filename)
+        self._close_file()
+
+    def _open_file(self, filename, batch):
+        """Open the file, creating the datasets like the ones in batch if needed"""
+        self._close_file()
+        exists = os.path.isfile(filename)
+        self._file = h5py.File(filename, 'a')
+        self._filename = filename
+        if exists:
+            # Rows beyond the events counted were not completely written
+            self._length = int(self._file.attrs.get('nevents', len(self._file['LCLS/fiducial'])))
+            return
+        print("Opened new file: ", filename)
+        self._length = 0
+        for key, values in batch.items():
+            shape = values.shape[1:]
+            ndims = len(shape)
+            axes = "experiment_identifier"
+            if ndims == 0: axes = 'experiment_identifier:value'
+            elif ndims == 1: axes = axes + ":x"
+            elif ndims == 2: axes = axes + ":y:x"
+            elif ndims == 3: axes = axes + ":z:y:x"
+            # Chunks of about a MB, and no more than a batch
+            rows = max(1, min(self.batch_size, 1024*1024 // max(1, values[0].nbytes)))
+            self._file.create_dataset(key, (0,) + shape, maxshape=(None,) + shape,
+                                      dtype=values.dtype, chunks=(rows,) + shape)
+            self._file[key].attrs.modify('axes', [axes])
+
+    def _close_file(self):
+        """Cut the datasets to the events counted and close the file"""
+        if self._file is None:
+            return
+        for key in self.perm_vars + list(self.events.keys()):
+            self._file[key].resize(self._length, axis=0)
+        self._file.close()
+        self._file = None
+
+    def _write(self, filename, batch):
+        """Write a batch of events, each dataset in one go"""
+        if self._file is None or self._filename != filename:
+            self._open_file(filename, batch)
+        start = self._length
+        stop = start + len(batch['LCLS/run'])
+        for key, values in batch.items():
+            dataset = self._file[key]
+            # Only as far as the events written, in case we never get to close the file
+            dataset.resize(stop, axis=0)
+            dataset[start:stop] = values
+        # Counted once all the datasets are written
+        self._file.attrs['nevents'] = stop
+        self._file.flush()
+        self._length = stop
 
     def make_group(self, file, group_name):
         if group_name not in file:
@@ -18,7 +18,6 @@ with open(os.path.join(cwd, "hummingbird/__init__.py")) as f:
 
 install_requires = [
     'h5py',
-    'h5writer',
     'mpi4py',
     'numpy',
     'pexpect',
@@ -72,6 +71,11 @@ setup(
         ],
         "euxfel": [
             "karabo-bridge",
+        ],
+        "compression": [
+            "lz4",
+            "zstandard",
+            "blosc",
         ]
     },
     python_requires='>=3.8',
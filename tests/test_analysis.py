@@ -1,4 +1,5 @@
 import os, sys
+import h5py
 import numpy as np
 
 # Make sure we are relative to the root path
@@ -133,6 +134,112 @@ def test_countHitscore():
 #    evt = DummyTranslator(state).next_event()
 #    analysis.countPhotonsAgainstEnergyFunction(evt, )
 
+# Testing the recorder
+# --------------------
+
+# Testing that the events are written in batches, to one file per run
+def test_recorder(tmp_path):
+    from hummingbird.backend import Record
+    class Timestamp(object):
+        def __init__(self, run, i):
+            self.run, self.timestamp2, self.fiducials = run, i, 3*i
+    recorder = analysis.recorder.Recorder(str(tmp_path), {'analysis/image': ('analysis', 'image'),
+                                                          'analysis/size': ('analysis', 'size')},
+                                          0, batchSize=7)
+    for i in range(30):
+        evt = {'eventID': {'Timestamp': Timestamp(1 + i//20, i)},
+               'analysis': {'image': Record('image', np.full((4, 3), i, dtype=np.uint16)),
+                            'size': Record('size', 0.5*i)}}
+        recorder.append(evt)
+    recorder.close()
+    with h5py.File(str(tmp_path / 'hits_001_00.h5'), 'r') as f:
+        assert (f['LCLS/fiducial'][:] == 3*np.arange(20)).all()
+        assert f['analysis/image'].shape == (20, 4, 3)
+        assert f['analysis/image'].dtype == np.uint16
+        assert (f['analysis/image'][19] == 19).all()
+    with h5py.File(str(tmp_path / 'hits_002_00.h5'), 'r') as f:
+        assert (f['analysis/size'][:] == 0.5*np.arange(20, 30)).all()
+
+# Testing that the events of a file which was not closed are continued after the ones counted
+def test_recorder_reopen(tmp_path):
+    from hummingbird.backend import Record
+    class Timestamp(object):
+        def __init__(self, run, i):
+            self.run, self.timestamp2, self.fiducials = run, i, 3*i
+    with h5py.File(str(tmp_path / 'hits_001_00.h5'), 'w') as f:
+        for key, dtype in [('LCLS/timestamp', np.uint64), ('LCLS/fiducial', np.int32),
+                           ('LCLS/run', np.int32), ('analysis/size', np.float64)]:
+            f.create_dataset(key, (10,), maxshape=(None,), dtype=dtype)
+        f['LCLS/fiducial'][:4] = [1, 2, 3, 4]
+        f.attrs['nevents'] = 4
+    recorder = analysis.recorder.Recorder(str(tmp_path), {'analysis/size': ('analysis', 'size')},
+                                          0, batchSize=2)
+    for i in range(3):
+        recorder.append({'eventID': {'Timestamp': Timestamp(1, 10+i)},
+                         'analysis': {'size': Record('size', 0.5*i)}})
+    recorder.close()
+    with h5py.File(str(tmp_path / 'hits_001_00.h5'), 'r') as f:
+        assert (f['LCLS/fiducial'][:] == [1, 2, 3, 4, 30, 33, 36]).all()
+        assert f['analysis/size'].shape == (7,) and f.attrs['nevents'] == 7
+
+# Testing that the CXI writer keeps the slices in order, across batches
+def test_cxiwriter(tmp_path):
+    from hummingbird.utils import cxiwriter
+    filename = str(tmp_path / 'hits.cxi')
+    W = cxiwriter.CXIWriter(filename, chunksize=4, compression='gzip')
+    for i in range(10):
+        W.write_slice({'entry_1': {'data_1': {'data': np.full((3, 2), i, dtype=np.int16)}, 'index': i}})
+    W.write_solo({'entry_1': {'run': 7}})
+    W.close()
+    with h5py.File(filename, 'r') as f:
+        data = f['entry_1/data_1/data']
+        assert data.shape == (10, 3, 2) and data.dtype == np.int16
+        assert data.chunks == (4, 3, 2)
+        assert (data[:, 0, 0] == np.arange(10)).all()
+        assert (f['entry_1/index'][:] == np.arange(10)).all()
+        assert f['entry_1/run'][()] == 7
+
+# Testing that the files of the ranks are joined with virtual datasets
+def test_cxiwriter_join(tmp_path):
+    from hummingbird.utils import cxiwriter
+    ranks = []
+    for rank in range(2):
+        filename = str(tmp_path / ('hits_rank%03d.cxi' % rank))
+        W = cxiwriter.CXIWriter(filename, chunksize=4)
+        for i in range(3+rank):
+            W.write_slice({'data': np.full(5, 10*rank+i)})
+        W.close()
+        ranks.append((filename, 3+rank, [('/data', (5,), np.dtype(int))], []))
+    cxiwriter._write_master(str(tmp_path / 'hits.cxi'), ranks)
+    with h5py.File(str(tmp_path / 'hits.cxi'), 'r') as f:
+        assert f['data'].is_virtual
+        assert f['data'][:, 0].tolist() == [0, 1, 2, 10, 11, 12, 13]
+
+# Testing that the master writes nothing and that local workers write files of their own
+def test_cxiwriter_local(tmp_path, monkeypatch):
+    from hummingbird import ipc
+    from hummingbird.ipc import local
+    from hummingbird.utils import cxiwriter
+    filename = str(tmp_path / 'hits.cxi')
+    monkeypatch.setattr(ipc.mpi, 'use_mpi', True)
+    monkeypatch.setattr(ipc.mpi, 'size', 3)
+    monkeypatch.setattr(ipc.mpi, 'slaves_comm', None)
+    monkeypatch.setattr(ipc.mpi, 'slaves_group', local.LocalGroup([1, 2], 0))
+    for rank in range(3):
+        monkeypatch.setattr(ipc.mpi, 'rank', rank)
+        W = cxiwriter.CXIWriter(filename, chunksize=4)
+        W.write_slice({'data': np.full(5, rank)})
+        W.write_solo({'run': 7})
+        W.close()
+    assert sorted(os.listdir(str(tmp_path))) == ['hits_rank001.cxi', 'hits_rank002.cxi']
+    with h5py.File(str(tmp_path / 'hits_rank002.cxi'), 'r') as f:
+        assert f['data'][:, 0].tolist() == [2]
+    if ipc.mpi.MPI is not None:
+        W = cxiwriter.CXIWriter(str(tmp_path / 'null.cxi'), comm=ipc.mpi.MPI.COMM_NULL)
+        W.write_slice({'data': np.zeros(5)})
+        W.close()
+        assert not os.path.exists(str(tmp_path / 'null.cxi'))
+
 # Remove traces from testing the analysis modules
 def teardown_module():
     sys.path.pop(0)
@@ -0,0 +1,347 @@
+import os, sys
+import threading
+import time
+import types
+
+import numpy as np
+
+# Make sure we are relative to the root path
+__thisdir__ = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, __thisdir__)
+
+from hummingbird.backend import EventTranslator, Record
+from hummingbird.backend.event_translator import translator_lock
+from hummingbird.backend.prefetcher import EventPrefetcher, on_main_thread
+
+
+class CountingTranslator(object):
+    """Returns the events 0, 1, ..., n-1, then None, and raises
+    the given exception instead of returning event number fail"""
+    def __init__(self, n, fail=None, exception=None):
+        self.n = n
+        self.i = 0
+        self.fail = fail
+        self.exception = exception
+        self.translated = []
+
+    def next_event(self):
+        if self.i == self.fail:
+            raise self.exception
+        if self.i >= self.n:
+            return None
+        self.i += 1
+        return EventTranslator({'number': self.i-1}, self)
+
+    def translate(self, evt, key):
+        self.translated.append((evt['number'], key))
+        return evt['number']
+
+
+# Testing the prefetching of events
+# -----------------------------------
+
+# Testing that the events come in order, followed by None for good
+def test_prefetcher_order():
+    prefetcher = EventPrefetcher(CountingTranslator(20), 3)
+    events = [prefetcher.next_event() for i in range(20)]
+    assert [evt._evt['number'] for evt in events] == list(range(20))
+    assert prefetcher.next_event() is None
+    assert prefetcher.next_event() is None
+    assert prefetcher.stop() == []
+
+# Testing that the keys asked for are translated on the prefetching thread
+def test_prefetcher_keys():
+    translator = CountingTranslator(5)
+    prefetcher = EventPrefetcher(translator, 10, keys=['photons'])
+    while prefetcher.qsize() < 5:
+        time.sleep(0.01)
+    assert translator.translated == [(i, 'photons') for i in range(5)]
+    evt = prefetcher.next_event()
+    assert evt['photons'] == 0
+    assert len(translator.translated) == 5
+    prefetcher.stop()
+
+# Testing that an exception of the translator reaches the event loop after the events before it
+def test_prefetcher_exception():
+    prefetcher = EventPrefetcher(CountingTranslator(10, fail=2, exception=ValueError('broken')), 5)
+    assert prefetcher.next_event()._evt['number'] == 0
+    assert prefetcher.next_event()._evt['number'] == 1
+    try:
+        prefetcher.next_event()
+        assert False
+    except ValueError as e:
+        assert str(e) == 'broken'
+    assert prefetcher.next_event() is None
+
+# Testing that stopping returns the events read but not handed out
+def test_prefetcher_stop():
+    prefetcher = EventPrefetcher(CountingTranslator(100), 4)
+    assert prefetcher.next_event()._evt['number'] == 0
+    while prefetcher.qsize() < 4:
+        time.sleep(0.01)
+    events = prefetcher.stop()
+    # Up to one more event was being put in the queue when stopping
+    numbers = [evt._evt['number'] for evt in events]
+    assert numbers[:4] == [1, 2, 3, 4]
+    assert len(numbers) <= 5
+
+# Testing that stopping waits for the event being read, however long it takes
+def test_prefetcher_stop_reading():
+    reading = threading.Event()
+    release = threading.Event()
+    class Translator(CountingTranslator):
+        def next_event(self):
+            if self.i == 1:
+                reading.set()
+                release.wait()
+            return CountingTranslator.next_event(self)
+    prefetcher = EventPrefetcher(Translator(5), 4)
+    assert prefetcher.next_event()._evt['number'] == 0
+    reading.wait()
+    timer = threading.Timer(1.5, release.set)
+    timer.start()
+    events = prefetcher.stop()
+    assert not prefetcher._thread.is_alive()
+    assert [evt._evt['number'] for evt in events] == [1]
+    timer.join()
+
+# Testing that the data of the keys asked for is read on the prefetching thread
+def test_prefetcher_decode():
+    threads = []
+    class Translator(CountingTranslator):
+        def translate(self, evt, key):
+            return {'frame': Record('frame', lambda: threads.append(threading.current_thread()))}
+    prefetcher = EventPrefetcher(Translator(1), 2, keys=['photons'])
+    evt = prefetcher.next_event()
+    assert len(threads) == 1 and threads[0] is not threading.current_thread()
+    evt['photons']['frame'].data
+    assert len(threads) == 1
+    prefetcher.stop()
+
+# Testing that calls on the main thread are done by the event loop
+def test_prefetcher_main_thread():
+    threads = []
+    class Translator(CountingTranslator):
+        def next_event(self):
+            on_main_thread(lambda: threads.append(threading.current_thread()))
+            return CountingTranslator.next_event(self)
+    prefetcher = EventPrefetcher(Translator(3), 2)
+    assert [prefetcher.next_event()._evt['number'] for i in range(3)] == [0, 1, 2]
+    assert prefetcher.next_event() is None
+    assert threads == [threading.current_thread()]*4
+
+
+# Testing the LCLS translator, without psana
+# ------------------------------------------
+
+def fake_psana():
+    """Returns a module with the psana types the translator knows"""
+    psana = types.ModuleType('psana')
+    for module, names in {'Bld': ['BldDataFEEGasDetEnergy', 'BldDataFEEGasDetEnergyV1'] +
+                                 ['BldDataEBeamV%d' % i for i in range(1, 8)],
+                          'Lusi': ['IpmFexV1'], 'Camera': ['FrameV1'], 'CsPad': ['DataV2'],
+                          'CsPad2x2': ['ElementV1'], 'PNCCD': ['FullFrameV1', 'FramesV1'],
+                          'Acqiris': ['DataDescV1', 'ConfigV1'],
+                          'EvrData': ['DataV3', 'DataV4']}.items():
+        setattr(psana, module, types.SimpleNamespace(**dict([(n, type(n, (), {})) for n in names])))
+    psana.EventId = type('EventId', (), {})
+    return psana
+
+# Returns the LCLS module, imported with a fake psana if there is none,
+# which is forgotten again after the test
+def lcls_module(monkeypatch):
+    import importlib
+    import hummingbird.backend
+    try:
+        import psana # pylint: disable=unused-import
+    except ImportError:
+        monkeypatch.setitem(sys.modules, 'psana', fake_psana())
+        monkeypatch.setitem(sys.modules, 'hummingbird.backend.lcls', None)
+        monkeypatch.setattr(hummingbird.backend, 'lcls', None, raising=False)
+        del sys.modules['hummingbird.backend.lcls']
+    return importlib.import_module('hummingbird.backend.lcls')
+
+# Returns a translator with the translations set up, but no data source
+def lcls_translator(monkeypatch):
+    lcls = lcls_module(monkeypatch)
+    translator = lcls.LCLSTranslator.__new__(lcls.LCLSTranslator)
+    psana = lcls.psana
+    translator._n2c = {psana.Camera.FrameV1: 'camera', psana.EventId: 'eventID',
+                       psana.PNCCD.FullFrameV1: 'photonPixelDetectors', psana.CsPad.DataV2: 'photonPixelDetectors'}
+    translator._translators = {psana.Camera.FrameV1: translator._tr_camera,
+                               psana.PNCCD.FullFrameV1: translator._tr_pnccdFullFrame}
+    translator._s2c = {'pnccd': 'pnccdFront', 'acq': 'Acqiris 0'}
+    translator._run_keys = None
+    translator._run_keys_run = None
+    translator._last_event = threading.local()
+    translator._unsupported = set()
+    translator._acqiris_configs = {}
+    return translator
+
+class FakeKey(object):
+    """The key of some data in a psana event"""
+    def __init__(self, type_, src):
+        self._type = type_
+        self._src = src
+    def type(self):
+        return self._type
+    def src(self):
+        return self._src
+    def key(self):
+        return ''
+
+class FakeEvent(object):
+    """A psana event of the given run, with the given objects by key"""
+    def __init__(self, run, objects):
+        self.run = run
+        self.objects = objects
+        self.keys_read = 0
+        self.event_id = types.SimpleNamespace(run=lambda: self.run)
+    def keys(self):
+        self.keys_read += 1
+        return list(self.objects.keys())
+    def get(self, type_, src=None, key=None):
+        if src is None:
+            return self.event_id
+        return [o for k, o in self.objects.items() if k.type() is type_ and k.src() == src][0]
+
+class FakeFrame(object):
+    """A pnCCD frame, which notes whether the translator lock is held when read"""
+    def __init__(self):
+        self.locked = None
+    def data(self):
+        self.locked = translator_lock._is_owned()
+        return [[1, 2], [3, 4]]
+
+# Testing that the keys are looked up once per event, and again when the detectors change
+def test_lcls_keys(monkeypatch):
+    translator = lcls_translator(monkeypatch)
+    psana = lcls_module(monkeypatch).psana
+    pnccd = FakeKey(psana.PNCCD.FullFrameV1, 'pnccd')
+    evt = FakeEvent(1, {FakeKey(psana.EventId, 'evr'): None, pnccd: FakeFrame(),
+                        FakeKey(psana.CsPad.DataV2, 'cspad'): None})
+    keys = translator._keys_of_run(evt)
+    assert [k for k, f in keys['photonPixelDetectors']] == [pnccd]
+    for i in range(3):
+        assert translator._keys_of_run(evt) is keys
+    assert evt.keys_read == 1
+    assert psana.CsPad.DataV2 in translator._unsupported
+    other = FakeEvent(1, {FakeKey(psana.Camera.FrameV1, 'opal'): None})
+    assert list(translator._keys_of_run(other).keys()) == ['camera']
+    assert translator._keys_of_run(FakeEvent(1, dict(evt.objects))) is not keys
+
+# Testing that psana is only called holding the translator lock when lazy Records are read
+def test_lcls_lazy_locked(monkeypatch):
+    translator = lcls_translator(monkeypatch)
+    psana = lcls_module(monkeypatch).psana
+    frame = FakeFrame()
+    evt = FakeEvent(1, {FakeKey(psana.PNCCD.FullFrameV1, 'pnccd'): frame})
+    values = translator.translate_core(evt, 'photonPixelDetectors')
+    assert frame.locked is None
+    assert values['pnccdFrontfullFrame'].data == [[1, 2], [3, 4]]
+    assert frame.locked
+
+class FakeAcqirisConfig(object):
+    """The configuration store of a data source, with one Acqiris of two channels,
+    which counts how often it is read"""
+    def __init__(self):
+        self.read = 0
+    def get(self, type_, src):
+        self.read += 1
+        verts = [types.SimpleNamespace(slope=lambda: 2., offset=lambda: 1.),
+                 types.SimpleNamespace(slope=lambda: .5, offset=lambda: 0.)]
+        return types.SimpleNamespace(vert=lambda: verts,
+                                     horiz=lambda: types.SimpleNamespace(sampInterval=lambda: 1e-9))
+
+class FakeAcqiris(object):
+    """The data of an Acqiris, with ramps of int16 samples"""
+    def data_shape(self):
+        return [2]
+    def data(self, i):
+        waveform = np.arange(4, dtype=np.int16)*(i+1)
+        return types.SimpleNamespace(nbrSamplesInSeg=lambda: len(waveform), waveforms=lambda: [waveform],
+                                     timestamp=lambda: [types.SimpleNamespace(value=lambda: 5.)])
+
+# Testing that the Acqiris configuration is read once per run, and that the waveforms are float32 volts
+def test_lcls_acqiris_config(monkeypatch):
+    translator = lcls_translator(monkeypatch)
+    psana = lcls_module(monkeypatch).psana
+    store = FakeAcqirisConfig()
+    translator.data_source = types.SimpleNamespace(env=lambda: types.SimpleNamespace(configStore=lambda: store))
+    key = FakeKey(psana.Acqiris.DataDescV1, 'acq')
+    translator._keys_of_run(FakeEvent(1, {key: None}))
+    for i in range(3):
+        values = {}
+        translator._tr_acqiris(values, FakeAcqiris(), key)
+    assert store.read == 1
+    assert values['Acqiris 0 Channel 0'].data.tolist() == [-1., 1., 3., 5.]
+    assert values['Acqiris 0 Channel 1'].data.tolist() == [0., 1., 2., 3.]
+    assert values['Acqiris 0 Channel 1'].data.dtype == np.float32
+    assert np.allclose(values['Acqiris 0 Channel 1'].time, 5. + 1e-9*np.arange(4))
+    # Other keys in the same run keep the configuration, a new run reads it again
+    translator._keys_of_run(FakeEvent(1, {key: None, FakeKey(psana.EventId, 'evr'): None}))
+    translator._tr_acqiris({}, FakeAcqiris(), key)
+    assert store.read == 1
+    translator._keys_of_run(FakeEvent(2, {key: None}))
+    translator._tr_acqiris({}, FakeAcqiris(), key)
+    assert store.read == 2
+
+class FakeDetector(object):
+    """A psana detector of 3x4 int16 pixels, whose run changes after event 2,
+    which notes when its calibration constants are read"""
+    def __init__(self):
+        self.read = []
+    def raw(self, evt):
+        return (np.arange(12, dtype=np.int16)*evt).reshape(3, 4)
+    def runnum(self, evt):
+        return 1 if evt <= 2 else 2
+    def pedestals(self, evt):
+        self.read.append(('pedestals', self.runnum(evt)))
+        return np.ones((3, 4))
+    def gain(self, evt):
+        self.read.append(('gain', self.runnum(evt)))
+        return np.full((3, 4), 2.)
+    def common_mode_apply(self, rnum, data, cmpars=None):
+        data -= 1
+
+# Testing that the calibration constants are read once per run, and that the data is float32
+def test_lcls_calibration_constants(monkeypatch):
+    lcls = lcls_module(monkeypatch)
+    det = FakeDetector()
+    calibrate = lcls._Calibration(*lcls._CALIB_STEPS['calib_gc'])
+    for evt in range(1, 5):
+        data = calibrate(det, evt)
+        assert data.dtype == np.float32 and data.flags.c_contiguous
+    assert det.read == [('pedestals', 1), ('gain', 1), ('pedestals', 2), ('gain', 2)]
+    raw = lcls._Calibration(*lcls._CALIB_STEPS['raw'])
+    assert raw(det, 2).dtype == np.float32
+    assert raw(det, 2).tolist() == det.raw(2).tolist()
+    assert det.read == [('pedestals', 1), ('gain', 1), ('pedestals', 2), ('gain', 2)]
+
+# Testing that the pedestals, common mode and gain are corrected in place, into the same array
+def test_lcls_calibration_correction(monkeypatch):
+    lcls = lcls_module(monkeypatch)
+    det = FakeDetector()
+    raw = det.raw(2).astype(np.float32)
+    expected = {'raw': raw, 'calib_pc': raw - 1, 'calib_cmc': raw - 2, 'calib_gc': (raw - 2)*2}
+    for method, data in expected.items():
+        calibrate = lcls._Calibration(*lcls._CALIB_STEPS[method], buffers=1)
+        calibrate(det, 1)
+        assert calibrate(det, 2).tolist() == data.tolist()
+        assert calibrate._buffers[0].tolist() == data.tolist()
+
+# Testing that the buffers are reused in turn, but not while a Record still refers to one
+def test_lcls_calibration_buffers(monkeypatch):
+    lcls = lcls_module(monkeypatch)
+    det = FakeDetector()
+    calibrate = lcls._Calibration(*lcls._CALIB_STEPS['calib_pc'], buffers=2)
+    ids = [id(calibrate(det, evt)) for evt in range(1, 5)]
+    assert ids[0] == ids[2] and ids[1] == ids[3] and ids[0] != ids[1]
+    record = Record('pnccdFront', calibrate(det, 1))
+    view = calibrate(det, 2)[1:]
+    kept = record.data.tolist(), view.tolist()
+    for evt in range(3, 6):
+        data = calibrate(det, evt)
+        assert data is not record.data and data.base is not view.base
+    assert (record.data.tolist(), view.tolist()) == kept
+    assert len(calibrate._buffers) == 2
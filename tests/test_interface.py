@@ -0,0 +1,363 @@
+import os, sys
+import json
+import threading
+import h5py
+import numpy as np
+import zmq
+
+# Make sure we are relative to the root path
+__thisdir__ = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, __thisdir__)
+
+from hummingbird.interface.data_source import DataSource
+from hummingbird.interface.decoder import BroadcastDecoder
+from hummingbird.interface.memory import History, MemoryManager, spill
+from hummingbird.interface.plotdata import PlotData
+from hummingbird.interface.recorder import H5Recorder
+from hummingbird.interface.ringbuffer import RingBuffer, RingBufferStr, RingBufferView
+from hummingbird.interface.ui.image_view import ImageView
+from hummingbird.interface.ui.plot_window import Envelope, Histogram, NormalizedHistogram, decimate
+from hummingbird.interface.zmqsocket import decode_broadcast
+from hummingbird.ipc import framing
+
+
+# Testing the ring buffers
+# ------------------------
+
+# Testing that the newest values are kept, oldest first
+def test_ringbuffer_append():
+    rb = RingBuffer(5)
+    for i in range(7):
+        rb.append(float(i))
+    assert (np.asarray(rb) == [2, 3, 4, 5, 6]).all()
+    assert rb[-1] == 6 and rb[0] == 2
+    assert rb.number_of_added_elements == 7
+
+# Testing that snapshots do not change, apart from losing overwritten values
+def test_ringbuffer_snapshot():
+    rb = RingBuffer(5)
+    for i in range(5):
+        rb.append(np.full((2, 2), i))
+    view = rb.snapshot()
+    rb.append(np.full((2, 2), 5))
+    assert view.shape == (5, 2, 2)
+    assert (np.asarray(view)[:, 0, 0] == [1, 2, 3, 4]).all()
+    assert view[-1][0, 0] == 4
+    assert (view[-2:, 0, 0] == [3, 4]).all()
+
+# Testing that single values which got overwritten are not returned
+def test_ringbuffer_overwritten_value():
+    rb = RingBuffer(1)
+    rb.append(np.full((2, 2), 0))
+    view = rb.snapshot()
+    # The next value is being written
+    rb._writing = 1
+    try:
+        view[0]
+        assert False
+    except IndexError:
+        pass
+    rb = RingBuffer(3)
+    for i in range(3):
+        rb.append(float(i))
+    view = rb.snapshot()
+    for i in range(3, 5):
+        rb.append(float(i))
+    assert view[0] == 2
+    assert len(view) == 1
+
+# Testing that aligned snapshots stay the same length
+def test_ringbuffer_align():
+    x, y = RingBuffer(3), RingBuffer(3)
+    for i in range(4):
+        y.append(float(i))
+        x.append(float(i))
+    y.append(4.)
+    views = [x.snapshot(), y.snapshot()]
+    RingBufferView.align(views)
+    y.append(5.)
+    assert (np.asarray(views[0]) == np.asarray(views[1])).all()
+
+# Testing that buffers saved by the earlier versions can be restored
+def test_ringbuffer_restore():
+    old = {'data': np.array([0, 1, 2, 9, 0, 1, 2, 9.]), 'index': 3, 'len': 3, 'maxlen': 4}
+    assert (np.asarray(RingBuffer.restore_state(old)) == [0, 1, 2]).all()
+    old = {'data': ['c', 'a', 'b'], 'index': 1, 'len': 3, 'maxlen': 3}
+    assert RingBufferStr.restore_state(old).snapshot().copy() == ['a', 'b', 'c']
+    rb = RingBuffer(3)
+    for i in range(5):
+        rb.append(float(i))
+    assert (np.asarray(RingBuffer.restore_state(rb.save_state())) == [2, 3, 4]).all()
+
+# Testing that the version of the plot data changes with the data
+def test_plotdata_version():
+    class Parent(object):
+        conf = {}
+        subscribed_titles = []
+    pd = PlotData(Parent(), 'pe')
+    version = pd.version
+    pd.append(1., 0., '')
+    assert pd.version > version
+    version = pd.version
+    pd.snapshot()
+    assert pd.version == version
+    pd.clear()
+    assert pd.version > version
+
+# Testing that scalars sent together are appended one by one, with their messages
+def test_data_source_batch():
+    class Source(object):
+        conf = {'pe': {'data_type': 'scalar'}}
+        subscribed_titles = []
+        _lock = threading.Lock()
+    source = Source()
+    source._plotdata = {'pe': PlotData(source, 'pe')}
+    DataSource._process_broadcast(source, [None, 'new_data_batch', 'pe', np.array([1., 2., 3.]),
+                                           np.array([10., 11., 12.]), {'unit': 'mJ'}, ['a', None, 'c']])
+    pd = source._plotdata['pe']
+    assert list(pd.y) == [1., 2., 3.] and list(pd.x) == [10., 11., 12.]
+    assert list(pd.l) == ['a', '', 'c']
+    assert source.conf['pe']['unit'] == 'mJ'
+
+# Testing that scalars sent together are added up when asked to
+def test_data_source_batch_sum():
+    class Source(object):
+        conf = {'pe': {'data_type': 'scalar'}}
+        subscribed_titles = []
+        _lock = threading.Lock()
+    source = Source()
+    source._plotdata = {'pe': PlotData(source, 'pe')}
+    DataSource._process_broadcast(source, [None, 'new_data_batch', 'pe', np.array([1., 2., 6.]),
+                                           np.array([10., 11., 12.]), {'sum_over': True}, [None]*3])
+    pd = source._plotdata['pe']
+    assert list(pd.y) == [3.] and list(pd.x) == [12.]
+
+# Testing that data arriving for a title whose plot data is gone is dropped
+def test_data_source_removed_title():
+    class Source(object):
+        conf = {'pe': {'data_type': 'scalar'}}
+        subscribed_titles = []
+        _lock = threading.Lock()
+        _plotdata = {}
+        def name(self):
+            return 'source'
+    DataSource._process_broadcast(Source(), [None, 'new_data', 'pe', 1., 10., {}])
+
+
+# Testing the memory budget of the histories
+# ------------------------------------------
+
+class _PlotData(object):
+    def __init__(self, title, displayed, last_used):
+        self.title = title
+        self.displayed = displayed
+        self.last_used = last_used
+        self.evicted = False
+    def evict(self):
+        self.evicted = True
+        return True
+
+# Testing that histories which do not fit keep their newest frames in memory, the rest on disk
+def test_memory_spill():
+    manager = MemoryManager(budget=1000)
+    pd = _PlotData('a', True, 0)
+    assert not isinstance(manager.allocate(pd, (10, 10), np.float64), (np.memmap, History))
+    assert manager.used == 800
+    assert isinstance(manager.allocate(_PlotData('b', True, 0), (10, 10), np.float64), History)
+    assert manager.used == 960
+    assert isinstance(manager.allocate(_PlotData('c', True, 0), (10, 30), np.float64), np.memmap)
+    manager.release(pd)
+    assert manager.used == 160
+
+# Testing that a ring buffer keeps its values in a history split between memory and disk
+def test_memory_history():
+    rb = RingBuffer(5, lambda shape, dtype: History(shape, dtype, 2))
+    for i in range(8):
+        rb.append(np.full((2, 2), i))
+    history = rb._state[0]
+    assert sorted(history._frame) == [1, 2]
+    assert (np.asarray(rb)[:, 0, 0] == [3, 4, 5, 6, 7]).all()
+    assert rb[-1][0, 0] == 7 and rb[0][0, 0] == 3
+    assert (rb[1:4, 1, 1] == [4, 5, 6]).all()
+    rb.resize(3)
+    assert (np.asarray(rb)[:, 0, 0] == [5, 6, 7]).all()
+
+# Testing that histories on disk are read in place, unless they wrap around
+def test_memory_read_in_place():
+    rb = RingBuffer(4, spill)
+    for i in range(3):
+        rb.append(np.full((2, 2), i))
+    values = rb.snapshot().copy()
+    assert isinstance(values, np.memmap) and not values.flags.writeable
+    assert (values[:, 0, 0] == [0, 1, 2]).all()
+    for i in range(3, 6):
+        rb.append(np.full((2, 2), i))
+    values = rb.snapshot().copy()
+    assert not isinstance(values, np.memmap)
+    assert (values[:, 0, 0] == [2, 3, 4, 5]).all()
+
+# Testing that the least recently used hidden histories are dropped first
+def test_memory_evict():
+    manager = MemoryManager(budget=1000)
+    old = _PlotData('old', False, 1)
+    new = _PlotData('new', False, 2)
+    manager.allocate(old, (40,), np.float64)
+    manager.allocate(new, (40,), np.float64)
+    manager.allocate(_PlotData('c', True, 3), (50,), np.float64)
+    assert old.evicted and not new.evicted
+    assert manager.used == 720
+
+
+# Testing the histograms of the plot windows
+# ------------------------------------------
+
+# Testing that only the new values are counted, and that rebinning keeps the counts
+def test_histogram():
+    rb = RingBuffer(10)
+    hist = Histogram(0, 4, 4)
+    for v in [0.5, 1.5, 1.5, -1, 4, np.nan]:
+        rb.append(v)
+    hist.add_values_from_ringbuffer(rb.snapshot())
+    rb.append(3.5)
+    hist.add_values_from_ringbuffer(rb.snapshot())
+    assert (hist.values_y == [1, 2, 0, 1]).all()
+    hist.rebin(0, 4, 2)
+    assert (hist.values_y == [3, 1]).all()
+
+# Testing that the weights are averaged per bin
+def test_normalized_histogram():
+    rb = RingBuffer(10)
+    hist = NormalizedHistogram(0, 2, 2)
+    for v, w in [(0.5, 1), (0.5, 3), (1.5, 2)]:
+        rb.append(np.array([v, w], dtype=np.float64))
+    hist.add_values_from_ringbuffer(rb.snapshot())
+    assert (hist.values_y == [2, 2]).all()
+    hist.rebin(0, 2, 1)
+    assert (hist.values_y == [2]).all()
+
+
+# Testing the decimation of long histories
+# ----------------------------------------
+
+# Testing that the extremes are kept, with at most two points per pixel
+def test_decimate():
+    y = np.sin(np.arange(1000)/10.)
+    x, dy = decimate(np.arange(1000), y, 50)
+    assert len(dy) <= 100
+    assert dy.min() == y.min() and dy.max() == y.max()
+    assert (np.diff(x) > 0).all()
+
+# Testing that the envelope follows the buffer as values are added and overwritten
+def test_envelope():
+    xb, yb = RingBuffer(500), RingBuffer(500)
+    envelope = Envelope()
+    for i in range(2000):
+        xb.append(float(i))
+        yb.append(np.sin(i/7.))
+        if i % 37 == 0:
+            envelope.update(xb.snapshot(), yb.snapshot(), 20)
+    envelope.update(xb.snapshot(), yb.snapshot(), 20)
+    x, y = envelope.points()
+    assert len(y) <= 44
+    assert x[0] >= np.asarray(xb)[0]
+    assert y.min() == np.asarray(yb).min() and y.max() == np.asarray(yb).max()
+    assert envelope.monotonic
+    xb.append(0.)
+    yb.append(0.)
+    envelope.update(xb.snapshot(), yb.snapshot(), 20)
+    assert not envelope.monotonic
+
+
+# Testing the image display
+# -------------------------
+
+# Testing that the levels are estimated from the newest image alone, leaving out NaNs
+def test_image_levels():
+    rb = RingBuffer(3)
+    rb.append(np.full((600, 400), 5.))
+    image = np.arange(240000, dtype=np.float64).reshape(600, 400)
+    image[0, 0] = np.nan
+    rb.append(image)
+    view = rb.snapshot()
+    assert view.ndim == 3
+    levels = ImageView.quickLevels(view, (1,))
+    assert levels == sorted(levels)
+    assert levels[0] > 0 and levels[-1] < 240000 and levels[-1] > 230000
+    assert ImageView.quickLevels(np.full((4, 4), np.nan)) == [0., 0., 1., 1.]
+
+# Testing that the trends read in small chunks agree with numpy
+def test_image_trend():
+    rb = RingBuffer(7)
+    images = np.random.rand(10, 5, 3)
+    for image in images:
+        rb.append(image)
+    view = rb.snapshot()
+    for name in ['mean', 'median', 'std', 'min', 'max']:
+        expected = getattr(np, name)(images[-7:], axis=0)
+        assert np.allclose(ImageView.trend(view, name, chunk_bytes=300), expected), name
+
+
+# Testing the decoding of the broadcasts
+# --------------------------------------
+
+# Testing that both encodings are decoded from the received frames
+def test_decode_broadcast():
+    image = np.arange(6, dtype=np.float32).reshape(2, 3)
+    data = [None, 'new_data', 'CCD', image, 1.5, {}]
+    md = {'dtype': 'float32', 'shape': [2, 3], 'strides': list(image.strides)}
+    items = ['__ndarray__' if i == 3 else d for i, d in enumerate(data)]
+    frames = [b'key', json.dumps(items).encode('UTF-8'), json.dumps(md).encode('UTF-8'), image.tobytes()]
+    decoded = decode_broadcast([zmq.Frame(f) for f in frames])
+    assert (decoded[3] == image).all() and decoded[4] == 1.5
+    frames = [framing.key(b'0123456789abcdef')] + framing.encode(list(data), 'CCD')
+    decoded = decode_broadcast([zmq.Frame(bytes(f)) for f in frames])
+    assert (decoded[3] == image).all() and decoded[2] == 'CCD'
+
+# Testing that the broadcasts of each key are handled in order
+def test_decoder_order():
+    received = {}
+    done = threading.Event()
+    def handler(frames):
+        received.setdefault(frames[0], []).append(frames[1])
+        if sum([len(v) for v in received.values()]) == 200:
+            done.set()
+    decoder = BroadcastDecoder(handler, workers=3, depth=1000)
+    for i in range(100):
+        decoder.submit([b'a', i])
+        decoder.submit([b'b', i])
+    assert done.wait(5)
+    decoder.stop()
+    assert received[b'a'] == list(range(100)) and received[b'b'] == list(range(100))
+
+
+# Testing the recorder
+# --------------------
+
+# Testing that scalars and images are stored as separate x and y datasets
+def test_recorder(tmp_path):
+    recorder = H5Recorder(str(tmp_path), 100)
+    assert recorder.openfile()
+    for i in range(2500):
+        recorder.append('History(pe)', float(i), 1000.+i)
+    recorder.flush()
+    for i in range(3):
+        recorder.append('CCD', np.full((4, 5), i, dtype=np.uint16), 2000.+i)
+    recorder.closefile()
+    files = list(tmp_path.iterdir())
+    assert len(files) == 1
+    with h5py.File(str(files[0]), 'r') as f:
+        assert (f['pe/y'][:] == np.arange(2500)).all()
+        assert (f['pe/x'][:] == 1000.+np.arange(2500)).all()
+        assert f['CCD/y'].shape == (3, 4, 5) and f['CCD/y'].dtype == np.uint16
+        assert (f['CCD/y'][2] == 2).all()
+
+# Testing that a new file is started when the file gets too large
+def test_recorder_rollover(tmp_path):
+    recorder = H5Recorder(str(tmp_path), 0.1)
+    assert recorder.openfile()
+    for i in range(5):
+        for j in range(20):
+            recorder.append('CCD', np.random.rand(32, 32), float(20*i+j))
+        recorder.flush()
+    recorder.closefile()
+    assert len(list(tmp_path.iterdir())) > 1
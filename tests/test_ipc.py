@@ -0,0 +1,647 @@
+import os, sys
+import multiprocessing
+import subprocess
+import time
+import numpy as np
+
+# Make sure we are relative to the root path
+__thisdir__ = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, __thisdir__)
+
+from hummingbird.backend import Record
+from hummingbird.ipc import broadcast, compression, framing, local, mpi, views
+from hummingbird.ipc.ratelimit import TokenBucket, RateLimiter
+
+
+# Testing the rate limiting
+# -------------------------
+
+# Testing that the bucket lets through a burst and then refills
+def test_token_bucket():
+    bucket = TokenBucket(100., burst=10)
+    assert sum([bucket.consume() for i in range(20)]) == 10
+    time.sleep(0.05)
+    assert bucket.consume()
+
+# Testing that anything bigger than the bucket passes when it is full
+def test_token_bucket_large():
+    bucket = TokenBucket(1000.)
+    assert bucket.consume(5000)
+    assert not bucket.consume(1)
+
+# Testing that each title is limited separately
+def test_rate_limiter():
+    limiter = RateLimiter()
+    assert limiter.allow('a', 1.)
+    assert not limiter.allow('a', 1.)
+    assert limiter.allow('b', 1.)
+
+# Testing that taking several items lets through as many as there are tokens
+def test_token_bucket_take():
+    bucket = TokenBucket(0.1, burst=5)
+    assert bucket.take(3) == 3
+    assert bucket.take(4) == 2
+    assert bucket.take(1) == 0
+
+# Testing that the master charges every item of a batch to the send_rate
+def test_master_send_rate(monkeypatch):
+    monkeypatch.setattr(mpi, '_master_rate_limiter', RateLimiter())
+    kwds = {'send_rate': 5}
+    batch = [None, 'new_data_batch', 'scalar', np.arange(3.), np.arange(3), kwds, ['a', 'b', 'c']]
+    assert mpi._limit_send_rate(['scalar', list(batch)]) is not None
+    # Only the newest two fit in the budget
+    msg = mpi._limit_send_rate(['scalar', list(batch)])
+    assert list(msg[1][3]) == [1., 2.] and list(msg[1][4]) == [1, 2]
+    assert msg[1][6] == ['b', 'c']
+    assert mpi._limit_send_rate(['scalar', list(batch)]) is None
+    assert mpi._limit_send_rate(['other', [None, 'new_data', 'other', 1., 0, kwds]]) is not None
+
+
+# Testing the binary encoding of broadcasts
+# -----------------------------------------
+
+# Testing that a broadcast comes back unchanged
+def test_framing_roundtrip():
+    image = np.random.rand(4, 5).astype(np.float32)
+    data = [None, 'new_data', 'CCD', image, 1.5, {'msg': 'hit', 'vmin': 0}]
+    frames = framing.encode(data, 'CCD')
+    assert len(frames) == 2
+    decoded = framing.decode([bytes(frames[0]), frames[1].tobytes()])
+    assert decoded[:3] == data[:3]
+    assert decoded[3].dtype == np.float32
+    assert (decoded[3] == image).all()
+    assert decoded[4:] == data[4:]
+
+# Testing the keys of binary broadcasts
+def test_framing_keys():
+    digest = b'0123456789abcdef'
+    assert framing.is_key(framing.key(digest))
+    assert not framing.is_key(digest)
+    assert framing.base_key(framing.key(digest)) == digest
+    assert framing.is_key(framing.batch_key(digest))
+    assert framing.base_key(framing.batch_key(digest)) == digest
+
+# Testing that compressed arrays come back unchanged
+def test_compression_roundtrip():
+    image = np.random.rand(32, 32)
+    data, md = compression.encode(image, {'compression': 'zlib'})
+    assert (compression.decode(data, md) == image).all()
+
+# Testing that downcasting keeps the values close
+def test_compression_downcast():
+    image = np.random.rand(32, 32)*100.
+    data, md = compression.encode(image, {'downcast': 'uint16'})
+    assert len(data) == image.size*2
+    assert np.abs(compression.decode(data, md) - image).max() < 1e-2
+
+# Testing that NaN survives downcasting to uint16
+def test_compression_downcast_nan():
+    image = np.random.rand(8, 8)
+    image[2, 3] = np.nan
+    data, md = compression.encode(image, {'downcast': 'uint16'})
+    decoded = compression.decode(data, md)
+    assert np.isnan(decoded[2, 3]) and np.isnan(decoded).sum() == 1
+    assert np.nanmax(np.abs(decoded - image)) < 1e-4
+
+# Testing that arrays which do not survive downcasting are sent unchanged
+def test_compression_downcast_skipped():
+    for downcast, value in [('uint16', np.inf), ('float16', 1e6)]:
+        image = np.ones((4, 4))
+        image[0, 0] = value
+        data, md = compression.encode(image, {'downcast': downcast})
+        assert 'downcast' not in md
+        assert (compression.decode(data, md) == image).all()
+
+# Testing the binned and cropped views of images
+def test_views():
+    image = np.arange(64, dtype=np.float64).reshape(8, 8)
+    view = views.normalize(binning=2, roi=[0, 4, 2, 8])
+    assert views.name('CCD', view) == 'CCD#bin=2#roi=0,4,2,8'
+    assert views.name('CCD', views.normalize()) == 'CCD'
+    binned = views.apply(image, view)
+    assert binned.shape == (2, 3)
+    assert binned[0, 0] == image[0:2, 2:4].mean()
+    assert views.apply(np.arange(8), view).shape == (8,)
+
+
+# Testing the lazy data of broadcasts
+# -----------------------------------
+
+# Testing that functions and records are only evaluated when asked
+def test_lazy_data():
+    calls = []
+    def data():
+        calls.append(1)
+        return np.ones(3)
+    assert broadcast._is_lazy(data)
+    assert not broadcast._is_lazy(np.ones(3))
+    record = Record('CCD', data)
+    assert broadcast._is_lazy(record)
+    assert not calls
+    assert (broadcast._evaluate(record) == 1).all()
+    assert (broadcast._evaluate(data) == 1).all()
+    assert len(calls) == 2
+
+# Testing that a plotted image is only read when the title is subscribed, and then once
+def test_lazy_plot_image(monkeypatch):
+    import hashlib
+    from hummingbird import plotting
+    class FakeEvent(object):
+        def event_id(self):
+            return 1.
+    sent = outbox(monkeypatch, interval=0)
+    monkeypatch.setattr(broadcast, 'evt', FakeEvent())
+    monkeypatch.setattr(mpi, 'is_slave', lambda: True)
+    monkeypatch.setattr(mpi, 'subscribed', set())
+    monkeypatch.setattr(plotting.image, 'images', {})
+    calls = []
+    def data():
+        calls.append(1)
+        return np.ones((2, 2))
+    plotting.image.plotImage(Record('CCD', data))
+    assert not calls
+    # Only the configuration was sent
+    assert all(isinstance(msg, dict) for msg in sent)
+    mpi.subscribed.add(hashlib.md5(b'CCD').digest())
+    plotting.image.plotImage(Record('CCD', data))
+    assert len(calls) == 1
+    assert [msg[2] for msg in sent if isinstance(msg, list)] == ['CCD']
+
+# Testing that an image without a mask is sent as it was plotted, when the record data changes later
+def test_plot_image_queued(monkeypatch):
+    import hashlib
+    from hummingbird import plotting
+    class FakeEvent(object):
+        def event_id(self):
+            return 1.
+    sent = outbox(monkeypatch)
+    monkeypatch.setattr(broadcast, 'evt', FakeEvent())
+    monkeypatch.setattr(mpi, 'is_slave', lambda: True)
+    monkeypatch.setattr(mpi, 'subscribed', set([hashlib.md5(b'CCD').digest()]))
+    monkeypatch.setattr(plotting.image, 'images', {})
+    record = Record('CCD', np.zeros((2, 2)))
+    plotting.image.plotImage(record)
+    record.data[...] = 1
+    broadcast.flush_outbox(force=True)
+    images = [msg[3] for msg in sent if isinstance(msg, list)]
+    assert len(images) == 1 and (images[0] == 0).all()
+
+# Testing the work queue
+# ----------------------
+
+# Testing that the batches cover the items once, in order
+def test_next_batch():
+    batches = []
+    while True:
+        start, stop = mpi.next_batch('test_next_batch', 25, 10, start=3)
+        if start >= stop:
+            break
+        batches.append((start, stop))
+    assert batches == [(3, 13), (13, 23), (23, 25)]
+    assert mpi.next_batch('test_next_batch', 25, 10, start=3) == (25, 25)
+
+
+# Testing the local multi-process mode
+# ------------------------------------
+
+# Returns the message matching the arguments, waiting for the queue to deliver it
+def wait_for_message(comm, source=local.ANY_SOURCE, tag=local.ANY_TAG):
+    status = local.Status()
+    end = time.time() + 5
+    while not comm.Iprobe(source, tag, status):
+        assert time.time() < end
+        time.sleep(0.01)
+    return status
+
+# Testing that messages are received by source and tag, in order
+def test_local_comm():
+    inboxes = [multiprocessing.Queue() for _ in range(3)]
+    comms = [local.LocalComm(inboxes, rank) for rank in range(3)]
+    comms[1].send('a', 0, tag=1)
+    comms[2].send('b', 0, tag=0)
+    comms[1].send('c', 0, tag=0)
+    status = wait_for_message(comms[0], source=2)
+    assert (status.Get_source(), status.Get_tag()) == (2, 0)
+    assert comms[0].recv(None, 2, 0) == 'b'
+    wait_for_message(comms[0], tag=0)
+    assert comms[0].recv(None, local.ANY_SOURCE, 0, status) == 'c'
+    assert comms[0].recv() == 'a'
+    assert not comms[0].Iprobe()
+    array = np.arange(100000, dtype=np.float32)
+    comms[0].Send(array, 2, tag=1)
+    received = np.empty_like(array)
+    comms[2].Recv(received, 0, 1)
+    assert (received == array).all()
+
+# Testing that waiting for a message gives up when the sender died
+def test_local_comm_check():
+    inboxes = [multiprocessing.Queue() for _ in range(2)]
+    def check():
+        raise local.WorkerError('gone')
+    comm = local.LocalComm(inboxes, 0, check)
+    try:
+        comm.recv()
+        assert False
+    except local.WorkerError:
+        pass
+
+# Runs the backend processes of start() with the given target, returning the exit code and output
+def run_local(target, workers=3):
+    script = """
+import sys
+sys.path.insert(0, %r)
+from hummingbird import ipc
+def target():
+    if ipc.mpi.is_master():
+        while not ipc.mpi.master_loop():
+            pass
+        print('master done')
+    else:
+%s
+        ipc.mpi.slave_done()
+ipc.local.start(%d, target)
+""" % (__thisdir__, target, workers)
+    p = subprocess.run([sys.executable, '-c', script], capture_output=True, timeout=60, text=True)
+    return p.returncode, p.stdout + p.stderr
+
+# Testing that the master returns once all the workers are done
+def test_local_start():
+    code, output = run_local("        ipc.mpi.send('__data_conf__', {})")
+    assert code == 0, output
+    assert 'master done' in output
+
+# Testing that the master stops, rather than waiting forever, when a worker dies
+def test_local_start_crash():
+    code, output = run_local("        if ipc.mpi.rank == 2: raise NameError('crash')")
+    assert code == 1, output
+    assert 'Worker 2 exited with code 1' in output
+    assert 'master done' not in output
+
+# Testing that the workers share the batches of a work queue, while taking part in sums
+def test_local_next_batch():
+    import ast
+    code, output = run_local("""        import numpy
+        ipc.mpi.init_event_reader_comm(0)
+        batches = []
+        while True:
+            start, stop = ipc.mpi.next_batch('queue', 100, 7)
+            if start >= stop:
+                break
+            batches.append((start, stop))
+            ipc.mpi.sum('total', numpy.ones(2))
+        # In one go, not to be mixed up with the output of the others
+        sys.stdout.write('batches %r\\n' % batches)
+        sys.stdout.flush()""")
+    assert code == 0, output
+    batches = []
+    for line in output.splitlines():
+        if line.startswith('batches '):
+            batches += ast.literal_eval(line[len('batches '):])
+    assert sorted(batches) == [(i, min(i+7, 100)) for i in range(0, 100, 7)]
+
+
+# Testing the messages between the ranks
+# --------------------------------------
+
+# Testing that only large numeric arrays are taken out of the messages
+def test_pack():
+    large = np.arange(mpi.array_threshold//8, dtype=np.float64)
+    small = np.arange(10)
+    strings = np.array(['a']*mpi.array_threshold)
+    arrays = []
+    packed = mpi._pack(['title', [large, small, strings], 3], arrays)
+    assert len(arrays) == 1 and arrays[0] is large
+    assert isinstance(packed[1][0], mpi._ArrayHeader)
+    assert packed[1][1] is small and packed[1][2] is strings
+
+# Testing that messages with large and small arrays, nested in lists, arrive unchanged
+def test_send_packed(monkeypatch):
+    inboxes = [multiprocessing.Queue() for _ in range(2)]
+    comms = [local.LocalComm(inboxes, rank) for rank in range(2)]
+    large = np.random.rand(300, 300).astype(np.float32)
+    image = np.arange(mpi.array_threshold, dtype=np.uint8).reshape(2, -1)
+    small = np.arange(5)
+    monkeypatch.setattr(mpi, 'comm', comms[1])
+    mpi._send_packed(['title', [large, ['nested', image]], small, 1.5], 0)
+    monkeypatch.setattr(mpi, 'comm', comms[0])
+    status = local.Status()
+    msg = mpi._recv_packed(local.ANY_SOURCE, status)
+    assert status.Get_source() == 1
+    assert msg[0] == 'title' and msg[3] == 1.5
+    assert msg[1][0].dtype == large.dtype and (msg[1][0] == large).all()
+    assert msg[1][1][0] == 'nested'
+    assert msg[1][1][1].shape == image.shape and (msg[1][1][1] == image).all()
+    assert (msg[2] == small).all()
+
+
+# Testing the master loop
+# -----------------------
+
+class FakeZmqServer(object):
+    """Records the broadcasts of the master"""
+    def __init__(self):
+        self.sent = []
+    def send(self, title, data):
+        self.sent.append((title, data[1], data[3]))
+
+# Returns the communicators of n local processes, with the one of the master in ipc.mpi
+def master_comms(monkeypatch, n):
+    inboxes = [multiprocessing.Queue() for _ in range(n)]
+    comms = [local.LocalComm(inboxes, rank) for rank in range(n)]
+    monkeypatch.setattr(mpi, 'comm', comms[0])
+    return comms
+
+# Sends a message from comm to the master, like ipc.mpi.send
+def send_to_master(monkeypatch, comm, title, data):
+    master = mpi.comm
+    monkeypatch.setattr(mpi, 'comm', comm)
+    mpi.send(title, data)
+    monkeypatch.setattr(mpi, 'comm', master)
+
+# Waits until n messages reached the master
+def wait_for_messages(comm, n):
+    end = time.time() + 5
+    while len(comm._pending) < n:
+        assert time.time() < end
+        comm.Iprobe()
+        time.sleep(0.01)
+
+# Testing that only the newest image of a title is sent on, but all summed images are
+def test_master_loop_images(monkeypatch):
+    from hummingbird.ipc import zmqserver
+    server = FakeZmqServer()
+    monkeypatch.setattr(zmqserver, 'get_zmq_server', lambda: server)
+    monkeypatch.setattr(broadcast, 'data_conf', {'image': {'data_type': 'image'},
+                                                 'summed': {'data_type': 'image'},
+                                                 'maxed': {'data_type': 'image'},
+                                                 'scalar': {'data_type': 'scalar'}})
+    comms = master_comms(monkeypatch, 3)
+    for i in range(3):
+        for title, kwds in [('image', {}), ('summed', {'sum_over': True}),
+                            ('maxed', {'max_over': True}), ('scalar', {})]:
+            send_to_master(monkeypatch, comms[1 + i%2], title,
+                           [None, 'new_data', title, np.full((2, 2), i), i, kwds])
+    wait_for_messages(comms[0], 12)
+    assert not mpi.master_loop()
+    assert mpi.master_queue_depth == 12
+    sent = [(title, data[0, 0]) for title, cmd, data in server.sent]
+    assert [i for title, i in sent if title == 'image'] == [2]
+    for title in ['summed', 'maxed', 'scalar']:
+        assert [i for t, i in sent if t == title] == [0, 1, 2]
+
+# Testing that the configuration is handled before the data
+def test_master_loop_conf(monkeypatch):
+    from hummingbird.ipc import zmqserver
+    server = FakeZmqServer()
+    conf_when_sent = []
+    def send(title, data):
+        conf_when_sent.append(dict(broadcast.data_conf.get(title, {})))
+    server.send = send
+    monkeypatch.setattr(zmqserver, 'get_zmq_server', lambda: server)
+    monkeypatch.setattr(broadcast, 'data_conf', {})
+    comms = master_comms(monkeypatch, 2)
+    send_to_master(monkeypatch, comms[1], 'scalar', [None, 'new_data', 'scalar', 1., 0, {}])
+    send_to_master(monkeypatch, comms[1], '__data_conf__', {'scalar': {'data_type': 'scalar'}})
+    wait_for_messages(comms[0], 2)
+    mpi.master_loop()
+    assert conf_when_sent == [{'data_type': 'scalar'}]
+
+
+# Testing the outbox of the slaves
+# --------------------------------
+
+# Returns the list the messages sent to the master end up in, with an empty outbox
+def outbox(monkeypatch, interval=10., size=100):
+    sent = []
+    monkeypatch.setattr(mpi, 'send', lambda title, data: sent.append(data))
+    monkeypatch.setattr(broadcast, 'data_conf', {'scalar': {'data_type': 'scalar'},
+                                                 'image': {'data_type': 'image'},
+                                                 'summed': {'data_type': 'image'}})
+    monkeypatch.setattr(broadcast, 'outbox_interval', interval)
+    monkeypatch.setattr(broadcast, 'outbox_size', size)
+    monkeypatch.setattr(broadcast, '_outbox', {})
+    monkeypatch.setattr(broadcast, '_outbox_count', 0)
+    monkeypatch.setattr(broadcast, '_outbox_time', time.time())
+    return sent
+
+# Testing that scalars are sent together, with their messages
+def test_outbox_scalars(monkeypatch):
+    sent = outbox(monkeypatch)
+    for i in range(3):
+        broadcast._post('scalar', float(i), 10+i, {'msg': 'm%d' % i})
+    assert not sent
+    broadcast.flush_outbox(force=True)
+    assert len(sent) == 1
+    uuid, cmd, title, ys, xs, kwds, msgs = sent[0]
+    assert (cmd, title) == ('new_data_batch', 'scalar')
+    assert ys.tolist() == [0., 1., 2.] and xs.tolist() == [10, 11, 12]
+    assert kwds == {'msg': 'm2'} and msgs == ['m0', 'm1', 'm2']
+    broadcast.flush_outbox(force=True)
+    assert len(sent) == 1
+
+# Testing that only the newest image is sent, unless the images are added up
+def test_outbox_images(monkeypatch):
+    sent = outbox(monkeypatch)
+    for i in range(3):
+        broadcast._post('image', np.full((2, 2), i), i, {})
+        broadcast._post('summed', np.full((2, 2), i), i, {'sum_over': True})
+    broadcast.flush_outbox(force=True)
+    assert [(m[2], m[3][0, 0]) for m in sent if m[2] == 'image'] == [('image', 2)]
+    assert [(m[2], m[3][0, 0]) for m in sent if m[2] == 'summed'] == [('summed', i) for i in range(3)]
+    assert set([m[1] for m in sent]) == set(['new_data'])
+
+# Testing that the outbox is sent once it is full, and right away without an interval
+def test_outbox_flush(monkeypatch):
+    sent = outbox(monkeypatch, size=2)
+    broadcast._post('scalar', 1., 0, {})
+    assert not sent
+    broadcast._post('scalar', 2., 1, {})
+    assert len(sent) == 1 and sent[0][3].tolist() == [1., 2.]
+    sent = outbox(monkeypatch, interval=0)
+    broadcast._post('scalar', 3., 2, {})
+    assert len(sent) == 1 and sent[0][1:5] == ['new_data', 'scalar', 3., 2]
+
+# Testing that the arrays in the outbox do not change with the ones of the analysis
+def test_outbox_copies(monkeypatch):
+    sent = outbox(monkeypatch)
+    image = np.zeros((2, 2))
+    broadcast._post('summed', image, 0, {'sum_over': True})
+    image[...] = 1
+    broadcast._post('summed', image, 1, {'sum_over': True})
+    broadcast.flush_outbox(force=True)
+    assert [m[3][0, 0] for m in sent] == [0, 1]
+
+
+# Testing the publishing of the broadcasts
+# ----------------------------------------
+
+class FakeDataSocket(object):
+    """Records the frames sent, by key"""
+    def __init__(self):
+        self.sent = []
+        self.key = None
+    def send(self, frame, flags=0, copy=True, track=False):
+        if self.key is None:
+            self.key = frame
+        else:
+            self.sent.append((self.key, frame))
+            self.key = None
+    def send_multipart(self, frames, copy=True):
+        self.sent.append((self.key, framing.decode([bytes(f) for f in frames])))
+        self.key = None
+    def send_json(self, data, flags=0):
+        self.send(data, flags)
+
+# Returns a zmq server publishing to a FakeDataSocket, with the given keys subscribed
+def publishing_server(monkeypatch, subscribed):
+    from hummingbird.ipc import zmqserver
+    monkeypatch.setattr(broadcast, 'data_conf', {'scalar': {'data_type': 'scalar'}})
+    server = zmqserver.ZmqServer.__new__(zmqserver.ZmqServer)
+    server._batch_mode = False
+    server._state = {}
+    server._bandwidth = None
+    server._views = {}
+    server._view_keys = {}
+    server._data_socket = FakeDataSocket()
+    server._subscribed = set(subscribed)
+    return server
+
+# Testing that batches of scalars only go to the clients which take them
+def test_publish_batches(monkeypatch):
+    from hummingbird.ipc import zmqserver
+    key = zmqserver._key('scalar')
+    batch = [None, 'new_data_batch', 'scalar', np.arange(3.), np.arange(10, 13), {'msg': 'c'}, ['a', None, 'c']]
+    server = publishing_server(monkeypatch, [framing.batch_key(key)])
+    server.send('scalar', list(batch))
+    assert len(server._data_socket.sent) == 1
+    sent_key, data = server._data_socket.sent[0]
+    assert sent_key == framing.batch_key(key) and data[1] == 'new_data_batch'
+    assert data[3].tolist() == [0., 1., 2.]
+    server = publishing_server(monkeypatch, [framing.key(key), key])
+    server.send('scalar', list(batch))
+    sent = server._data_socket.sent
+    binary = [data for k, data in sent if k == framing.key(key)]
+    assert [(d[1], d[3], d[4], d[5]) for d in binary] == [('new_data', 0., 10, {'msg': 'a'}),
+                                                          ('new_data', 1., 11, {}),
+                                                          ('new_data', 2., 12, {'msg': 'c'})]
+    assert [data[1] for k, data in sent if k == key] == ['new_data']*3
+
+# Testing that subscriptions replace the set of subscribed keys rather than modify it,
+# so that the threads reading it never see it change
+def test_forward_subscriptions(monkeypatch):
+    from hummingbird.ipc import zmqserver
+    key = zmqserver._key('scalar')
+    server = publishing_server(monkeypatch, [])
+    forwarded = []
+    monkeypatch.setattr(server, '_xsub_stream', type('Stream', (), {'send_multipart': staticmethod(forwarded.append)}), raising=False)
+    subscribed = server.subscribed
+    server._forward_xpub(None, [b'\x01' + framing.key(key)])
+    assert subscribed == set() and server.subscribed == set([framing.key(key)])
+    assert server.is_subscribed('scalar')
+    subscribed = server.subscribed
+    server._forward_xpub(None, [b'\x00' + framing.key(key)])
+    assert subscribed == set([framing.key(key)]) and server.subscribed == set()
+    assert not server.is_subscribed('scalar')
+    assert len(forwarded) == 2
+
+
+# Testing the non-blocking reductions
+# -----------------------------------
+
+# Sets up the master and two event readers, of which the first one is the main one
+def reductions(monkeypatch, period=1):
+    from hummingbird.ipc import zmqserver
+    monkeypatch.setattr(zmqserver, 'get_zmq_server', lambda: FakeZmqServer())
+    monkeypatch.setattr(mpi, 'reducedata', {})
+    monkeypatch.setattr(mpi, 'reducetotal', {})
+    monkeypatch.setattr(mpi, 'reduction_period', period)
+    monkeypatch.setattr(mpi, 'use_mpi', True)
+    comms = master_comms(monkeypatch, 3)
+    monkeypatch.setattr(mpi, 'is_main_event_reader', lambda: mpi.comm is comms[1])
+    for comm in comms[1:]:
+        comm.reductions = {}
+    return comms
+
+# Calls sum() as the event reader with the given communicator
+def reader_sum(monkeypatch, comm, cmd, array):
+    master = mpi.comm
+    monkeypatch.setattr(mpi, 'comm', comm)
+    monkeypatch.setattr(mpi, '_reductions', comm.reductions)
+    mpi.sum(cmd, array)
+    monkeypatch.setattr(mpi, 'comm', master)
+    return array
+
+# Testing that a contribution is sent every period calls, without waiting for the total,
+# and that the newest total received is returned
+def test_reduction_period(monkeypatch):
+    comms = reductions(monkeypatch, period=2)
+    # The other event reader contributes without asking for the total
+    reader_sum(monkeypatch, comms[2], 'total', np.full(3, 2.))
+    reader_sum(monkeypatch, comms[2], 'total', np.full(3, 2.))
+    wait_for_messages(comms[0], 1)
+    assert (reader_sum(monkeypatch, comms[1], 'total', np.ones(3)) == 1).all()
+    assert len(comms[0]._pending) == 1 and not comms[0].Iprobe(1)
+    reader_sum(monkeypatch, comms[1], 'total', np.ones(3))
+    wait_for_messages(comms[0], 2)
+    mpi.master_loop()
+    assert (mpi.reducetotal['total'] == 3).all()
+    wait_for_message(comms[1], 0, mpi._REDUCE_TAG)
+    # The new total is returned, while the next contribution is only sent every other call
+    assert (reader_sum(monkeypatch, comms[1], 'total', np.full(3, 5.)) == 3).all()
+    assert (comms[1].reductions['total'].sendbuf == 1).all()
+    assert (reader_sum(monkeypatch, comms[1], 'total', np.full(3, 5.)) == 3).all()
+    assert (comms[1].reductions['total'].sendbuf == 5).all()
+
+# Testing that the main event reader waits for the total of its last contribution at the end
+def test_reduction_done(monkeypatch):
+    comms = reductions(monkeypatch)
+    reader_sum(monkeypatch, comms[1], 'total', np.full(3, 3.))
+    reduction = comms[1].reductions['total']
+    assert reduction.waiting and reduction.result is None
+    wait_for_messages(comms[0], 1)
+    mpi.master_loop()
+    monkeypatch.setattr(mpi, 'comm', comms[1])
+    reduction.done()
+    assert not reduction.waiting and (reduction.result == 3).all()
+
+# Testing with mpirun that the event readers do not need to call sum() equally often
+def test_reduction_uneven():
+    import shutil
+    import pytest
+    pytest.importorskip('mpi4py')
+    if shutil.which('mpirun') is None:
+        pytest.skip('mpirun is not available')
+    script = """
+import sys, time
+sys.path.insert(0, %r)
+import numpy
+from hummingbird.ipc import mpi
+mpi.init_event_reader_comm(0)
+if mpi.is_master():
+    while not mpi.master_loop():
+        pass
+    sys.stdout.write('master done\\n')
+else:
+    # Rank 2 never calls sum(), rank 3 many more times than the main event reader
+    if mpi.rank == 3:
+        for i in range(40):
+            mpi.sum('total', numpy.full(2000, 3.))
+    if mpi.is_main_event_reader():
+        total = numpy.zeros(2000)
+        end = time.time() + 20
+        while total[0] != 4 and time.time() < end:
+            total[:] = 1
+            mpi.sum('total', total)
+        sys.stdout.write('total %%d\\n' %% total[0])
+    mpi.slave_done()
+""" % __thisdir__
+    args = ['mpirun', '-n', '4']
+    version = subprocess.run(['mpirun', '--version'], capture_output=True, text=True)
+    if 'Open MPI' in version.stdout:
+        args += ['--allow-run-as-root', '--oversubscribe']
+    # Not the environment MPI set up for this process, which would confuse mpirun
+    p = subprocess.run(args + [sys.executable, '-c', script], capture_output=True,
+                       timeout=60, text=True, env=dict(os.environ))
+    output = p.stdout + p.stderr
+    assert p.returncode == 0, output
+    assert 'total 4' in output and 'master done' in output